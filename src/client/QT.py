@@ -14,12 +14,27 @@ from PyQt5.QtCore import Qt, pyqtSignal, QTimer
 from PyQt5.QtGui import QFont, QPixmap, QIcon
 import humanize
 import WebsocketMG
+from transfer import file_info
+from imaging import ImageJob, STAGE_QUEUED, STAGE_DECODE, STAGE_RESIZE, STAGE_ENCODE, STAGE_SENDING, STAGE_SENT, \
+    STAGE_CANCELLED, STAGE_FAILED, CANCELLABLE_STAGES
 import asyncio
 
 CONFIG_FILE = 'client.config'
 
 user_id = 0
 
+# 图片气泡下方显示的压缩、发送进度，发送完成后不再显示
+PROGRESS_TEXT = {
+    STAGE_QUEUED: "等待压缩",
+    STAGE_DECODE: "压缩中",
+    STAGE_RESIZE: "压缩中",
+    STAGE_ENCODE: "压缩中",
+    STAGE_SENDING: "发送中",
+    STAGE_SENT: "",
+    STAGE_CANCELLED: "已取消",
+    STAGE_FAILED: "发送失败",
+}
+
 
 def insert_soft_breaks(text):
     return '\u200b'.join(text)
@@ -339,6 +354,26 @@ class MessageBubble(QWidget):
         self.label.mousePressEvent = lambda e: os.startfile(self.content)
         self.layout.addWidget(self.label)
 
+    def track(self, job):
+        """显示图片任务的进度，发送之前点击进度可以取消"""
+        self.status = QLabel()
+        self.status.setStyleSheet("color: #888888; font-size: 11px;")
+        self.job = job
+        self.layout.addWidget(self.status)
+        job.on_progress = self.set_progress
+        self.set_progress(job.stage, 0.0)
+
+    def set_progress(self, stage, fraction=None):
+        text = PROGRESS_TEXT.get(stage, "")
+        if stage in CANCELLABLE_STAGES:
+            text += f" {int(fraction * 100)}%（点击取消）"
+            self.status.mousePressEvent = lambda e: self.job.cancel()
+        else:
+            # 开始发送后点击不再取消
+            self.status.mousePressEvent = lambda e: None
+        self.status.setText(text)
+        self.status.setVisible(bool(text))
+
     def adjust_bubble_width(self, max_width):
         if self.current_max_width == max_width:
             return
@@ -374,9 +409,9 @@ class SendOnEnterTextEdit(QTextEdit):
             event.ignore()
 
     def dropEvent(self, event):
-        urls = event.mimeData().urls()
-        if urls:
-            local_path = urls[0].toLocalFile()
+        # 一次拖入多个文件时逐个发送，图片在后台并行压缩
+        for url in event.mimeData().urls():
+            local_path = url.toLocalFile()
             if os.path.isfile(local_path):
                 # 只接受图片和常见文档类型
                 ext = os.path.splitext(local_path)[1].lower()
@@ -523,7 +558,9 @@ class GridLayoutWindow(CustomWindow):
 
         if is_image:
             self.add_message(file_path, "image", name=WebsocketMG.global_state.username, is_sender=True)
-            QTimer.singleShot(0, lambda: asyncio.create_task(self.web.send_image(file_path)))
+            job = ImageJob(file_path)
+            self.bubbles[-1].track(job)
+            QTimer.singleShot(0, lambda: asyncio.create_task(self.web.send_image(file_path, job=job)))
         else:
             self.add_message(file_path, "file", name=WebsocketMG.global_state.username, is_sender=True)
             QTimer.singleShot(0, lambda: asyncio.create_task(self.web.send_file(file_path)))
@@ -706,7 +743,8 @@ class GridLayoutWindow(CustomWindow):
 
                 mess = await self.web.message_queue.get()
                 logging.info(f"前端消息队列输出：{mess}")
-                data = json.loads(mess)
+                # 收到的消息是已解析的字典，本地加载的历史消息是 JSON 文本
+                data = mess if isinstance(mess, dict) else json.loads(mess)
                 msg = data['message']
                 name = data['name']
                 flag = data['flag']
@@ -740,7 +778,17 @@ class GridLayoutWindow(CustomWindow):
                 elif flag == 8 and os.path.exists(msg):
                     self.add_message(msg, "image", name=name, time=time, is_sender=is_sender)
                 elif flag == 9:
-                    self.add_message(msg, "text", name=name, time=time, is_sender=is_sender)
+                    # 自己发送的文件显示本地文件，其他人发送的文件显示文件名和大小
+                    info = file_info(msg)
+                    if info and info.get('path') and os.path.exists(info['path']):
+                        self.add_message(info['path'], "file", name=name, time=time, is_sender=is_sender)
+                    elif info:
+                        self.add_message(f"📎 {info['name']}（{humanize.naturalsize(info['size'])}）", "text",
+                                         name=name, time=time, is_sender=is_sender)
+                        if info.get('file') is not None:
+                            # 点击后按文件 id 下载，完成后显示为文件气泡
+                            self.bubbles[-1].label.mousePressEvent = \
+                                lambda e, data=data, info=info: asyncio.create_task(self.download_file(data, info))
                 elif flag == 10:
                     file_path = msg
                     new_name = name + '.png'
@@ -760,6 +808,11 @@ class GridLayoutWindow(CustomWindow):
                 print(f"Error processing message: {e}")
             await asyncio.sleep(0.1)  # 添加小延迟，避免过度占用CPU
 
+    async def download_file(self, data, info):
+        """下载别人发送的文件到 received_files 目录"""
+        path = os.path.join(os.getcwd(), "received_files", f"{info['file']}_{os.path.basename(info['name'])}")
+        await self.web.download_file(info['file'], path, data)
+
     def closeEvent(self, event):
         super().closeEvent(event)
 
@@ -5,12 +5,18 @@ import base64
 import os
 import ssl
 import string
+import uuid
 from datetime import datetime
 from sqlmg import SqlMG
+from protocol import binary_create, parse_frame, batch_messages, chunk_create, download_chunk_parse, CompactCodec, \
+    BINARY_SUBPROTOCOL, COMPACT_SUBPROTOCOL, DEFAULT_ROOM
+from transfer import Upload, Download, file_digest, file_info, read_chunk, DOWNLOAD_MAX_STREAMS
+from imaging import ImageEncoder, ImageJob, EncodeCancelled, STAGE_SENDING, STAGE_SENT, STAGE_CANCELLED, STAGE_FAILED
 import websockets
-from PIL import Image
-import io
+from compression import deflate_extensions, configure_deflate
 import random
+import collections
+import itertools
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -21,10 +27,8 @@ cert_path = os.path.join(current_dir, 'source', 'cert.pem')
 
 # 消息大小限制（10MB）
 MAX_MESSAGE_SIZE = 10 * 1024 * 1024
-# 图片压缩质量（1-100）
-IMAGE_QUALITY = 85
-# 最大图片尺寸
-MAX_IMAGE_SIZE = (1920, 1080)
+# 下载进度写入本地数据库的间隔（秒）
+DOWNLOAD_SAVE_INTERVAL = 1
 
 
 # 全局变量
@@ -50,9 +54,25 @@ class WebSocketManager:
         self.sql = SqlMG('basedata.db')
         self.sql.client_sql()
         self.is_connected = False
+        # 已发送但还没收到服务端回执的本地消息行号
+        self.unacked = collections.deque()
+        # 协商了紧凑协议时的编解码器
+        self.codec = None
+        # 正在进行的上传 {上传 id: Upload}
+        self.uploads = {}
+        # 正在进行的下载 {文件 id: Download}、下载任务 {文件 id: 任务}，以及进行中的请求 {请求号: Download}
+        self.downloads = {}
+        self.download_tasks = {}
+        self.download_requests = {}
+        self.request_ids = itertools.count(1)
+        # 连接上所有下载共用的范围请求名额，同步带来很多图片时排队请求，不会触发服务端的 BUSY
+        self.download_slots = asyncio.Semaphore(DOWNLOAD_MAX_STREAMS)
+        # 图片压缩线程池，以及最后提交的一张图片发送完成（或放弃）的标记
+        self.image_encoder = ImageEncoder()
+        self.image_sends = None
 
     @staticmethod
-    def json_create(flag, id, name, message, times):
+    def json_create(flag, id, name, message, times, room=None):
         # 如果times是datetime对象，转换为isoformat字符串
         if isinstance(times, datetime):
             times = times.isoformat()
@@ -63,12 +83,38 @@ class WebSocketManager:
             "message": message,
             "timestamp": times
         }
+        if room and room != DEFAULT_ROOM:
+            msg["room"] = room
         return json.dumps(msg)
 
     @staticmethod
     def now():
         return datetime.now().replace(microsecond=0).isoformat()
 
+    def encode(self, flag, id, name, message, times, room=None, extra=None):
+        """按握手时协商的格式编码要发送的消息：紧凑帧，或 JSON；extra 为附加的顶层字段"""
+        if self.codec is not None:
+            return self.codec.encode(flag, id, name, message, times, room=room, extra=extra)
+        msg = self.json_create(flag, id, name, message, times, room)
+        if extra:
+            msg = json.dumps({**json.loads(msg), **extra})
+        return msg
+
+    def encode_bytes(self, flag, data, room=None):
+        """按协商的格式编码携带原始字节的消息（图片、文件分块）：紧凑帧、二进制帧，或 base64 JSON"""
+        if self.codec is not None:
+            return self.encode(flag, global_state.user_id, global_state.username, data, self.now(), room)
+        if self.websocket.subprotocol == BINARY_SUBPROTOCOL:
+            return binary_create(flag, global_state.user_id, global_state.username, data, self.now(), room=room)
+        return self.json_create(flag, global_state.user_id, global_state.username,
+                                base64.b64encode(data).decode('utf-8'), self.now(), room)
+
+    def show(self, msg):
+        """把已解析的消息交给界面显示，界面直接使用字典，不再重复解析"""
+        if isinstance(msg['timestamp'], datetime):
+            msg = {**msg, "timestamp": msg['timestamp'].isoformat()}
+        self.message_queue.put_nowait(msg)
+
     async def refresh_message(self):
         """同步离线信息"""
         if not os.path.exists(CONFIG_FILE):
@@ -77,32 +123,18 @@ class WebSocketManager:
         with open(CONFIG_FILE, 'r') as f:
             config = json.load(f)
         time = config.get('time', -1)
-        if time == -1:
+        cursor = config.get('cursor')
+        if time == -1 and cursor is None:
             logger.info("时间戳为-1，跳过同步")
             self.update_time(self.now())
             return
-        logger.info(f"开始请求同步，上次同步时间：{time}")
+        logger.info(f"开始请求同步，上次同步时间：{time}，游标：{cursor}")
         try:
-            await self.websocket.send(self.json_create(5, global_state.user_id, 0, time, 0))
+            # 有游标时从上次确认的游标继续同步，否则由服务端把时间换算为游标
+            request = {"cursor": cursor} if cursor is not None else {"time": time}
+            await self.websocket.send(self.encode(5, global_state.user_id, 0, request, 0))
             logger.info("同步请求已发送")
-            async for msg in self.websocket:
-                rcv = json.loads(msg)
-                rcv['timestamp'] = datetime.fromisoformat(rcv['timestamp'])
-                logger.info(f"收到同步消息：{rcv}")
-                if rcv['message'] == "sync_complete":
-                    logger.info("同步完成")
-                    break
-                elif rcv['message'] == "heartbeat":
-                    continue
-                if rcv['flag'] == 0:
-                    self.sql.exec(
-                        "INSERT INTO messages(sender_id, sender_username, type, message, timestamp) VALUES (?,?,?,?,?)",
-                        (rcv['id'], rcv['name'], rcv['flag'], rcv['message'], rcv['timestamp']))
-                elif rcv['flag'] == 8:
-                    rcv = self.rec_pic_msg(rcv)
-                    self.sql.exec(
-                        "INSERT INTO messages(sender_id, sender_username, type, message, timestamp) VALUES (?,?,?,?,?)",
-                        (rcv['id'], rcv['name'], rcv['flag'], rcv['message'], rcv['timestamp']))
+            await self.receive_sync()
         except Exception as e:
             logger.error(f"同步过程中发生错误：{e}")
             # return
@@ -122,15 +154,171 @@ class WebSocketManager:
                                row['timestamp']))
         self.message_queue.put_nowait(self.json_create(7,0,0,0,0))
 
+    async def receive_sync(self, show=False):
+        """
+        接收同步消息直到 sync_complete，每页结束时先保存游标再确认；
+        show 为 True 时（凭令牌恢复会话）把补齐的消息直接交给界面显示
+        """
+        async for msg in self.websocket:
+            rcv = parse_frame(msg, self.codec)
+            if rcv['flag'] == 12:
+                items = batch_messages(rcv)
+                if show:
+                    items = [item for item in items if not self.is_known_message(item['seq'])]
+                    for item in items:
+                        self.message_queue.put_nowait(item)
+                self.save_batch(items)
+                continue
+            if self.dispatch_transfer(rcv):
+                continue
+            rcv['timestamp'] = datetime.fromisoformat(rcv['timestamp'])
+            logger.info(f"收到同步消息：{rcv}")
+            if rcv['message'] == "sync_complete":
+                # 没有更多消息时服务端在 seq 中带上最终游标，之前没有游标的客户端从这里开始按游标同步
+                if rcv.get('seq') is not None:
+                    self.update_time(self.now(), rcv['seq'])
+                logger.info("同步完成")
+                break
+            elif rcv['message'] == "heartbeat":
+                continue
+            if rcv['flag'] == 5:
+                await self.ack_sync_page(rcv['message'])
+                continue
+            if self.is_known_message(rcv.get('seq')):
+                continue
+            if rcv['flag'] in (0, 9, 15):
+                self.save_message(rcv)
+            elif rcv['flag'] == 8 and isinstance(rcv['message'], dict):
+                # 只收到图片的引用，下载完成后再显示
+                self.fetch_image(rcv)
+                continue
+            elif rcv['flag'] == 8:
+                rcv = self.rec_pic_msg(rcv)
+                self.save_message(rcv)
+            else:
+                continue
+            if show:
+                self.show(rcv)
+
+    async def ack_sync_page(self, end):
+        """
+        一页同步消息接收完毕：先保存游标再确认，断线重连后从这里继续；
+        按会话同步时页尾为 {"cursor": 游标, "peer": 用户id}，保存为该会话的游标，确认时原样回复
+        """
+        if isinstance(end, dict):
+            self.save_peer_cursor(end['peer'], end['cursor'])
+        else:
+            self.update_time(self.now(), end)
+        await self.websocket.send(self.encode(6, global_state.user_id, 0, end, self.now()))
+
+    async def sync_conversation(self, peer_id):
+        """
+        只同步与 peer_id 的私聊会话，从这个会话上次确认的游标继续；
+        同步的消息和页尾由 receive_messages 接收，与全局同步游标无关
+        """
+        cursor = 0
+        if os.path.exists(CONFIG_FILE):
+            with open(CONFIG_FILE, 'r') as f:
+                cursor = json.load(f).get('peer_cursors', {}).get(str(peer_id), 0)
+        await self.websocket.send(self.encode(5, global_state.user_id, 0, {"cursor": cursor, "peer": peer_id},
+                                              self.now()))
+
+    def is_known_message(self, seq):
+        """本地是否已经保存过该序号的消息"""
+        if seq is None:
+            return False
+        return bool(self.sql.fetch("SELECT 1 FROM messages WHERE server_id = ?", (seq,)))
+
+    def save_message(self, msg):
+        """保存收到的消息，带序号的消息按序号去重"""
+        self.sql.exec(
+            "INSERT OR IGNORE INTO messages(sender_id, sender_username, type, message, timestamp, server_id, room) VALUES (?,?,?,?,?,?,?)",
+            (msg['id'], msg['name'], msg['flag'], msg['message'], msg['timestamp'], msg.get('seq'),
+             msg.get('room', DEFAULT_ROOM)))
+
+    def save_batch(self, items):
+        """在一个事务中保存同步批量帧中的所有消息"""
+        self.sql.exec_many(
+            "INSERT OR IGNORE INTO messages(sender_id, sender_username, type, message, timestamp, server_id, room) VALUES (?,?,?,?,?,?,?)",
+            [(item['id'], item['name'], item['flag'], item['message'], datetime.fromisoformat(item['timestamp']),
+              item['seq'], item.get('room', DEFAULT_ROOM)) for item in items])
+        logger.info(f"收到同步批量消息 {len(items)} 条")
+
+    def ack_message(self, seq):
+        """收到服务端回执：记录自己发送的消息的序号（不移动同步游标）"""
+        if self.unacked:
+            self.sql.exec("UPDATE messages SET server_id = ? WHERE id = ?", (seq, self.unacked.popleft()))
+
     @staticmethod
-    def update_time(timestamp):
+    def update_time(timestamp, cursor=None):
+        """
+        保存同步时间和游标。游标只来自同步的页尾（flag 5）和同步完成（flag 7）：
+        实时消息和回执的序号之前可能有被丢弃或还在途中的消息，用它们移动游标会永久漏掉这些消息；
+        重新连接后从页尾同步时已经收到的消息按序号去重
+        """
         if os.path.exists(CONFIG_FILE):
             with open(CONFIG_FILE, 'r') as f:
                 data = json.load(f)
             data['time'] = timestamp
+            if cursor is not None:
+                data['cursor'] = max(cursor, data.get('cursor') or 0)
             with open(CONFIG_FILE, 'w') as f:
                 json.dump(data, f)
 
+    @staticmethod
+    def save_peer_cursor(peer_id, cursor):
+        """保存按会话同步的游标"""
+        if os.path.exists(CONFIG_FILE):
+            with open(CONFIG_FILE, 'r') as f:
+                data = json.load(f)
+            cursors = data.setdefault('peer_cursors', {})
+            cursors[str(peer_id)] = max(cursor, cursors.get(str(peer_id), 0))
+            with open(CONFIG_FILE, 'w') as f:
+                json.dump(data, f)
+
+    @staticmethod
+    def save_token(token, expires):
+        """保存服务端签发的会话令牌"""
+        if os.path.exists(CONFIG_FILE):
+            with open(CONFIG_FILE, 'r') as f:
+                data = json.load(f)
+            data['token'] = token
+            data['token_expires'] = expires
+            with open(CONFIG_FILE, 'w') as f:
+                json.dump(data, f)
+
+    async def resume_session(self, user_id, username, password):
+        """
+        凭上次登录时保存的令牌恢复会话：不再发送密码，服务端回复后直接发送断线期间错过的消息，
+        一次往返即可恢复。没有可用令牌或服务端拒绝时返回 False，改用密码登录
+        """
+        if not os.path.exists(CONFIG_FILE):
+            return False
+        with open(CONFIG_FILE, 'r') as f:
+            config = json.load(f)
+        token = config.get('token')
+        if not token or config.get('user_id') != user_id or config.get('token_expires', 0) <= datetime.now().timestamp():
+            return False
+        request = {"token": token, "cursor": config.get('cursor')}
+        await self.websocket.send(self.encode(16, user_id, username, request, self.now()))
+        rcv = parse_frame(await self.websocket.recv(), self.codec)
+        if rcv['flag'] != 16 or rcv['message'].get('status') != 'RESUMED':
+            logger.info("会话令牌已失效，使用密码登录")
+            return False
+        # 令牌只能恢复一次，保存服务端换发的新令牌供下次重连使用
+        self.save_token(rcv['message']['token'], rcv['message']['expires'])
+        global_state.user_id = user_id
+        global_state.username = username
+        global_state.password = password
+        logger.info("已凭令牌恢复会话")
+        await self.receive_sync(show=True)
+        self.is_connected = True
+        asyncio.create_task(self.receive_messages())
+        asyncio.create_task(self.heart_beat())
+        self.resume_uploads()
+        self.resume_downloads()
+        return True
+
     async def ws_client(self, user_id, username, password):
         # 更新全局状态
         global_state.user_id = user_id
@@ -139,9 +327,8 @@ class WebSocketManager:
 
         if user_id == 0:
             # 注册新用户
-            await self.websocket.send(self.json_create(2, 0, username, password, self.now()))
-            response = await self.websocket.recv()
-            rcv = json.loads(response)
+            await self.websocket.send(self.encode(2, 0, username, password, self.now()))
+            rcv = parse_frame(await self.websocket.recv(), self.codec)
             if rcv['message'] != 'REGISTERED':
                 logger.error("Registration failed")
                 return False
@@ -153,12 +340,15 @@ class WebSocketManager:
                 json.dump({'user_id': user_id_global, 'username': username, 'password': password, 'time': -1}, f)
         else:
             # 使用保存的用户信息登录
-            await self.websocket.send(self.json_create(1, user_id, username, password, self.now()))
+            await self.websocket.send(self.encode(1, user_id, username, password, self.now()))
 
-        response = await self.websocket.recv()
-        response = json.loads(response)
+        response = parse_frame(await self.websocket.recv(), self.codec)
         if response['message'] == "LOGIN_SUCCESS":
             logger.info("Login successful")
+            # 登录成功后服务端签发会话令牌，断线重连时凭令牌恢复
+            issued = parse_frame(await self.websocket.recv(), self.codec)
+            if issued['flag'] == 16:
+                self.save_token(issued['message']['token'], issued['message']['expires'])
             # 先进行消息同步
             try:
                 await self.refresh_message()
@@ -166,6 +356,8 @@ class WebSocketManager:
                 self.is_connected = True
                 asyncio.create_task(self.receive_messages())
                 asyncio.create_task(self.heart_beat())
+                self.resume_uploads()
+                self.resume_downloads()
             except Exception as e:
                 logger.error(f"同步失败：{e}")
                 return False
@@ -186,49 +378,93 @@ class WebSocketManager:
     async def receive_messages(self):
         try:
             async for message in self.websocket:
-                msg = json.loads(message)
+                msg = parse_frame(message, self.codec)
                 logger.info(f'收到信息：{msg}')
+                if msg['flag'] == 11:
+                    self.ack_message(msg['message'])
+                    continue
+                if self.dispatch_transfer(msg):
+                    continue
+                if msg['flag'] == 5:
+                    # 按会话同步（sync_conversation）的一页结束
+                    await self.ack_sync_page(msg['message'])
+                    continue
+                if msg['flag'] == 7:
+                    logger.info("会话同步完成")
+                    continue
+                if msg['flag'] == 12:
+                    items = [item for item in batch_messages(msg) if not self.is_known_message(item['seq'])]
+                    self.save_batch(items)
+                    for item in items:
+                        self.message_queue.put_nowait(item)
+                    continue
+                if msg['flag'] in (0, 8, 9, 15) and self.is_known_message(msg.get('seq')):
+                    # 按会话同步时可能收到已经保存过的消息
+                    continue
+                if msg['flag'] in (13, 15) and isinstance(msg['message'], dict) \
+                        and msg['message'].get('status') in ('NOT_MEMBER', 'NO_SUCH_USER'):
+                    # 被服务端拒绝的消息不会有回执
+                    if self.unacked:
+                        self.unacked.popleft()
                 msg['timestamp'] = datetime.fromisoformat(msg['timestamp'])
                 self.update_time(self.now())
                 if msg['message'] in ['heartbeat', 'heartbeat_ack']:
                     continue
                 if msg['id'] == 0:
-                    self.message_queue.put_nowait(message)
+                    self.show(msg)
                     continue
                 if msg['flag'] == 6:
                     self.sql.exec(
                         "INSERT INTO messages (sender_id, sender_username, type, message, timestamp) VALUES (?,?,?,?,?)",
                         (msg['id'], msg['name'], msg['flag'], msg['message'], msg['timestamp']))
-                    self.message_queue.put_nowait(message)
+                    self.show(msg)
                 # elif msg['flag'] == 7:
                 #     self.update_time(msg['timestamp'])
                 #     logging.info("[系统] 离线消息同步完成。")
+                elif msg['flag'] == 8 and isinstance(msg['message'], dict):
+                    self.fetch_image(msg)
                 elif msg['flag'] == 8:
                     msg = self.rec_pic_msg(msg)
-                    self.sql.exec(
-                        "INSERT INTO messages (sender_id, sender_username, type, message, timestamp) VALUES (?,?,?,?,?)",
-                        (msg['id'], msg['name'], msg['flag'], msg['message'], msg['timestamp']))
-                    msg['timestamp'] = msg['timestamp'].isoformat()
-                    message = json.dumps(msg)
-                    self.message_queue.put_nowait(message)
+                    self.save_message(msg)
+                    self.show(msg)
                 elif msg['flag'] == 10:
-                    msg = self.rec_pic_msg(msg, msg['name'])
-                    msg['timestamp'] = msg['timestamp'].isoformat()
-                    message = json.dumps(msg)
-                    self.message_queue.put_nowait(message)
-                elif msg['flag'] == 0:
-                    self.sql.exec(
-                        "INSERT INTO messages (sender_id, sender_username, type, message, timestamp) VALUES (?,?,?,?,?)",
-                        (msg['id'], msg['name'], msg['flag'], msg['message'], msg['timestamp']))
-                    self.message_queue.put_nowait(message)
+                    self.show(self.rec_pic_msg(msg, msg['name']))
+                elif msg['flag'] in (0, 9, 15):
+                    self.save_message(msg)
+                    self.show(msg)
                 else:
-                    if msg['flag'] == 8:
-                        msg = self.rec_pic_msg(msg)
-                        message = json.dumps(msg)
-                    self.message_queue.put_nowait(message)
+                    self.show(msg)
         except websockets.ConnectionClosed:
             logger.error("Connection closed.")
             self.is_connected = False
+            for upload in list(self.uploads.values()):
+                upload.interrupt()
+            for download in list(self.downloads.values()):
+                download.interrupt()
+
+    def dispatch_transfer(self, msg) -> bool:
+        """把上传、下载的回复和下载分块交给对应的传输，返回消息是否已处理"""
+        flag = msg['flag']
+        if flag == 17:
+            upload = self.uploads.get(msg['message'].get('upload'))
+            if upload is not None:
+                upload.on_reply(msg['message'])
+        elif flag == 19:
+            request_id = msg['message'].get('req')
+            download = self.download_requests.get(request_id)
+            if download is not None:
+                download.on_reply(request_id, msg['message'])
+        elif flag == 20:
+            payload = msg['message']
+            if not isinstance(payload, bytes):
+                payload = base64.b64decode(payload)
+            request_id, offset, crc, data = download_chunk_parse(payload)
+            download = self.download_requests.get(request_id)
+            if download is not None:
+                download.on_chunk(request_id, offset, crc, data)
+        else:
+            return False
+        return True
 
     @staticmethod
     def rec_pic_msg(msg, name = None):
@@ -244,15 +480,18 @@ class WebSocketManager:
         else:
             save_path = os.path.join(current_dir, 'source', name + ".png")
 
+        # 二进制帧携带原始图片字节，旧的 JSON 帧携带 base64 文本
+        if not isinstance(image_data, bytes):
+            image_data = base64.b64decode(image_data)
         with open(save_path, 'wb') as img_file:
-            img_file.write(base64.b64decode(image_data))
+            img_file.write(image_data)
         msg['message'] = save_path
         return msg
 
     async def heart_beat(self):
         while True:
             await asyncio.sleep(30)
-            msg = self.json_create(4, global_state.user_id, "heartbeat", "heartbeat", self.now())
+            msg = self.encode(4, global_state.user_id, "heartbeat", "heartbeat", self.now())
             await self.websocket.send(msg)
 
     async def connect_ws(self, user_id, username, password):
@@ -261,24 +500,34 @@ class WebSocketManager:
             self.websocket = await websockets.connect(
                 self.url,
                 ssl=self.ssl_context,
-                max_size=MAX_MESSAGE_SIZE
+                max_size=MAX_MESSAGE_SIZE,
+                subprotocols=[COMPACT_SUBPROTOCOL, BINARY_SUBPROTOCOL],
+                # 图片已经是 JPEG，按 compression.py 的策略只压缩较长的文字消息
+                compression=None,
+                extensions=deflate_extensions()
             )
+            self.codec = CompactCodec() if self.websocket.subprotocol == COMPACT_SUBPROTOCOL else None
+            configure_deflate(self.websocket, self.codec is not None)
+            if await self.resume_session(user_id, username, password):
+                return True
             return await self.ws_client(user_id, username, password)
         except Exception as e:
             logger.error(f"WebSocket连接失败: {e}")
             return False
 
-    async def send_message(self, message):
+    async def send_message(self, message, room=DEFAULT_ROOM):
         if not self.is_connected:
             logger.error("未连接到WebSocket服务器")
             return False
         try:
             current_time = datetime.fromisoformat(self.now())
-            msg = self.json_create(0, global_state.user_id, global_state.username, message, current_time)
+            msg = self.encode(0, global_state.user_id, global_state.username, message, current_time, room)
             self.sql.exec(
-                "INSERT INTO messages (sender_id, sender_username, type, message, timestamp) VALUES (?,?,?,?,?)",
-                (global_state.user_id, global_state.username, 0, message, current_time))
+                "INSERT INTO messages (sender_id, sender_username, type, message, timestamp, room) VALUES (?,?,?,?,?,?)",
+                (global_state.user_id, global_state.username, 0, message, current_time, room))
+            local_id = self.sql.cursor.lastrowid
             await self.websocket.send(msg)
+            self.unacked.append(local_id)
             self.update_time(self.now())
             return True
         except Exception as e:
@@ -286,65 +535,320 @@ class WebSocketManager:
             self.is_connected = False
             return False
 
-    def compress_image(self, image_path):
-        """压缩图片"""
-        try:
-            # 打开图片
-            with Image.open(image_path) as img:
-                # 转换为RGB模式（如果是RGBA，去除透明通道）
-                if img.mode in ('RGBA', 'P'):
-                    img = img.convert('RGB')
-
-                # 调整图片大小
-                if img.size[0] > MAX_IMAGE_SIZE[0] or img.size[1] > MAX_IMAGE_SIZE[1]:
-                    img.thumbnail(MAX_IMAGE_SIZE, Image.Resampling.LANCZOS)
-
-                # 保存到内存中
-                output = io.BytesIO()
-                img.save(output, format='JPEG', quality=IMAGE_QUALITY, optimize=True)
-                compressed_data = output.getvalue()
-
-                # 检查压缩后的大小
-                if len(compressed_data) > MAX_MESSAGE_SIZE:
-                    logger.error(f"图片压缩后仍然超过大小限制: {len(compressed_data)} bytes > {MAX_MESSAGE_SIZE} bytes")
-                    return None
-
-                return compressed_data
-        except Exception as e:
-            logger.error(f"压缩图片时出错: {e}")
-            return None
-
-
-
-    async def send_image(self, image_path, flag = 8):
-        if not self.is_connected:
-            logger.error("未连接到WebSocket服务器")
-            return False
+    async def send_image(self, image_path, flag = 8, room=DEFAULT_ROOM, job=None):
+        """
+        在线程池中压缩图片后发送（见 imaging.py），压缩期间界面照常响应；
+        同时拖入的多张图片并行压缩，但按提交的顺序发送，服务端回执仍按顺序对应本地消息。
+        job 为 ImageJob 时通过它报告进度，也可以用它取消
+        """
+        job = job or ImageJob(image_path)
+        turn = asyncio.get_running_loop().create_future()
+        previous, self.image_sends = self.image_sends, turn
         try:
+            if not self.is_connected:
+                logger.error("未连接到WebSocket服务器")
+                job.report(STAGE_FAILED)
+                return False
             if not os.path.exists(image_path):
                 logger.error(f"图片文件不存在: {image_path}")
+                job.report(STAGE_FAILED)
                 return False
 
             # 压缩图片
-            compressed_data = self.compress_image(image_path)
+            compressed_data = await self.image_encoder.encode(job)
             if compressed_data is None:
+                job.report(STAGE_FAILED)
                 return False
-
-            # 转换为base64
-            img_data = base64.b64encode(compressed_data).decode('utf-8')
-
-            msg = self.json_create(flag, global_state.user_id, global_state.username, img_data, self.now())
+            # 等前一张图片发送之后再发送
+            if previous is not None:
+                await previous
+            if job.is_cancelled:
+                raise EncodeCancelled()
+
+            job.report(STAGE_SENDING)
+            if self.codec is None:
+                # 二进制帧和 base64 JSON 帧的编码不依赖连接状态，同样放到线程中
+                msg = await asyncio.to_thread(self.encode_bytes, flag, compressed_data, room)
+            else:
+                # 紧凑协议的驻留表只在事件循环中使用
+                msg = self.encode_bytes(flag, compressed_data, room)
             if flag == 8:
                 self.sql.exec(
-                    "INSERT INTO messages (sender_id, sender_username, type, message, timestamp) VALUES (?,?,?,?,?)",
-                    (global_state.user_id, global_state.username, flag, image_path, datetime.now()))
+                    "INSERT INTO messages (sender_id, sender_username, type, message, timestamp, room) VALUES (?,?,?,?,?,?)",
+                    (global_state.user_id, global_state.username, flag, image_path, datetime.now(), room))
+                local_id = self.sql.cursor.lastrowid
             await self.websocket.send(msg)
+            if flag == 8:
+                self.unacked.append(local_id)
             self.update_time(self.now())
+            job.report(STAGE_SENT)
             return True
+        except EncodeCancelled:
+            logger.info(f"已取消发送图片: {image_path}")
+            job.report(STAGE_CANCELLED)
+            return False
         except Exception as e:
             logger.error(f"发送图片失败: {e}")
+            job.report(STAGE_FAILED)
             self.is_connected = False
             return False
+        finally:
+            turn.set_result(None)
+
+    async def send_file(self, file_path, room=DEFAULT_ROOM):
+        """
+        分块上传文件：在后台线程中流式计算摘要后按窗口发送分块，见 transfer.py；
+        上传信息先记入本地数据库，断线后重新连接时从服务端已写入的位置继续
+        """
+        if not self.is_connected:
+            logger.error("未连接到WebSocket服务器")
+            return False
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) == 0:
+            logger.error(f"文件不存在或为空: {file_path}")
+            return False
+        size = os.path.getsize(file_path)
+        digest = await asyncio.to_thread(file_digest, file_path)
+        upload = Upload(uuid.uuid4().hex, file_path, size, digest, room)
+        info = json.dumps({"name": upload.name, "size": size, "digest": digest, "path": file_path})
+        self.sql.exec(
+            "INSERT INTO messages (sender_id, sender_username, type, message, timestamp, room) VALUES (?,?,?,?,?,?)",
+            (global_state.user_id, global_state.username, 9, info, datetime.now(), room))
+        upload.local_id = self.sql.cursor.lastrowid
+        self.sql.exec("INSERT INTO uploads (upload_id, path, size, digest, room, local_id) VALUES (?,?,?,?,?,?)",
+                      (upload.upload_id, file_path, size, digest, room, upload.local_id))
+        return await self.run_upload(upload)
+
+    async def run_upload(self, upload):
+        """发送 start 后按窗口发送分块，直到上传完成、出错或连接断开"""
+        self.uploads[upload.upload_id] = upload
+        try:
+            await self.websocket.send(self.encode(17, global_state.user_id, global_state.username,
+                                                  upload.start_request(), self.now()))
+            while not upload.finished:
+                while upload.window_open():
+                    offset = upload.sending
+                    data = await asyncio.to_thread(read_chunk, upload.path, offset, upload.chunk_size)
+                    if not data:
+                        # 文件在上传过程中被截短
+                        upload.error = 'FILE_CHANGED'
+                        await self.cancel_upload(upload.upload_id)
+                        break
+                    await self.websocket.send(self.encode_bytes(18, chunk_create(upload.upload_id, offset, data)))
+                    # 发送期间可能收到出错回复，已经退回到出错的位置
+                    if upload.sending == offset:
+                        upload.sending = offset + len(data)
+                if not upload.finished:
+                    await upload.wait()
+        except websockets.ConnectionClosed:
+            upload.interrupt()
+        finally:
+            self.uploads.pop(upload.upload_id, None)
+
+        if upload.interrupted:
+            logger.info(f"上传 {upload.name} 在 {upload.acked}/{upload.size} 字节处中断，重新连接后继续")
+            return False
+        self.sql.exec("DELETE FROM uploads WHERE upload_id = ?", (upload.upload_id,))
+        if upload.error is not None:
+            logger.error(f"上传 {upload.name} 失败: {upload.error}")
+            return False
+        self.sql.exec("UPDATE messages SET server_id = ? WHERE id = ?", (upload.file_id, upload.local_id))
+        logger.info(f"上传 {upload.name} 完成，文件 id {upload.file_id}")
+        return True
+
+    def resume_uploads(self):
+        """登录或恢复会话后，继续上次没有完成的上传"""
+        for row in self.sql.fetch("SELECT upload_id, path, size, digest, room, local_id FROM uploads"):
+            if row['upload_id'] in self.uploads:
+                continue
+            if not os.path.isfile(row['path']) or os.path.getsize(row['path']) != row['size']:
+                logger.error(f"待上传的文件已变化，放弃上传: {row['path']}")
+                self.sql.exec("DELETE FROM uploads WHERE upload_id = ?", (row['upload_id'],))
+                continue
+            asyncio.create_task(self.run_upload(
+                Upload(row['upload_id'], row['path'], row['size'], row['digest'], row['room'], row['local_id'])))
+
+    async def cancel_upload(self, upload_id):
+        """放弃一次上传，服务端删除已上传的部分"""
+        self.sql.exec("DELETE FROM uploads WHERE upload_id = ?", (upload_id,))
+        await self.websocket.send(self.encode(17, global_state.user_id, global_state.username,
+                                              {"op": "cancel", "upload": upload_id}, self.now()))
+
+    def fetch_image(self, msg):
+        """
+        服务端只发送了引用 {"file": id} 的图片：先以下载的目标路径保存消息，在后台按 id 下载，
+        下载完成后再交给界面显示，不阻塞接收循环
+        """
+        file_id = msg['message']['file']
+        received_folder = os.path.join(current_dir, 'received_pics')
+        msg = {**msg, "message": os.path.join(received_folder, f'chat_{global_state.user_id}_{file_id}.jpg')}
+        self.save_message(msg)
+        self.start_download(file_id, msg['message'], msg)
+
+    async def download_file(self, file_id, path, message=None):
+        """
+        按 id 下载服务端保存的文件或图片到 path，返回保存的路径；出错或连接断开时返回 None，
+        断开的下载在重新连接后继续。message 为完成后交给界面显示的消息
+        """
+        return await asyncio.shield(self.start_download(file_id, path, message))
+
+    def start_download(self, file_id, path, message=None):
+        """开始下载并返回下载任务，同一个文件已在下载中时返回已有的任务"""
+        task = self.download_tasks.get(file_id)
+        if task is None:
+            self.sql.exec("INSERT OR IGNORE INTO downloads (file_id, path, message) VALUES (?,?,?)",
+                          (file_id, path, json.dumps(message, default=str) if message is not None else None))
+            task = self.download_tasks[file_id] = asyncio.create_task(
+                self.run_download(Download(file_id, path, message=message)))
+        return task
+
+    async def download_request(self, download, request, rng=None):
+        """发送一个下载请求（flag 19），请求号在本连接上唯一"""
+        request_id = next(self.request_ids)
+        download.requests[request_id] = rng
+        self.download_requests[request_id] = download
+        await self.websocket.send(self.encode(19, global_state.user_id, global_state.username,
+                                              {**request, "req": request_id, "file": download.file_id}, self.now()))
+
+    async def cancel_download_request(self, request_id):
+        """通知服务端停止发送一个范围"""
+        self.download_requests.pop(request_id, None)
+        await self.websocket.send(self.encode(19, global_state.user_id, global_state.username,
+                                              {"op": "cancel", "req": request_id}, self.now()))
+
+    async def run_download(self, download):
+        """
+        查询文件信息后同时请求各个范围，直到下载完成、出错或连接断开；
+        分块由接收循环写入 .part 文件（见 transfer.py），这里只发送请求、取消出错的请求并定时保存进度
+        """
+        self.downloads[download.file_id] = download
+        download.on_release = self.download_slots.release
+        try:
+            if download.size is None:
+                await self.download_request(download, {"op": "stat"})
+                while download.size is None and not download.finished:
+                    await download.wait()
+                if download.size is not None:
+                    self.save_download(download)
+            if download.size is not None and download.error is None and not download.interrupted:
+                os.makedirs(os.path.dirname(download.path), exist_ok=True)
+                download.file = open(download.part_path, 'r+b' if os.path.exists(download.part_path) else 'wb')
+                try:
+                    while not download.finished:
+                        for request_id in download.stale:
+                            await self.cancel_download_request(request_id)
+                        download.stale.clear()
+                        for rng in download.pending_ranges():
+                            # 名额在这个范围的请求结束时归还（见 Download.end_request）
+                            await self.download_slots.acquire()
+                            await self.download_request(download, {"op": "get", "offset": rng[2],
+                                                                   "length": rng[1] - rng[2]}, rng)
+                        try:
+                            await asyncio.wait_for(download.wait(), DOWNLOAD_SAVE_INTERVAL)
+                        except asyncio.TimeoutError:
+                            pass
+                        self.save_download(download)
+                    if download.error is not None:
+                        for request_id in list(download.requests):
+                            await self.cancel_download_request(request_id)
+                finally:
+                    download.file.close()
+                    download.file = None
+        except websockets.ConnectionClosed:
+            download.interrupt()
+        finally:
+            for request_id in list(download.requests):
+                download.end_request(request_id)
+            self.downloads.pop(download.file_id, None)
+            self.download_tasks.pop(download.file_id, None)
+            for request_id in [key for key, value in self.download_requests.items() if value is download]:
+                del self.download_requests[request_id]
+        return await self.finish_download(download)
+
+    async def finish_download(self, download):
+        """校验 sha256 后把 .part 文件移动到目标位置，并显示完成的消息；中断的下载保存进度后返回 None"""
+        if download.interrupted:
+            if download.size is not None:
+                self.save_download(download)
+            logger.info(f"下载 {download.file_id} 在 {download.received}/{download.size} 字节处中断，重新连接后继续")
+            return None
+        self.sql.exec("DELETE FROM downloads WHERE file_id = ?", (download.file_id,))
+        self.sql.exec("DELETE FROM download_ranges WHERE file_id = ?", (download.file_id,))
+        if download.error is None and download.digest \
+                and await asyncio.to_thread(file_digest, download.part_path) != download.digest:
+            download.error = 'DIGEST_MISMATCH'
+        if download.error is not None:
+            logger.error(f"下载 {download.file_id} 失败: {download.error}")
+            if os.path.exists(download.part_path):
+                os.remove(download.part_path)
+            return None
+        os.replace(download.part_path, download.path)
+        logger.info(f"下载 {download.file_id} 完成，{download.size} 字节保存到 {download.path}")
+        if download.message is not None:
+            self.show_download(download.message, download.path)
+        return download.path
+
+    def save_download(self, download):
+        """保存文件信息和各范围已写入的位置"""
+        self.sql.exec("UPDATE downloads SET size = ?, digest = ? WHERE file_id = ?",
+                      (download.size, download.digest, download.file_id))
+        self.sql.exec_many("INSERT OR REPLACE INTO download_ranges (file_id, start, end, written) VALUES (?,?,?,?)",
+                           [(download.file_id, *rng) for rng in download.ranges])
+
+    def show_download(self, msg, path):
+        """下载完成：图片消息已保存为目标路径，文件消息在文件信息中记下本地路径，之后交给界面显示"""
+        msg = dict(msg)
+        if msg['flag'] == 9:
+            info = file_info(msg['message']) or {}
+            msg['message'] = json.dumps({**info, "path": path})
+            if msg.get('seq') is not None:
+                self.sql.exec("UPDATE messages SET message = ? WHERE server_id = ?", (msg['message'], msg['seq']))
+        self.show(msg)
+
+    def resume_downloads(self):
+        """登录或恢复会话后，继续上次没有完成的下载"""
+        for row in self.sql.fetch("SELECT file_id, path, size, digest, message FROM downloads"):
+            if row['file_id'] in self.download_tasks:
+                continue
+            ranges = [[r['start'], r['end'], r['written']] for r in self.sql.fetch(
+                "SELECT start, end, written FROM download_ranges WHERE file_id = ? ORDER BY start", (row['file_id'],))]
+            if not os.path.exists(row['path'] + '.part'):
+                # 已写入的部分不在了，各范围从头开始
+                ranges = [[start, end, start] for start, end, _ in ranges]
+            # 没有记录范围时重新查询文件信息
+            size = row['size'] if ranges else None
+            message = json.loads(row['message']) if row['message'] else None
+            download = Download(row['file_id'], row['path'], size, row['digest'], ranges, message)
+            self.download_tasks[row['file_id']] = asyncio.create_task(self.run_download(download))
+
+    async def send_direct(self, peer_id, message):
+        """发送私聊消息给 peer_id，对方不存在时服务端以 flag 15 回复 NO_SUCH_USER"""
+        if not self.is_connected:
+            logger.error("未连接到WebSocket服务器")
+            return False
+        try:
+            current_time = datetime.fromisoformat(self.now())
+            msg = self.encode(15, global_state.user_id, global_state.username, message, current_time,
+                              extra={"to": peer_id})
+            low, high = sorted((global_state.user_id, peer_id))
+            self.sql.exec(
+                "INSERT INTO messages (sender_id, sender_username, type, message, timestamp, room) VALUES (?,?,?,?,?,?)",
+                (global_state.user_id, global_state.username, 15, message, current_time, f'dm:{low}:{high}'))
+            local_id = self.sql.cursor.lastrowid
+            await self.websocket.send(msg)
+            self.unacked.append(local_id)
+            return True
+        except Exception as e:
+            logger.error(f"发送私聊消息失败: {e}")
+            self.is_connected = False
+            return False
+
+    async def join_room(self, room):
+        """加入房间，服务端以 flag 13 回复 JOINED 或 JOIN_FAIL；之后会收到并同步该房间的消息"""
+        await self.websocket.send(self.encode(13, global_state.user_id, global_state.username, room, self.now()))
+
+    async def leave_room(self, room):
+        """离开房间，服务端以 flag 14 回复 LEFT 或 LEAVE_FAIL；默认房间不能离开"""
+        await self.websocket.send(self.encode(14, global_state.user_id, global_state.username, room, self.now()))
 
     async def disconnect(self):
         if self.websocket and self.websocket.open:
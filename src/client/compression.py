@@ -0,0 +1,77 @@
+"""
+客户端的 permessage-deflate 压缩策略，与服务端 compression.py 相同：
+图片和头像（flag 8/10）已经是 JPEG，不再压缩；小于 DEFLATE_MIN_SIZE 字节的消息也不压缩
+"""
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ClientPerMessageDeflateFactory
+from websockets.frames import CTRL_OPCODES, OP_CONT, OP_TEXT
+
+# 压缩滑动窗口位数，与服务端的默认值相同
+DEFLATE_WINDOW_BITS = 12
+DEFLATE_MEM_LEVEL = 5
+# 小于该字节数的消息不压缩
+DEFLATE_MIN_SIZE = 256
+# 不压缩的消息：图片、头像
+DEFLATE_SKIP_FLAGS = frozenset((8, 10))
+
+JSON_FLAG_PREFIX = b'{"flag": '
+
+
+def frame_flag(data, text, compact):
+    """从一条消息的开头取出 flag；compact 为 True 时二进制帧为紧凑帧，否则为 v3 帧"""
+    if text:
+        if data.startswith(JSON_FLAG_PREFIX):
+            end = data.find(b',', len(JSON_FLAG_PREFIX), len(JSON_FLAG_PREFIX) + 4)
+            if end > 0 and data[len(JSON_FLAG_PREFIX):end].isdigit():
+                return int(data[len(JSON_FLAG_PREFIX):end])
+        return None
+    if compact:
+        return data[0] if data else None
+    return data[1] if len(data) > 1 else None
+
+
+class PolicyDeflate(PerMessageDeflate):
+    """逐条消息决定是否压缩的 permessage-deflate 扩展"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 握手完成后由 configure_deflate 设置
+        self.compact = False
+        self.skip_message = False
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        if frame.opcode is not OP_CONT:
+            flag = frame_flag(frame.data, frame.opcode is OP_TEXT, self.compact)
+            self.skip_message = len(frame.data) < DEFLATE_MIN_SIZE or flag in DEFLATE_SKIP_FLAGS
+        if self.skip_message:
+            return frame
+        return super().encode(frame)
+
+
+class PolicyDeflateFactory(ClientPerMessageDeflateFactory):
+    def process_response_params(self, params, accepted_extensions):
+        extension = super().process_response_params(params, accepted_extensions)
+        return PolicyDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+        )
+
+
+def deflate_extensions(window_bits=DEFLATE_WINDOW_BITS, mem_level=DEFLATE_MEM_LEVEL) -> list:
+    """websockets.connect 的 extensions 参数"""
+    return [PolicyDeflateFactory(
+        server_max_window_bits=window_bits,
+        client_max_window_bits=True,
+        compress_settings={"memLevel": mem_level},
+    )]
+
+
+def configure_deflate(websocket, compact):
+    """握手完成后告诉压缩扩展二进制帧的格式"""
+    for extension in websocket.protocol.extensions:
+        if isinstance(extension, PolicyDeflate):
+            extension.compact = compact
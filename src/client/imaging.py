@@ -0,0 +1,148 @@
+"""
+客户端图片压缩：打开、缩放、JPEG 编码都在线程池中进行，不阻塞 Qt/asyncio 事件循环
+Pillow 在解码、LANCZOS 缩放和 JPEG 编码时释放 GIL，同时拖入的多张图片在多核上并行压缩；
+线程与界面共享进程，不需要像进程池那样在子进程中重新导入界面模块，也不需要复制解码后的图片。
+进度按阶段报告（排队、解码、缩放、编码），取消在阶段之间生效，还在排队的任务直接取消。
+"""
+import asyncio
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# 图片压缩质量（1-100）
+IMAGE_QUALITY = 85
+# 最大图片尺寸
+MAX_IMAGE_SIZE = (1920, 1080)
+# 压缩后的最大字节数，与消息大小限制（10MB）一致
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+# 同时压缩的图片数
+ENCODE_WORKERS = min(4, os.cpu_count() or 1)
+
+# 进度阶段
+STAGE_QUEUED = 'queued'
+STAGE_DECODE = 'decode'
+STAGE_RESIZE = 'resize'
+STAGE_ENCODE = 'encode'
+STAGE_SENDING = 'sending'
+STAGE_SENT = 'sent'
+STAGE_CANCELLED = 'cancelled'
+STAGE_FAILED = 'failed'
+
+# 可以取消的阶段：开始发送后帧已经放入连接，不能再取消
+CANCELLABLE_STAGES = (STAGE_QUEUED, STAGE_DECODE, STAGE_RESIZE, STAGE_ENCODE)
+
+# 各阶段开始时的大致进度，JPEG 编码（optimize=True）占大部分时间
+STAGE_PROGRESS = {STAGE_QUEUED: 0.0, STAGE_DECODE: 0.05, STAGE_RESIZE: 0.35, STAGE_ENCODE: 0.5,
+                  STAGE_SENDING: 0.9, STAGE_SENT: 1.0}
+
+
+class EncodeCancelled(Exception):
+    """压缩在阶段之间发现任务已取消"""
+
+
+def compress_image(image_path, report=None, cancelled=None):
+    """
+    压缩图片（在工作线程中执行，不要访问界面和连接的状态）
+    report(stage) 在每个阶段开始时调用，cancelled 为 threading.Event，已设置时抛出 EncodeCancelled
+    """
+    def stage(name):
+        if cancelled is not None and cancelled.is_set():
+            raise EncodeCancelled()
+        if report is not None:
+            report(name)
+
+    try:
+        stage(STAGE_DECODE)
+        with Image.open(image_path) as img:
+            # 转换为RGB模式（如果是RGBA，去除透明通道）
+            if img.mode in ('RGBA', 'P'):
+                img = img.convert('RGB')
+
+            # 调整图片大小（JPEG 在解码时按比例缩小，thumbnail 内部使用 draft）
+            stage(STAGE_RESIZE)
+            if img.size[0] > MAX_IMAGE_SIZE[0] or img.size[1] > MAX_IMAGE_SIZE[1]:
+                img.thumbnail(MAX_IMAGE_SIZE, Image.Resampling.LANCZOS)
+
+            # 保存到内存中
+            stage(STAGE_ENCODE)
+            output = io.BytesIO()
+            img.save(output, format='JPEG', quality=IMAGE_QUALITY, optimize=True)
+            compressed_data = output.getvalue()
+
+            # 检查压缩后的大小
+            if len(compressed_data) > MAX_IMAGE_BYTES:
+                logger.error(f"图片压缩后仍然超过大小限制: {len(compressed_data)} bytes > {MAX_IMAGE_BYTES} bytes")
+                return None
+
+            return compressed_data
+    except EncodeCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"压缩图片时出错: {e}")
+        return None
+
+
+class ImageJob:
+    """一张图片的压缩和发送任务，on_progress(stage, fraction) 在事件循环线程中调用"""
+
+    def __init__(self, path, on_progress=None):
+        self.path = path
+        self.on_progress = on_progress
+        self.cancelled = threading.Event()
+        self.future = None
+        self.stage = STAGE_QUEUED
+
+    def report(self, stage):
+        if self.is_cancelled and stage not in (STAGE_CANCELLED, STAGE_SENT):
+            # 工作线程在取消前排入的进度
+            return
+        self.stage = stage
+        if self.on_progress is not None:
+            self.on_progress(stage, STAGE_PROGRESS.get(stage))
+
+    def cancel(self) -> bool:
+        """取消压缩和发送，返回是否已取消；开始发送之后不能再取消"""
+        if self.stage not in CANCELLABLE_STAGES:
+            return False
+        self.cancelled.set()
+        if self.future is not None:
+            # 还在排队的任务不会再执行
+            self.future.cancel()
+        return True
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self.cancelled.is_set()
+
+
+class ImageEncoder:
+    """图片压缩线程池，排队的任务按提交顺序开始，最多 ENCODE_WORKERS 张同时压缩"""
+
+    def __init__(self, workers=ENCODE_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='image')
+
+    async def encode(self, job):
+        """压缩一张图片，返回 JPEG 字节；失败时返回 None，取消时抛出 EncodeCancelled"""
+        loop = asyncio.get_running_loop()
+
+        def report(stage):
+            loop.call_soon_threadsafe(job.report, stage)
+
+        job.report(STAGE_QUEUED)
+        job.future = loop.run_in_executor(self.executor, compress_image, job.path, report, job.cancelled)
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            if job.is_cancelled:
+                raise EncodeCancelled()
+            raise
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
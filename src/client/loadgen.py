@@ -0,0 +1,345 @@
+"""
+无界面压测客户端：模拟大量聊天用户连接本地 serve.py，按场景比例发送消息，统计吞吐量和端到端投递延迟
+
+协议与 WebsocketMG 相同：注册 flag 2、登录 flag 1、文字 flag 0、图片 flag 8（二进制帧）、同步 flag 5/6、心跳 flag 4。
+第一次运行时批量注册用户并保存到用户文件，之后重复使用。连接按 --ramp 的速度逐步建立，
+全部建立后所有用户同时开始按 --rate 的频率随机执行场景中的动作，持续 --duration 秒。
+用户平均分布在 --rooms 个房间中，每条文字消息只投递给同一房间的用户；
+文字消息内容中带有发送时间，接收方据此计算端到端延迟（压测进程与服务器需在同一台机器上）。
+
+用法：python loadgen.py --clients 2000 --duration 60 --mix text=80,image=2,sync=8,heartbeat=10
+"""
+import argparse
+import asyncio
+import collections
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import ssl
+import time
+
+import websockets
+from PIL import Image
+
+from WebsocketMG import WebSocketManager
+from protocol import binary_create, parse_frame, batch_messages, BINARY_SUBPROTOCOL
+from compression import deflate_extensions, configure_deflate
+
+URL = 'wss://localhost:9998'
+
+# 默认场景：各动作的权重
+DEFAULT_MIX = 'text=80,image=2,sync=8,heartbeat=10'
+ACTIONS = ('text', 'image', 'sync', 'heartbeat')
+
+# 保存已注册压测用户的文件
+USERS_FILE = 'loadgen_users.json'
+USER_PASSWORD = 'loadgen'
+
+# 批量注册时并行使用的连接数
+PROVISION_CONNECTIONS = 8
+
+# 每个进程最多保留的延迟样本数，超出后按蓄水池抽样
+MAX_SAMPLES = 100000
+
+# 停止发送后等待在途消息送达的时间（秒）
+DRAIN_SECONDS = 3
+
+# 文字消息的前缀，后面是发送时的纳秒时间戳
+TEXT_TAG = 'load:'
+
+json_create = WebSocketManager.json_create
+now = WebSocketManager.now
+
+
+def client_ssl_context():
+    """测试使用自签名证书，不校验"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def parse_mix(text) -> dict:
+    mix = {}
+    for part in text.split(','):
+        action, _, weight = part.partition('=')
+        if action not in ACTIONS:
+            raise argparse.ArgumentTypeError(f'未知动作：{action}')
+        mix[action] = float(weight)
+    return mix
+
+
+def test_image(size) -> bytes:
+    """生成一张随机内容的 JPEG，所有图片消息共用"""
+    image = Image.frombytes('RGB', (size, size), os.urandom(size * size * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class Reservoir:
+    """蓄水池抽样，样本数不超过 size"""
+
+    def __init__(self, size=MAX_SAMPLES):
+        self.size = size
+        self.samples = []
+        self.count = 0
+
+    def add(self, value):
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            index = random.randrange(self.count)
+            if index < self.size:
+                self.samples[index] = value
+
+
+class Stats:
+    """一个压测进程的统计"""
+
+    def __init__(self):
+        self.sent = collections.Counter()
+        self.received = collections.Counter()
+        self.latency = Reservoir()
+        self.sync_time = Reservoir()
+        self.connected = 0
+        self.errors = 0
+
+    def result(self) -> dict:
+        return {
+            "sent": dict(self.sent),
+            "received": dict(self.received),
+            "latency": self.latency.samples,
+            "sync_time": self.sync_time.samples,
+            "connected": self.connected,
+            "errors": self.errors
+        }
+
+
+async def provision(url, count, users_file):
+    """批量注册压测用户，已保存的用户直接复用"""
+    users = []
+    if os.path.exists(users_file):
+        with open(users_file, encoding='utf-8') as f:
+            users = json.load(f)
+    if len(users) >= count:
+        return users[:count]
+    prefix = f'load{os.getpid()}_'
+    names = [f'{prefix}{index}' for index in range(count - len(users))]
+
+    async def register(chunk):
+        async with websockets.connect(url, ssl=client_ssl_context(), max_size=None,
+                                      subprotocols=[BINARY_SUBPROTOCOL]) as websocket:
+            for name in chunk:
+                await websocket.send(json_create(2, None, name, USER_PASSWORD, now()))
+                while True:
+                    msg = parse_frame(await websocket.recv())
+                    if msg.get('flag') == 2:
+                        break
+                if msg['message'] == 'REGISTERED':
+                    users.append({"id": msg['id'], "name": name})
+
+    print(f'注册 {len(names)} 个压测用户...')
+    await asyncio.gather(*(register(names[index::PROVISION_CONNECTIONS]) for index in range(PROVISION_CONNECTIONS)))
+    with open(users_file, 'w', encoding='utf-8') as f:
+        json.dump(users, f)
+    return users[:count]
+
+
+class LoadClient:
+    """一个模拟用户：登录、加入房间，之后按场景随机发送，后台任务统计收到的消息"""
+
+    def __init__(self, user, room, stats, image):
+        self.user_id = user['id']
+        self.name = user['name']
+        self.room = room
+        self.stats = stats
+        self.image = image
+        self.websocket = None
+        self.reader = None
+        # 收到过的最大消息序号，同步时作为游标
+        self.last_seq = 0
+        # 正在进行的同步的开始时间
+        self.sync_started = None
+
+    async def connect(self, url):
+        self.websocket = await websockets.connect(url, ssl=client_ssl_context(), max_size=None,
+                                                  subprotocols=[BINARY_SUBPROTOCOL],
+                                                  compression=None, extensions=deflate_extensions())
+        configure_deflate(self.websocket, False)
+        await self.websocket.send(json_create(1, self.user_id, self.name, USER_PASSWORD, now()))
+        while True:
+            msg = parse_frame(await self.websocket.recv())
+            if msg.get('flag') == 1:
+                break
+        if msg['message'] != 'LOGIN_SUCCESS':
+            raise ConnectionError(f'用户 {self.user_id} 登录失败')
+        await self.websocket.send(json_create(13, self.user_id, self.name, self.room, now()))
+        self.reader = asyncio.create_task(self.receive())
+
+    def seen(self, seq):
+        if seq and seq > self.last_seq:
+            self.last_seq = seq
+
+    async def receive(self):
+        try:
+            async for raw in self.websocket:
+                msg = parse_frame(raw)
+                flag = msg.get('flag')
+                if flag == 0 and msg.get('id'):
+                    self.stats.received['text'] += 1
+                    self.seen(msg.get('seq'))
+                    text = msg['message']
+                    if isinstance(text, str) and text.startswith(TEXT_TAG):
+                        self.stats.latency.add((time.time_ns() - int(text[len(TEXT_TAG):])) / 1e6)
+                elif flag == 8:
+                    self.stats.received['image'] += 1
+                    self.seen(msg.get('seq'))
+                elif flag == 12:
+                    items = batch_messages(msg)
+                    self.stats.received['synced'] += len(items)
+                elif flag == 5:
+                    # 一页同步消息发送完毕，确认后服务端发送下一页
+                    self.seen(msg['message'])
+                    await self.websocket.send(json_create(6, self.user_id, self.name, msg['message'], now()))
+                elif flag == 7 and self.sync_started is not None:
+                    self.stats.sync_time.add((time.perf_counter() - self.sync_started) * 1000)
+                    self.sync_started = None
+        except websockets.ConnectionClosed:
+            pass
+
+    async def act(self, action):
+        if action == 'text':
+            frame = json_create(0, self.user_id, self.name, f'{TEXT_TAG}{time.time_ns()}', now(), self.room)
+        elif action == 'image':
+            frame = binary_create(8, self.user_id, self.name, self.image, now(), room=self.room)
+        elif action == 'sync':
+            if self.sync_started is not None:
+                return
+            self.sync_started = time.perf_counter()
+            frame = json_create(5, self.user_id, self.name, {"cursor": self.last_seq}, now())
+        else:
+            frame = json_create(4, self.user_id, self.name, 'heartbeat', now())
+        await self.websocket.send(frame)
+        self.stats.sent[action] += 1
+
+    async def run(self, rate, mix, deadline):
+        actions, weights = list(mix), list(mix.values())
+        try:
+            while True:
+                await asyncio.sleep(random.expovariate(rate))
+                if time.monotonic() >= deadline:
+                    return
+                await self.act(random.choices(actions, weights)[0])
+        except websockets.ConnectionClosed:
+            self.stats.errors += 1
+
+    async def close(self):
+        await self.websocket.close()
+        if self.reader is not None:
+            await self.reader
+
+
+async def load(index, users, args, barrier):
+    stats = Stats()
+    image = test_image(args.image_size)
+    clients = []
+
+    async def start(position, user):
+        # 全局第 n 个连接在 n / ramp 秒时建立
+        await asyncio.sleep((position * args.processes + index) / args.ramp)
+        client = LoadClient(user, f'load-{(position * args.processes + index) % args.rooms}', stats, image)
+        try:
+            await client.connect(args.url)
+            clients.append(client)
+            stats.connected += 1
+        except (OSError, ConnectionError, websockets.WebSocketException) as e:
+            logging.warning(f'连接失败：{e}')
+            stats.errors += 1
+
+    await asyncio.gather(*(start(position, user) for position, user in enumerate(users)))
+    # 等待所有压测进程都建立完连接后同时开始
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*(client.run(args.rate, args.mix, deadline) for client in clients))
+    await asyncio.sleep(DRAIN_SECONDS)
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+    return stats.result()
+
+
+def load_process(index, users, args, barrier, results):
+    logging.getLogger().setLevel(logging.WARNING)
+    results.put(asyncio.run(load(index, users, args, barrier)))
+
+
+def report(outcomes, args):
+    sent = collections.Counter()
+    received = collections.Counter()
+    latency = []
+    sync_time = []
+    for outcome in outcomes:
+        sent.update(outcome['sent'])
+        received.update(outcome['received'])
+        latency.extend(outcome['latency'])
+        sync_time.extend(outcome['sync_time'])
+    latency.sort()
+    sync_time.sort()
+    connected = sum(outcome['connected'] for outcome in outcomes)
+    errors = sum(outcome['errors'] for outcome in outcomes)
+
+    print(f'连接：{connected}/{args.clients}，错误 {errors}，持续 {args.duration} 秒')
+    print('发送：' + '，'.join(f'{action} {sent[action]} ({sent[action] / args.duration:.0f}/s)'
+                            for action in ACTIONS))
+    print('收到：' + '，'.join(f'{kind} {received[kind]} ({received[kind] / args.duration:.0f}/s)'
+                            for kind in ('text', 'image', 'synced')))
+    for title, samples in (('投递延迟', latency), ('同步耗时', sync_time)):
+        print(f'{title}(ms)：p50 {percentile(samples, 0.5):.1f}  p95 {percentile(samples, 0.95):.1f}  '
+              f'p99 {percentile(samples, 0.99):.1f}  max {samples[-1] if samples else 0:.1f}  样本 {len(samples)}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='聊天服务器压测客户端')
+    parser.add_argument('--url', default=URL)
+    parser.add_argument('--clients', type=int, default=1000, help='模拟的用户数')
+    parser.add_argument('--processes', type=int, default=min(os.cpu_count() or 1, 8), help='压测进程数')
+    parser.add_argument('--ramp', type=float, default=200, help='每秒建立的连接数')
+    parser.add_argument('--duration', type=float, default=60, help='所有连接建立后持续发送的时间（秒）')
+    parser.add_argument('--rate', type=float, default=0.5, help='每个用户每秒执行的动作数')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'各动作的权重，默认 {DEFAULT_MIX}')
+    parser.add_argument('--rooms', type=int, default=50, help='用户分布的房间数')
+    parser.add_argument('--image-size', type=int, default=256, help='图片消息的边长（像素）')
+    parser.add_argument('--users-file', default=USERS_FILE)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    users = asyncio.run(provision(args.url, args.clients, args.users_file))
+    args.processes = min(args.processes, len(users))
+    barrier = multiprocessing.Barrier(args.processes)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=load_process,
+                                         args=(index, users[index::args.processes], args, barrier, results))
+                 for index in range(args.processes)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    report(outcomes, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -69,7 +69,9 @@ class SqlMG():
                 sender_username TEXT,
                 type INTEGER,
                 message TEXT,
-                timestamp DATETIME
+                timestamp DATETIME,
+                server_id INTEGER,
+                room TEXT NOT NULL DEFAULT 'lobby'
             );
             ''')
             self.cursor.execute('''
@@ -78,6 +80,45 @@ class SqlMG():
                     route TEXT             
             );
             ''')
+            # 没有完成的文件上传，重新连接后从服务端确认的位置继续
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS uploads (
+                upload_id TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                room TEXT NOT NULL,
+                local_id INTEGER        -- 对应的本地消息行号
+            );
+            ''')
+            # 没有完成的下载，各范围的进度记录在 download_ranges 中，重新连接后从已写入的位置继续
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS downloads (
+                file_id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL,
+                size INTEGER,           -- 查询到文件信息之前为空
+                digest TEXT,
+                message TEXT            -- 完成后显示的消息（JSON）
+            );
+            ''')
+            self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS download_ranges (
+                file_id INTEGER NOT NULL,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                written INTEGER NOT NULL,
+                PRIMARY KEY (file_id, start)
+            );
+            ''')
+            # 旧数据库没有 server_id 列时补上，服务端分配的消息序号用于同步去重
+            columns = [row['name'] for row in self.cursor.execute('PRAGMA table_info(messages)')]
+            if 'server_id' not in columns:
+                self.cursor.execute('ALTER TABLE messages ADD COLUMN server_id INTEGER')
+            if 'room' not in columns:
+                self.cursor.execute("ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT 'lobby'")
+            self.cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_server_id ON messages (server_id);
+            ''')
             self.conn.commit()
             logger.info('sql for client init successfully.')
         except sqlite3.Error as e:
@@ -96,6 +137,16 @@ class SqlMG():
         except sqlite3.Error as e:
             logger.error(f'{sql} with {params} run failed: {e}')
 
+    def exec_many(self, sql, params_list):
+        """在一个事务中批量执行同一条sql"""
+        try:
+            self.cursor.executemany(sql, params_list)
+            self.conn.commit()
+            logger.info(f'{sql} with {len(params_list)} rows run successfully.')
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            logger.error(f'{sql} with {len(params_list)} rows run failed: {e}')
+
     def fetch(self, sql, params=None):
         """执行sql的查询功能"""
         try:
@@ -0,0 +1,230 @@
+"""
+分块文件传输的客户端部分
+
+上传：先发送 start（flag 17），服务端回复从哪个字节继续以及分块大小，之后按顺序发送分块（flag 18），
+同时在途的分块不超过 UPLOAD_WINDOW 个，收到确认后再读取、发送下一个分块，任何时候只有窗口内的分块在内存中。
+分块校验失败或偏移不连续时服务端回复出错和应当继续的位置，从那里重新发送；
+断线后上传信息保存在本地数据库中，重新连接后再次发送 start，从服务端已写入的位置继续。
+
+下载：先以 stat（flag 19）查询文件大小和摘要，把文件分为最多 DOWNLOAD_STREAMS 个范围同时请求，
+服务端按分块（flag 20）从磁盘读取发送，各范围的分块交替到达，按偏移写入 .part 文件。
+分块校验失败或偏移不连续时取消这个范围，从已写入的位置重新请求；断线后各范围的进度保存在本地数据库中，
+重新连接后从已写入的位置继续。全部完成后校验 sha256 再移动到目标位置。
+"""
+import asyncio
+import hashlib
+import json
+import os
+import zlib
+
+# 同时在途（已发送、未确认）的分块数
+UPLOAD_WINDOW = 4
+
+# 计算摘要时每次读取的字节数
+READ_BLOCK = 1024 * 1024
+
+# 从出错位置重新发送即可恢复的错误，其余错误放弃这次上传
+RETRY_REASONS = ('CHECKSUM', 'OFFSET', 'BAD_CHUNK')
+
+# 一个文件同时请求的范围数
+DOWNLOAD_STREAMS = 4
+
+# 一个连接上同时请求的范围数，不超过服务端的 DOWNLOAD_MAX_STREAMS，超过时服务端回复 BUSY
+DOWNLOAD_MAX_STREAMS = 8
+
+# 小于这个大小的范围不再拆分
+DOWNLOAD_MIN_RANGE = 1024 * 1024
+
+
+def file_digest(path) -> str:
+    """流式计算文件的 sha256，不把整个文件读入内存"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(READ_BLOCK):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def read_chunk(path, offset, size) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+def file_info(message):
+    """flag 9 消息的文件信息：{"file", "name", "size", "digest"}，本地发送的文件还有 "path"；无法解析时返回 None"""
+    if isinstance(message, dict):
+        return message
+    try:
+        info = json.loads(message)
+    except (TypeError, ValueError):
+        return None
+    return info if isinstance(info, dict) else None
+
+
+class Upload:
+    """一次上传的状态，由收到的 flag 17 回复推进"""
+
+    def __init__(self, upload_id, path, size, digest, room, local_id=None):
+        self.upload_id = upload_id
+        self.path = path
+        self.name = os.path.basename(path)
+        self.size = size
+        self.digest = digest
+        self.room = room
+        self.local_id = local_id
+        self.chunk_size = None
+        # 服务端已确认写入的位置，和下一个要发送的分块的位置
+        self.acked = 0
+        self.sending = 0
+        # 完成时为文件 id（消息序号），放弃时为出错原因
+        self.file_id = None
+        self.error = None
+        self.interrupted = False
+        self.changed = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.file_id is not None or self.error is not None or self.interrupted
+
+    def start_request(self) -> dict:
+        return {"op": "start", "upload": self.upload_id, "name": self.name, "size": self.size,
+                "digest": self.digest, "room": self.room}
+
+    def window_open(self) -> bool:
+        """可以继续发送分块：服务端已回复开始，还有未发送的部分，且在途的分块没有占满窗口"""
+        return (self.chunk_size is not None and self.sending < self.size
+                and self.sending - self.acked < UPLOAD_WINDOW * self.chunk_size)
+
+    def on_reply(self, reply):
+        op = reply.get('op')
+        if op == 'offset':
+            self.chunk_size = reply['chunk_size']
+            self.acked = self.sending = reply['offset']
+        elif op == 'ack':
+            self.acked = max(self.acked, reply['offset'])
+        elif op == 'error' and reply.get('reason') in RETRY_REASONS and reply.get('offset') is not None:
+            # 从服务端期望的位置重新发送，之后在途的分块会被服务端丢弃
+            self.acked = self.sending = reply['offset']
+        elif op == 'error':
+            self.error = reply.get('reason') or 'ERROR'
+        elif op == 'done':
+            self.file_id = reply['file']
+            self.acked = self.size
+        elif op == 'cancelled':
+            self.error = 'CANCELLED'
+        self.changed.set()
+
+    def interrupt(self):
+        """连接断开：停止发送，重新连接后再继续"""
+        self.interrupted = True
+        self.changed.set()
+
+    async def wait(self):
+        await self.changed.wait()
+        self.changed.clear()
+
+
+class Download:
+    """一次下载的状态，由收到的 flag 19 回复和 flag 20 分块推进"""
+
+    def __init__(self, file_id, path, size=None, digest=None, ranges=None, message=None):
+        self.file_id = file_id
+        self.path = path
+        self.size = size
+        self.digest = digest
+        # 各范围 [起点, 终点, 已写入到的位置]
+        self.ranges = ranges or []
+        # 完成后交给界面显示的消息
+        self.message = message
+        # 进行中的请求 {请求号: 范围}，stat 请求的范围为 None
+        self.requests = {}
+        # 出错后需要通知服务端停止发送的请求号
+        self.stale = []
+        # 写入中的 .part 文件
+        self.file = None
+        # 范围请求结束时调用，归还连接上的并发名额
+        self.on_release = None
+        self.error = None
+        self.interrupted = False
+        self.changed = asyncio.Event()
+
+    @property
+    def part_path(self) -> str:
+        return self.path + '.part'
+
+    @property
+    def complete(self) -> bool:
+        return self.size is not None and all(end <= written for _, end, written in self.ranges)
+
+    @property
+    def finished(self) -> bool:
+        return self.complete or self.error is not None or self.interrupted
+
+    @property
+    def received(self) -> int:
+        return sum(written - start for start, _, written in self.ranges)
+
+    def on_info(self, info):
+        """收到 stat 的回复：记录大小和摘要，把文件分为若干范围"""
+        self.size = info['size']
+        self.digest = info.get('digest')
+        parts = max(1, min(DOWNLOAD_STREAMS, self.size // DOWNLOAD_MIN_RANGE))
+        step = -(-self.size // parts) if self.size else 0
+        self.ranges = [[start, min(start + step, self.size), start] for start in range(0, self.size, step or 1)]
+
+    def pending_ranges(self) -> list:
+        """还没有完成、也没有在请求中的范围"""
+        active = {id(rng) for rng in self.requests.values() if rng is not None}
+        return [rng for rng in self.ranges if rng[2] < rng[1] and id(rng) not in active]
+
+    def end_request(self, request_id):
+        """请求结束（收完、被拒绝或被放弃）"""
+        rng = self.requests.pop(request_id, None)
+        if rng is not None and self.on_release is not None:
+            self.on_release()
+
+    def on_reply(self, request_id, reply):
+        if request_id not in self.requests:
+            # 已经放弃的请求
+            return
+        op = reply.get('op')
+        if op == 'info':
+            self.end_request(request_id)
+            self.on_info(reply)
+        elif op == 'end':
+            # 范围没有收完（如中途有分块被丢弃）时，这个范围会重新请求剩下的部分
+            self.end_request(request_id)
+        elif op == 'error' and reply.get('reason') == 'BUSY':
+            self.end_request(request_id)
+        elif op == 'error':
+            self.error = reply.get('reason') or 'ERROR'
+        self.changed.set()
+
+    def on_chunk(self, request_id, offset, crc, data):
+        """
+        写入一个分块。分块直接在接收循环中写入 .part 文件，只写入页缓存，一次最多一个分块；
+        偏移不连续或校验失败时放弃这个请求，之后由下载任务取消它并从已写入的位置重新请求
+        """
+        rng = self.requests.get(request_id)
+        if rng is None:
+            return
+        if offset != rng[2] or offset + len(data) > rng[1] or zlib.crc32(data) != crc:
+            self.end_request(request_id)
+            self.stale.append(request_id)
+            self.changed.set()
+            return
+        self.file.seek(offset)
+        self.file.write(data)
+        rng[2] += len(data)
+        if rng[2] == rng[1]:
+            self.changed.set()
+
+    def interrupt(self):
+        """连接断开：停止下载，重新连接后再继续"""
+        self.interrupted = True
+        self.changed.set()
+
+    async def wait(self):
+        await self.changed.wait()
+        self.changed.clear()
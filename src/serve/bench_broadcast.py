@@ -0,0 +1,65 @@
+"""
+广播性能测试：比较逐个接收者编码与只编码一次两种广播方式的单个接收者 CPU 开销
+
+用法：python bench_broadcast.py
+"""
+import time
+
+from protocol import json_create, now
+from session import ClientSession
+
+# 模拟的连接数量
+CLIENT_COUNTS = (100, 1000, 10000)
+
+# 每种规模重复广播的次数
+ROUNDS = 20
+
+MESSAGE = "这是一条用于测试广播性能的聊天消息" * 4
+
+
+class FakeSocket:
+    """只用于填充会话的假连接，不会真正发送"""
+
+    async def send(self, frame):
+        pass
+
+
+def make_sessions(count):
+    return {user_id: ClientSession(user_id, FakeSocket(), max_queue=ROUNDS + 1) for user_id in range(1, count + 1)}
+
+
+def broadcast_per_recipient(sessions, message):
+    """旧的广播方式：每个接收者各自生成时间戳并编码一次"""
+    for user_id, session in sessions.items():
+        session.enqueue(json_create(0, 0, 'bench', message, now()))
+
+
+def broadcast_encode_once(sessions, message):
+    """新的广播方式：只编码一次，所有接收者共享同一帧"""
+    frame = json_create(0, 0, 'bench', message, now())
+    for user_id, session in sessions.items():
+        session.enqueue(frame)
+
+
+def measure(func, sessions):
+    """返回每个接收者的平均 CPU 时间（微秒）"""
+    start = time.process_time()
+    for _ in range(ROUNDS):
+        func(sessions, MESSAGE)
+    elapsed = time.process_time() - start
+    for session in sessions.values():
+        session.queue.clear()
+    return elapsed / (ROUNDS * len(sessions)) * 1e6
+
+
+def main():
+    print(f"{'clients':>8} {'per-recipient(us)':>18} {'encode-once(us)':>16} {'speedup':>8}")
+    for count in CLIENT_COUNTS:
+        sessions = make_sessions(count)
+        before = measure(broadcast_per_recipient, sessions)
+        after = measure(broadcast_encode_once, sessions)
+        print(f"{count:>8} {before:>18.3f} {after:>16.3f} {before / after:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
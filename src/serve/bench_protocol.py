@@ -0,0 +1,76 @@
+"""
+协议编解码性能测试：比较 JSON 帧与紧凑帧（chat.compact.v1）在各类消息上的帧大小和编解码耗时
+
+紧凑帧的编解码器在整个测试中复用，用户名在第一帧之后都是驻留表引用，与一个长连接上的情况相同。
+用法：python bench_protocol.py
+"""
+import base64
+import json
+import os
+import time
+
+from protocol import json_create, now, parse_frame, CompactCodec
+
+# 每种消息重复编解码的次数
+ROUNDS = 20000
+
+TEXT = "这是一条用于测试协议编解码性能的聊天消息"
+IMAGE = os.urandom(64 * 1024)
+SEQ = 1234567890123456789 >> 4
+
+# (说明, flag, id, 用户名, 消息内容, seq, room)
+CASES = [
+    ('0 普通消息', 0, 1024, 'alice', TEXT, SEQ, None),
+    ('0 房间消息', 0, 1024, 'alice', TEXT, SEQ, 'python'),
+    ('1 登录', 1, 1024, 'alice', 'password', None, None),
+    ('2 注册', 2, None, 'alice', 'password', None, None),
+    ('3 服务端心跳', 3, 0, 0, 'heartbeat', None, None),
+    ('4 客户端心跳', 4, 1024, 'heartbeat', 'heartbeat', None, None),
+    ('5 同步请求', 5, 1024, 0, {"cursor": SEQ}, None, None),
+    ('6 同步确认', 6, 1024, 0, SEQ, None, None),
+    ('7 同步完成', 7, 0, 'server', 'sync_complete', SEQ, None),
+    ('8 图片 64KB', 8, 1024, 'alice', IMAGE, SEQ, None),
+    ('10 头像 64KB', 10, 1024, 'alice', IMAGE, None, None),
+]
+
+
+def measure(func, rounds=ROUNDS):
+    """返回每次调用的平均耗时（微秒）"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def json_frame(flag, id, name, message, times, seq, room):
+    # 旧的 JSON 协议中图片为 base64 文本
+    if isinstance(message, bytes):
+        message = base64.b64encode(message).decode('utf-8')
+    return json_create(flag, id, name, message, times, seq, room)
+
+
+def main():
+    times = now()
+    encoder = CompactCodec()
+    decoder = CompactCodec()
+    print(f"{'message':<14} {'json(B)':>8} {'compact(B)':>10} "
+          f"{'json enc(us)':>12} {'compact enc(us)':>15} {'json dec(us)':>12} {'compact dec(us)':>15}")
+    for title, flag, id, name, message, seq, room in CASES:
+        text = json_frame(flag, id, name, message, times, seq, room)
+        # 第一帧定义驻留的用户名，之后的帧只带引用
+        decoder.decode(encoder.encode(flag, id, name, message, times, seq, room))
+        frame = encoder.encode(flag, id, name, message, times, seq, room)
+        assert decoder.decode(frame)['message'] == message
+        rounds = ROUNDS // 20 if isinstance(message, bytes) else ROUNDS
+        json_encode = measure(lambda: json_frame(flag, id, name, message, times, seq, room), rounds)
+        compact_encode = measure(lambda: encoder.encode(flag, id, name, message, times, seq, room), rounds)
+        json_decode = measure(lambda: json.loads(text), rounds)
+        compact_decode = measure(lambda: decoder.decode(frame), rounds)
+        print(f"{title:<14} {len(text.encode('utf-8')):>8} {len(frame):>10} "
+              f"{json_encode:>12.2f} {compact_encode:>15.2f} {json_decode:>12.2f} {compact_decode:>15.2f}")
+    # 解析入口与服务端处理函数一致
+    assert parse_frame(frame, decoder)['flag'] == 10
+
+
+if __name__ == '__main__':
+    main()
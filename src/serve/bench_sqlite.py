@@ -0,0 +1,44 @@
+"""
+消息写入性能测试：比较三种持久化模式每秒能写入多少条消息
+
+用法：python bench_sqlite.py [消息条数]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from sqlmg import SqlMG, DURABILITY_PER_MESSAGE, DURABILITY_GROUPED, DURABILITY_OS_BUFFERED
+
+# 模拟服务端定时 flush 的间隔（条）
+FLUSH_EVERY = 50
+
+INSERT_SQL = "INSERT INTO messages (sender_id, sender_username, message, timestamp, type) VALUES (?, ?, ?, ?, ?)"
+
+
+def run(durability, count):
+    """返回该模式下每秒写入的消息数"""
+    with tempfile.TemporaryDirectory() as folder:
+        sql = SqlMG(os.path.join(folder, 'bench.db'), durability=durability)
+        sql.sever_sql()
+        start = time.perf_counter()
+        for i in range(count):
+            sql.queue(INSERT_SQL, (1, 'bench', f'message {i}', int(time.time() * 1000), 0))
+            if i % FLUSH_EVERY == 0:
+                sql.flush()
+        sql.close()
+        return count / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    # 每条 SQL 的日志会严重影响结果，测试时关闭
+    logging.getLogger('chat.db').setLevel(logging.WARNING)
+    print(f"{'mode':>12} {'inserts/sec':>12}")
+    for durability in (DURABILITY_PER_MESSAGE, DURABILITY_GROUPED, DURABILITY_OS_BUFFERED):
+        print(f"{durability:>12} {run(durability, count):>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
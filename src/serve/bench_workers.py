@@ -0,0 +1,159 @@
+"""
+多进程扩展性测试：分别以 1、2、4 ... 个 worker 启动服务器，测量每秒能投递给客户端的广播消息数
+
+每种配置使用独立的临时数据库；压测客户端本身也分布在多个进程中，避免客户端成为瓶颈。
+用法：python bench_workers.py [最大 worker 数]
+"""
+import asyncio
+import multiprocessing
+import os
+import queue
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+from protocol import json_create, now, parse_frame, BINARY_SUBPROTOCOL
+
+PORT = 9997
+
+# 压测客户端进程数，每个进程中的连接数，每个连接发送的消息数
+LOAD_PROCESSES = 4
+CLIENTS_PER_PROCESS = 25
+MESSAGES_PER_CLIENT = 20
+
+# 等待所有消息送达的最长时间（秒）
+TIMEOUT = 120
+
+# 等待所有压测进程登录完成的最长时间（秒）
+LOGIN_TIMEOUT = 60
+
+SERVE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'serve.py')
+
+
+def client_ssl_context():
+    """测试使用自签名证书，不校验"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def open_client(index, context):
+    """注册并登录一个测试用户，返回连接"""
+    websocket = await websockets.connect(f'wss://localhost:{PORT}', ssl=context, max_size=None,
+                                         subprotocols=[BINARY_SUBPROTOCOL])
+    name = f'bench{os.getpid()}_{index}'
+    await websocket.send(json_create(2, None, name, 'bench', now()))
+    user_id = parse_frame(await websocket.recv())['id']
+    await websocket.send(json_create(1, user_id, name, 'bench', now()))
+    while parse_frame(await websocket.recv()).get('message') != 'LOGIN_SUCCESS':
+        pass
+    return websocket
+
+
+async def count_messages(websocket, expected, counter):
+    """统计收到的其他用户的聊天消息（忽略上线通知和回执）"""
+    async for raw in websocket:
+        msg = parse_frame(raw)
+        if msg.get('flag') == 0 and msg.get('id'):
+            counter[0] += 1
+            if counter[0] >= expected:
+                return
+
+
+async def load(barrier, total_clients):
+    context = client_ssl_context()
+    clients = [await open_client(index, context) for index in range(CLIENTS_PER_PROCESS)]
+    # 等待所有压测进程都登录完成后同时开始发送
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait, LOGIN_TIMEOUT)
+    # 每条消息会投递给除发送者以外的所有连接
+    expected = MESSAGES_PER_CLIENT * total_clients - MESSAGES_PER_CLIENT
+    counters = [[0] for _ in clients]
+    start = time.perf_counter()
+    receivers = [asyncio.create_task(count_messages(websocket, expected, counter))
+                 for websocket, counter in zip(clients, counters)]
+    for number in range(MESSAGES_PER_CLIENT):
+        for websocket in clients:
+            await websocket.send(json_create(0, 0, 'bench', f'message {number}', now()))
+    await asyncio.wait(receivers, timeout=TIMEOUT)
+    elapsed = time.perf_counter() - start
+    for websocket in clients:
+        await websocket.close()
+    return sum(counter[0] for counter in counters), elapsed
+
+
+def load_process(barrier, total_clients, results):
+    """运行一个压测进程，结果或出错信息都放入 results，主进程不会一直等待"""
+    try:
+        results.put(asyncio.run(load(barrier, total_clients)))
+    except BaseException as e:
+        # 让其他还在等待登录完成的压测进程也立即退出
+        barrier.abort()
+        results.put((None, f'{type(e).__name__}: {e}'))
+
+
+def wait_port(timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('localhost', PORT), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('服务器没有启动')
+
+
+def run(workers):
+    """返回该配置下每秒投递的消息数"""
+    with tempfile.TemporaryDirectory() as folder:
+        server = subprocess.Popen([sys.executable, SERVE_PATH, '--port', str(PORT), '--workers', str(workers)],
+                                  cwd=folder, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes = []
+        try:
+            wait_port()
+            barrier = multiprocessing.Barrier(LOAD_PROCESSES)
+            results = multiprocessing.Queue()
+            total_clients = LOAD_PROCESSES * CLIENTS_PER_PROCESS
+            processes = [multiprocessing.Process(target=load_process, args=(barrier, total_clients, results))
+                         for _ in range(LOAD_PROCESSES)]
+            for process in processes:
+                process.start()
+            try:
+                outcomes = [results.get(timeout=LOGIN_TIMEOUT + TIMEOUT + 30) for _ in processes]
+            except queue.Empty:
+                raise RuntimeError('压测进程没有返回结果') from None
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            server.terminate()
+            server.wait()
+    errors = [error for count, error in outcomes if count is None]
+    if errors:
+        raise RuntimeError(f'压测进程出错：{errors[0]}')
+    delivered = sum(count for count, _ in outcomes)
+    return delivered / max(elapsed for _, elapsed in outcomes)
+
+
+def main():
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    counts = [1]
+    while counts[-1] * 2 <= max_workers:
+        counts.append(counts[-1] * 2)
+    print(f"{'workers':>8} {'deliveries/sec':>15} {'scaling':>8}")
+    baseline = None
+    for workers in counts:
+        rate = run(workers)
+        baseline = baseline or rate
+        print(f"{workers:>8} {rate:>15.0f} {rate / baseline:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
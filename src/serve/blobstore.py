@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+
+logger = logging.getLogger('chat.image')
+
+# sha256 十六进制摘要
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def write_atomic(path, data):
+    """先写入同目录下的临时文件，再原子重命名，避免读到写了一半的文件"""
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class BlobStore:
+    """
+    内容寻址的图片仓库
+    文件按内容的 sha256 命名，存放在两级分片子目录下（pic/ab/cd/abcd....jpg），
+    相同内容只保存一份；引用计数记录在数据库 blobs 表中，由 messages 表的引用决定。
+    """
+
+    def __init__(self, root, sql, suffix='.jpg'):
+        self.root = root
+        self.sql = sql
+        self.suffix = suffix
+        os.makedirs(self.root, exist_ok=True)
+
+    @staticmethod
+    def is_digest(ref) -> bool:
+        """判断消息中保存的是否为图片摘要（旧数据保存的是文件路径）"""
+        return isinstance(ref, str) and DIGEST_PATTERN.match(ref) is not None
+
+    def path(self, digest) -> str:
+        """返回摘要对应的文件路径"""
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + self.suffix)
+
+    def locate(self, ref) -> str:
+        """把消息中保存的图片引用转换为文件路径，兼容旧的直接保存路径的数据"""
+        return self.path(ref) if self.is_digest(ref) else ref
+
+    def derivative_path(self, ref, kind) -> str:
+        """返回派生图片（如同步用的压缩图）的路径，与原图存放在同一目录"""
+        return os.path.splitext(self.locate(ref))[0] + f'.{kind}.jpg'
+
+    def put(self, data) -> str:
+        """保存图片并增加一次引用，返回内容摘要"""
+        digest = self.write(data)
+        self.add_ref(digest, len(data))
+        return digest
+
+    def write(self, data) -> str:
+        """只把图片写入磁盘（不访问数据库），返回内容摘要"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            write_atomic(path, data)
+            logger.info(f"保存新图片 {digest}，{len(data)} bytes")
+        else:
+            # 刷新修改时间，清理时不会删除正要被新消息引用的图片（见 collect_garbage）
+            os.utime(path)
+            logger.info(f"图片 {digest} 已存在，只增加引用计数")
+        return digest
+
+    def add_ref(self, digest, size):
+        """增加一次引用（只访问数据库）"""
+        self.sql.exec("""
+            INSERT INTO blobs (digest, size, refcount) VALUES (?, ?, 1)
+            ON CONFLICT(digest) DO UPDATE SET refcount = refcount + 1
+        """, (digest, size))
+
+    def _remove(self, digest):
+        self.sql.exec("DELETE FROM blobs WHERE digest = ?", (digest,))
+        for path in (self.path(digest), *self._derivatives(digest)):
+            if os.path.exists(path):
+                os.remove(path)
+        logger.info(f"删除无引用的图片 {digest}")
+
+    def _derivatives(self, digest):
+        """列出某张图片已生成的所有派生图片"""
+        folder = os.path.dirname(self.path(digest))
+        if not os.path.isdir(folder):
+            return []
+        return [os.path.join(folder, name) for name in os.listdir(folder)
+                if name.startswith(digest + '.') and name != digest + self.suffix]
+
+    def collect_garbage(self, min_age=3600):
+        """
+        按 messages 表的实际引用重新计算引用计数，并删除没有被引用的图片。
+        消息不会被删除，没有引用的图片来自写入图片后、消息入库前中断的请求（如进程崩溃时还没有提交的消息）；
+        min_age 秒内写入过的图片可能正等待消息入库，这次不删除
+        """
+        deadline = time.time() - min_age
+        refs = {row['message']: row['refs'] for row in self.sql.fetch(
+            "SELECT message, COUNT(*) AS refs FROM messages WHERE type = 8 GROUP BY message")}
+        for row in self.sql.fetch("SELECT digest, refcount FROM blobs"):
+            digest = row['digest']
+            refcount = refs.get(digest, 0)
+            if refcount == 0:
+                path = self.path(digest)
+                if not os.path.exists(path) or os.path.getmtime(path) < deadline:
+                    self._remove(digest)
+            elif refcount != row['refcount']:
+                self.sql.exec("UPDATE blobs SET refcount = ? WHERE digest = ?", (refcount, digest))
@@ -0,0 +1,339 @@
+"""
+消息总线：每条被接受的消息只发布一次，由总线投递给所有节点（包括发布者自己）的本地订阅者
+
+单进程运行时使用进程内的 LocalBus；多个服务进程（同一台机器上的多个 worker，或监听不同端口的多个
+serve.py）通过独立的代理进程 Broker 连接在一起，各自使用 BrokerBus。
+
+独立运行代理：python bus.py [地址]，地址为 unix socket 路径或 host:port
+"""
+import asyncio
+import collections
+import json
+import logging
+import os
+import struct
+import sys
+import tempfile
+
+from logconfig import setup_logging
+from protocol import DEFAULT_ROOM
+
+logger = logging.getLogger('chat.bus')
+
+# 事件帧：数据长度(4B) 头部长度(4B)，随后是 JSON 头部和原始数据（如图片字节）
+FRAME_HEADER = struct.Struct('!II')
+
+# 代理的默认地址
+DEFAULT_BROKER_ADDRESS = os.path.join(tempfile.gettempdir(), 'chat-bus.sock')
+
+# 代理为每个房间保留的最近事件数，节点重连后据此补发断线期间错过的事件
+BROKER_HISTORY = 1024
+
+# 代理为所有房间保留的事件总字节数，超出时淘汰最早的事件（图片事件带有原始图片数据）
+BROKER_HISTORY_BYTES = 64 * 1024 * 1024
+
+# 节点与代理断开期间最多暂存的待发布事件数和总字节数，超出时丢弃最早的事件（消息本身已入库，客户端可通过同步补齐）
+OUTBOX_SIZE = 10000
+OUTBOX_BYTES = 64 * 1024 * 1024
+
+# 重连间隔（秒），每次失败后加倍，直到上限
+RECONNECT_DELAY = 0.1
+RECONNECT_MAX_DELAY = 5
+
+
+def encode_event(header, payload=b'') -> bytes:
+    head = json.dumps(header).encode('utf-8')
+    return FRAME_HEADER.pack(len(head) + len(payload), len(head)) + head + payload
+
+
+async def read_frame(reader) -> bytes:
+    """读取一个完整的事件帧（含帧头），不解析内容"""
+    prefix = await reader.readexactly(FRAME_HEADER.size)
+    total, _ = FRAME_HEADER.unpack(prefix)
+    return prefix + await reader.readexactly(total)
+
+
+def decode_event(frame):
+    """解析事件帧，返回 (头部, 原始数据)"""
+    _, head_len = FRAME_HEADER.unpack_from(frame)
+    body = memoryview(frame)[FRAME_HEADER.size:]
+    return json.loads(bytes(body[:head_len])), bytes(body[head_len:])
+
+
+def split_address(address):
+    """host:port 返回 (host, port)，否则视为 unix socket 路径，返回 (path, None)"""
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and os.sep not in address:
+        return host, int(port)
+    return address, None
+
+
+async def open_address(address):
+    host, port = split_address(address)
+    if port is None:
+        return await asyncio.open_unix_connection(host)
+    return await asyncio.open_connection(host, port)
+
+
+async def serve_address(handler, address):
+    host, port = split_address(address)
+    if port is None:
+        if os.path.exists(host):
+            os.remove(host)
+        return await asyncio.start_unix_server(handler, path=host)
+    return await asyncio.start_server(handler, host, port)
+
+
+class MessageBus:
+    """
+    总线接口：publish 发布事件，总线把事件交给每个节点的订阅者 on_event(header, payload)
+    可能有事件没有投递到某个节点时，该节点的订阅者会收到 {"type": "gap"} 事件
+    """
+
+    def __init__(self, on_event):
+        self.on_event = on_event
+
+    async def start(self):
+        pass
+
+    def publish(self, header, payload=b''):
+        raise NotImplementedError
+
+    async def run(self):
+        """后台任务，负责接收事件"""
+        await asyncio.Future()
+
+    def close(self):
+        pass
+
+
+class LocalBus(MessageBus):
+    """进程内实现：发布即投递给本进程的订阅者，发布顺序就是投递顺序"""
+
+    def publish(self, header, payload=b''):
+        self.on_event(header, payload)
+
+
+class BrokerBus(MessageBus):
+    """
+    通过代理在多个节点之间转发事件
+    所有节点（包括发布者）都按代理收到事件的顺序投递；代理为每个房间的事件编号（room_seq），
+    同一房间的事件在所有节点上顺序相同，重复的编号会被忽略。
+    与代理断开时，新事件暂存在 outbox 中（按条数和字节数限制）并自动重连；重连后代理按各房间最后收到的编号补发期间错过的事件。
+    """
+
+    def __init__(self, address, on_event):
+        super().__init__(on_event)
+        self.address = address
+        self.reader = None
+        self.writer = None
+        self.outbox = collections.deque()
+        self.outbox_bytes = 0
+        # 代理每次启动生成新的 epoch，编号只在同一个 epoch 内有效
+        self.epoch = None
+        # 各房间已投递的最后编号 {room: room_seq}
+        self.last_seq = {}
+        self.reconnects = 0
+        self.dropped = 0
+        # outbox 溢出丢弃过事件，重连后需要通知所有节点
+        self.lost = False
+
+    async def start(self, retries=50):
+        """连接代理，失败时重试 retries 次"""
+        delay = RECONNECT_DELAY
+        for _ in range(retries):
+            try:
+                await self._connect()
+                return
+            except (OSError, asyncio.IncompleteReadError):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        raise ConnectionError(f"无法连接消息代理：{self.address}")
+
+    async def _connect(self):
+        reader, writer = await open_address(self.address)
+        writer.write(encode_event({"type": "resume", "epoch": self.epoch, "rooms": self.last_seq}))
+        hello, _ = decode_event(await read_frame(reader))
+        if hello['epoch'] != self.epoch:
+            # 代理重启过，旧的编号作废
+            self.epoch = hello['epoch']
+            self.last_seq = {}
+            self._gap()
+        self.reader, self.writer = reader, writer
+        # 补发断开期间暂存的事件
+        while self.outbox:
+            writer.write(self.outbox.popleft())
+        self.outbox_bytes = 0
+        if self.lost:
+            writer.write(encode_event({"type": "gap"}))
+            self.lost = False
+        logger.info(f"已连接消息代理：{self.address}")
+
+    def publish(self, header, payload=b''):
+        """发布事件，只写入发送缓冲区，不等待"""
+        frame = encode_event(header, payload)
+        if self.writer is not None:
+            self.writer.write(frame)
+            return
+        self.outbox.append(frame)
+        self.outbox_bytes += len(frame)
+        while len(self.outbox) > OUTBOX_SIZE or self.outbox_bytes > OUTBOX_BYTES:
+            self.outbox_bytes -= len(self.outbox.popleft())
+            self.dropped += 1
+            self.lost = True
+
+    async def run(self):
+        while True:
+            try:
+                while True:
+                    self._dispatch(*decode_event(await read_frame(self.reader)))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logger.error(f"与消息代理的连接已断开：{self.address}")
+            self.writer.close()
+            self.reader = self.writer = None
+            await self._reconnect()
+
+    async def _reconnect(self):
+        delay = RECONNECT_DELAY
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self._connect()
+                self.reconnects += 1
+                return
+            except (OSError, asyncio.IncompleteReadError):
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _dispatch(self, header, payload):
+        room = header.get('room', DEFAULT_ROOM)
+        seq = header['room_seq']
+        last = self.last_seq.get(room, 0)
+        if seq <= last:
+            return
+        if last and seq > last + 1:
+            logger.warning(f"房间 {room} 的事件 {last + 1}..{seq - 1} 已超出代理保留范围，未能补发")
+            self._gap()
+        self.last_seq[room] = seq
+        try:
+            self.on_event(header, payload)
+        except Exception as e:
+            logger.error(f"处理总线事件时出错：{e}")
+
+    def _gap(self):
+        """通知本节点的订阅者可能错过了事件（第一次连接代理时也会通知，此前的事件都没有收到）"""
+        try:
+            self.on_event({"type": "gap"}, b'')
+        except Exception as e:
+            logger.error(f"处理总线事件时出错：{e}")
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.writer is not None,
+            "outbox": len(self.outbox),
+            "outbox_bytes": self.outbox_bytes,
+            "dropped": self.dropped,
+            "reconnects": self.reconnects
+        }
+
+
+class Broker:
+    """
+    消息代理：节点连接进来发布事件，代理为事件加上房间内编号后转发给所有节点（包括发布者）
+    每个房间保留最近 history 条事件，所有房间合计不超过 history_bytes 字节，节点重连时补发它错过的部分；
+    已淘汰的事件不再补发，节点从编号的跳跃发现缺口
+    """
+
+    def __init__(self, address=DEFAULT_BROKER_ADDRESS, history=BROKER_HISTORY, history_bytes=BROKER_HISTORY_BYTES):
+        self.address = address
+        self.history_size = history
+        self.history_bytes = history_bytes
+        self.epoch = os.urandom(8).hex()
+        self.room_seq = {}
+        # 各房间最近的事件 {room: deque[(room_seq, frame)]}
+        self.history = {}
+        # 所有房间的事件按保存顺序排列 deque[(room, room_seq)]，按字节数淘汰时从最早的开始；
+        # 已按房间条数淘汰的事件留在这里，数量超过保存的事件数两倍时清理
+        self.history_order = collections.deque()
+        self.history_count = 0
+        self.history_total = 0
+        self.writers = set()
+        self.server = None
+
+    async def start(self):
+        self.server = await serve_address(self._handle, self.address)
+        logger.info(f"消息代理已启动：{self.address}")
+
+    async def _handle(self, reader, writer):
+        try:
+            resume, _ = decode_event(await read_frame(reader))
+            writer.write(encode_event({"type": "hello", "epoch": self.epoch}))
+            if resume.get('epoch') == self.epoch:
+                self._replay(writer, resume.get('rooms') or {})
+            self.writers.add(writer)
+            while True:
+                header, payload = decode_event(await read_frame(reader))
+                self._forward(header, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def _replay(self, writer, rooms):
+        for room, last in rooms.items():
+            for seq, frame in self.history.get(room, ()):
+                if seq > last:
+                    writer.write(frame)
+
+    def _forward(self, header, payload):
+        room = header.setdefault('room', DEFAULT_ROOM)
+        seq = self.room_seq[room] = self.room_seq.get(room, 0) + 1
+        header['room_seq'] = seq
+        frame = encode_event(header, payload)
+        self._remember(room, seq, frame)
+        for writer in self.writers:
+            writer.write(frame)
+
+    def _remember(self, room, seq, frame):
+        """保存事件供重连补发，超出房间条数或总字节数时淘汰最早的事件"""
+        history = self.history.setdefault(room, collections.deque())
+        history.append((seq, frame))
+        self.history_order.append((room, seq))
+        self.history_count += 1
+        self.history_total += len(frame)
+        if len(history) > self.history_size:
+            self._evict(history)
+        while self.history_total > self.history_bytes:
+            old_room, old_seq = self.history_order.popleft()
+            old = self.history.get(old_room)
+            if old and old[0][0] == old_seq:
+                self._evict(old)
+                if not old:
+                    del self.history[old_room]
+        if len(self.history_order) > 2 * self.history_count + self.history_size:
+            self.history_order = collections.deque(
+                (room, seq) for room, seq in self.history_order
+                if room in self.history and seq >= self.history[room][0][0])
+
+    def _evict(self, history):
+        self.history_count -= 1
+        self.history_total -= len(history.popleft()[1])
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+
+async def run_broker(address):
+    broker = Broker(address)
+    await broker.start()
+    await asyncio.Future()
+
+
+if __name__ == '__main__':
+    setup_logging(log_file=None)
+    asyncio.run(run_broker(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_BROKER_ADDRESS))
@@ -0,0 +1,192 @@
+"""
+permessage-deflate 压缩策略
+
+websockets 默认对每条消息都做 deflate：JPEG 图片和头像（flag 8/10）本身已经压缩过，再压缩只是消耗 CPU；
+心跳、回执等几十字节的小帧压缩后几乎不变小。这里按消息的 flag 和大小决定是否压缩：
+RFC 7692 允许发送方逐条消息选择压缩（RSV1 置位）或不压缩，对端不需要任何改动。
+批量同步帧（flag 12）和较长的文字消息仍然压缩，连接级的压缩上下文在消息之间共享，压缩率高于逐帧 zlib。
+
+滑动窗口位数和 memLevel 决定每个连接的压缩器占用的内存（约 2^(wbits+2) + 2^(memLevel+9) 字节），
+默认与 websockets 相同为 12/5，约 32KB；连接数多时可以用 --deflate-window-bits 调小，或设为 0 关闭压缩。
+
+按 flag 统计压缩前后字节数和压缩、解压耗时，通过指标端口输出。
+"""
+import time
+
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import CTRL_OPCODES, OP_CONT, OP_TEXT
+
+from protocol import FORMAT_BINARY, FORMAT_COMPACT, FORMAT_JSON
+
+# 压缩滑动窗口位数（9~15），0 表示不启用 permessage-deflate
+DEFLATE_WINDOW_BITS = 12
+# zlib memLevel（1~9），越小每个连接占用的内存越少
+DEFLATE_MEM_LEVEL = 5
+# 小于该字节数的消息不压缩
+DEFLATE_MIN_SIZE = 256
+# 不压缩的消息：图片、头像（JPEG 已经压缩过）
+DEFLATE_SKIP_FLAGS = frozenset((8, 10))
+
+JSON_FLAG_PREFIX = b'{"flag": '
+
+
+def frame_flag(data, text, fmt):
+    """从一条消息的开头取出 flag，不解析整条消息；取不到时返回 None"""
+    if text:
+        # json_create / batch_create 生成的 JSON 都以 flag 字段开头
+        if data.startswith(JSON_FLAG_PREFIX):
+            end = data.find(b',', len(JSON_FLAG_PREFIX), len(JSON_FLAG_PREFIX) + 4)
+            if end > 0 and data[len(JSON_FLAG_PREFIX):end].isdigit():
+                return int(data[len(JSON_FLAG_PREFIX):end])
+        return None
+    if fmt == FORMAT_COMPACT and data:
+        return data[0]
+    if fmt == FORMAT_BINARY and len(data) > 1:
+        return data[1]
+    return None
+
+
+class DeflateStats:
+    """按 flag 统计的压缩情况，只在事件循环中更新"""
+
+    # 每个 flag 的统计项
+    FIELDS = ('messages', 'skipped', 'raw_bytes', 'wire_bytes', 'seconds',
+              'in_messages', 'in_raw_bytes', 'in_wire_bytes', 'in_seconds')
+
+    def __init__(self):
+        # {flag: {统计项: 值}}
+        self.flags = {}
+
+    def _entry(self, flag):
+        entry = self.flags.get(flag)
+        if entry is None:
+            entry = self.flags[flag] = dict.fromkeys(self.FIELDS, 0)
+        return entry
+
+    def sent(self, flag, raw, wire, seconds, skipped):
+        entry = self._entry(flag)
+        entry['messages'] += 1
+        entry['skipped'] += skipped
+        entry['raw_bytes'] += raw
+        entry['wire_bytes'] += wire
+        entry['seconds'] += seconds
+
+    def received(self, flag, raw, wire, seconds):
+        entry = self._entry(flag)
+        entry['in_messages'] += 1
+        entry['in_raw_bytes'] += raw
+        entry['in_wire_bytes'] += wire
+        entry['in_seconds'] += seconds
+
+    def collect(self, field) -> dict:
+        """{flag: 值}，供指标采集"""
+        return {'other' if flag is None else flag: entry[field] for flag, entry in self.flags.items()}
+
+    def summary(self) -> list:
+        """[(flag, 消息数, 跳过数, 压缩率, 每条消息的压缩耗时微秒)]"""
+        rows = []
+        for flag, entry in sorted(self.flags.items(), key=lambda item: str(item[0])):
+            ratio = entry['wire_bytes'] / entry['raw_bytes'] if entry['raw_bytes'] else 1.0
+            compressed = entry['messages'] - entry['skipped']
+            cost = entry['seconds'] / compressed * 1e6 if compressed else 0.0
+            rows.append((flag, entry['messages'], entry['skipped'], ratio, cost))
+        return rows
+
+
+class PolicyDeflate(PerMessageDeflate):
+    """按 DeflatePolicy 逐条消息决定是否压缩的 permessage-deflate 扩展"""
+
+    def __init__(self, *args, policy, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.policy = policy
+        # 连接选择的消息格式，握手完成后由 configure_deflate 设置
+        self.format = FORMAT_JSON
+        # 当前消息（可能分为多个帧）是否跳过压缩，以及所属的 flag
+        self.skip_message = False
+        self.out_flag = None
+        self.in_flag = None
+
+    def encode(self, frame):
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        if frame.opcode is not OP_CONT:
+            self.out_flag = frame_flag(frame.data, frame.opcode is OP_TEXT, self.format)
+            self.skip_message = not self.policy.should_compress(self.out_flag, len(frame.data))
+        if self.skip_message:
+            self.policy.stats.sent(self.out_flag, len(frame.data), len(frame.data), 0.0, 1)
+            return frame
+        start = time.perf_counter()
+        encoded = super().encode(frame)
+        self.policy.stats.sent(self.out_flag, len(frame.data), len(encoded.data), time.perf_counter() - start, 0)
+        return encoded
+
+    def decode(self, frame, **kwargs):
+        start = time.perf_counter()
+        decoded = super().decode(frame, **kwargs)
+        if decoded is frame or frame.opcode in CTRL_OPCODES:
+            # 对端没有压缩的消息
+            return decoded
+        if frame.opcode is not OP_CONT:
+            self.in_flag = frame_flag(decoded.data, frame.opcode is OP_TEXT, self.format)
+        self.policy.stats.received(self.in_flag, len(decoded.data), len(frame.data), time.perf_counter() - start)
+        return decoded
+
+
+class DeflatePolicy:
+    """哪些消息需要压缩：skip_flags 中的 flag 和小于 min_size 字节的消息不压缩"""
+
+    def __init__(self, skip_flags=DEFLATE_SKIP_FLAGS, min_size=DEFLATE_MIN_SIZE, stats=None):
+        self.skip_flags = frozenset(skip_flags)
+        self.min_size = min_size
+        self.stats = stats if stats is not None else DeflateStats()
+
+    def should_compress(self, flag, size) -> bool:
+        return size >= self.min_size and flag not in self.skip_flags
+
+
+class PolicyDeflateFactory(ServerPerMessageDeflateFactory):
+    """协商结果与 ServerPerMessageDeflateFactory 相同，生成的扩展按策略逐条压缩"""
+
+    def __init__(self, policy, **kwargs):
+        super().__init__(**kwargs)
+        self.policy = policy
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, PolicyDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            policy=self.policy,
+        )
+
+
+def deflate_extensions(policy, window_bits=DEFLATE_WINDOW_BITS, mem_level=DEFLATE_MEM_LEVEL) -> list:
+    """websockets.serve 的 extensions 参数；window_bits 为 0 时不启用压缩"""
+    if not window_bits:
+        return []
+    return [PolicyDeflateFactory(
+        policy,
+        server_max_window_bits=window_bits,
+        client_max_window_bits=window_bits,
+        compress_settings={"memLevel": mem_level},
+    )]
+
+
+def deflate_extension(websocket):
+    """连接上协商成功的压缩扩展，没有时返回 None"""
+    protocol = getattr(websocket, 'protocol', None)
+    for extension in getattr(protocol, 'extensions', ()):
+        if isinstance(extension, PerMessageDeflate):
+            return extension
+    return None
+
+
+def configure_deflate(websocket, fmt):
+    """握手完成后告诉压缩扩展连接使用的消息格式，用于从二进制帧中取出 flag"""
+    extension = deflate_extension(websocket)
+    if isinstance(extension, PolicyDeflate):
+        extension.format = fmt
+    return extension
@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import os
+import re
+import time
+import zlib
+
+from blobstore import DIGEST_PATTERN
+
+logger = logging.getLogger('chat.file')
+
+# 上传 id：客户端生成的 uuid4 十六进制
+UPLOAD_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+# 计算摘要时每次读取的字节数
+READ_BLOCK = 1024 * 1024
+
+
+def read_range(path, offset, size) -> bytes:
+    """读取文件中的一段（io 线程），每次只读一个分块"""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+
+class UploadError(Exception):
+    """上传请求或分块被拒绝，reason 为回复给客户端的原因，offset 为客户端应当继续发送的位置"""
+
+    def __init__(self, reason, offset=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.offset = offset
+
+
+class FileStore:
+    """
+    分块上传的文件仓库
+    上传中的文件写在 partial/<上传id>.part，上传信息记录在数据库 uploads 表中，断线重连后从已写入的位置继续；
+    上传完成并校验 sha256 后移动到按内容摘要命名的位置（ab/cd/abcd...），相同内容只保存一份，文件信息记录在 files 表中。
+    每次只读写一个分块，不会把整个文件放入内存；下载时按范围逐个分块读取（read_range）。
+    数据库操作在 db 线程中调用，文件读写在 io 线程池中调用。
+    """
+
+    def __init__(self, root, sql, chunk_size, max_size):
+        self.root = root
+        self.sql = sql
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.partial_root = os.path.join(root, 'partial')
+        os.makedirs(self.partial_root, exist_ok=True)
+
+    def path(self, digest) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def partial_path(self, upload_id) -> str:
+        return os.path.join(self.partial_root, upload_id + '.part')
+
+    def begin(self, upload_id, user_id, name, size, digest, room) -> int:
+        """
+        开始或继续一次上传（db 线程），返回客户端应当从哪个字节继续发送
+        同一上传 id 再次开始时，已写入的部分按分块大小向下取整，最后一个不完整的写入重新发送；
+        仓库中已有相同内容时直接返回 size
+        """
+        if not UPLOAD_ID_PATTERN.match(str(upload_id)) or not DIGEST_PATTERN.match(str(digest)):
+            raise UploadError('BAD_REQUEST')
+        if not isinstance(size, int) or size <= 0 or not isinstance(name, str) or not name:
+            raise UploadError('BAD_REQUEST')
+        if size > self.max_size:
+            raise UploadError('TOO_LARGE')
+        rows = self.sql.fetch("SELECT user_id, size, digest FROM uploads WHERE upload_id = ?", (upload_id,))
+        if rows and (rows[0]['user_id'] != user_id or rows[0]['size'] != size or rows[0]['digest'] != digest):
+            raise UploadError('CONFLICT')
+        if not rows:
+            self.sql.exec("INSERT INTO uploads (upload_id, user_id, name, size, digest, room, created) "
+                          "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (upload_id, user_id, os.path.basename(name), size, digest, room, int(time.time() * 1000)))
+        if os.path.exists(self.path(digest)):
+            return size
+        path = self.partial_path(upload_id)
+        written = os.path.getsize(path) if os.path.exists(path) else 0
+        offset = min(written - written % self.chunk_size, size)
+        with open(path, 'ab') as part:
+            part.truncate(offset)
+        return offset
+
+    def write_chunk(self, upload_id, size, offset, data, crc) -> int:
+        """
+        校验并写入一个分块（io 线程），返回写入后的位置。
+        上传过期清理或在另一个连接上取消后，已上传的部分不存在，按未知上传拒绝
+        """
+        if zlib.crc32(data) != crc:
+            raise UploadError('CHECKSUM', offset)
+        if len(data) > self.chunk_size or offset + len(data) > size:
+            raise UploadError('BAD_CHUNK', offset)
+        try:
+            with open(self.partial_path(upload_id), 'r+b') as part:
+                part.seek(offset)
+                part.write(data)
+        except FileNotFoundError:
+            raise UploadError('UNKNOWN_UPLOAD') from None
+        return offset + len(data)
+
+    def finish(self, upload_id, digest):
+        """校验整个文件的 sha256 并移动到仓库中（io 线程）；内容不一致时删除已上传的部分"""
+        target = self.path(digest)
+        partial = self.partial_path(upload_id)
+        if os.path.exists(target):
+            # 相同内容已经上传过
+            if os.path.exists(partial):
+                os.remove(partial)
+            return
+        sha = hashlib.sha256()
+        try:
+            with open(partial, 'rb') as part:
+                while block := part.read(READ_BLOCK):
+                    sha.update(block)
+        except FileNotFoundError:
+            raise UploadError('UNKNOWN_UPLOAD') from None
+        if sha.hexdigest() != digest:
+            os.remove(partial)
+            raise UploadError('DIGEST_MISMATCH', 0)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(partial, target)
+        logger.info(f"保存新文件 {digest}，{os.path.getsize(target)} bytes")
+
+    def complete(self, upload_id, file_id) -> dict:
+        """记录上传完成的文件（db 线程），file_id 与对应的 flag 9 消息 id 相同；返回文件信息"""
+        row = self.sql.fetch("SELECT user_id, name, size, digest, room FROM uploads WHERE upload_id = ?",
+                             (upload_id,))[0]
+        self.sql.exec("INSERT INTO files (id, digest, name, size, user_id, room) VALUES (?, ?, ?, ?, ?, ?)",
+                      (file_id, row['digest'], row['name'], row['size'], row['user_id'], row['room']))
+        self.sql.exec("DELETE FROM uploads WHERE upload_id = ?", (upload_id,))
+        return {"file": file_id, "name": row['name'], "size": row['size'], "digest": row['digest']}
+
+    def lookup(self, file_id):
+        """文件 id 对应的文件信息（db 线程）：{"path", "name", "size", "digest", "room"}，没有时返回 None"""
+        rows = self.sql.fetch("SELECT digest, name, size, room FROM files WHERE id = ?", (file_id,))
+        if not rows:
+            return None
+        row = rows[0]
+        return {"path": self.path(row['digest']), "name": row['name'], "size": row['size'],
+                "digest": row['digest'], "room": row['room']}
+
+    def cancel(self, upload_id, user_id):
+        """放弃一次上传（db 线程）"""
+        self.sql.exec("DELETE FROM uploads WHERE upload_id = ? AND user_id = ?", (upload_id, user_id))
+        path = self.partial_path(upload_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def expire(self, max_age):
+        """删除超过 max_age 秒没有完成的上传（db 线程）"""
+        deadline = int((time.time() - max_age) * 1000)
+        for row in self.sql.fetch("SELECT upload_id FROM uploads WHERE created < ?", (deadline,)):
+            self.sql.exec("DELETE FROM uploads WHERE upload_id = ?", (row['upload_id'],))
+            path = self.partial_path(row['upload_id'])
+            if os.path.exists(path):
+                os.remove(path)
+            logger.info(f"删除过期的上传 {row['upload_id']}")
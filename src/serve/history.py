@@ -0,0 +1,95 @@
+import bisect
+
+from idgen import id_floor
+from protocol import batch_item, from_millis, to_millis
+
+
+class RecentHistory:
+    """
+    最近消息的内存缓冲：每个房间（包括私聊会话）保留最近 per_room 条已入库的消息，按 id 排序
+    每条消息以与数据库查询结果相同的字段保存，文字消息另外保存编码好的批量帧元素（item），同步时直接拼接。
+
+    floor 之后的消息都经过本进程的消息总线，因此一定在缓冲中，除非已被淘汰；
+    游标不小于 floor 和该房间最后淘汰的 id 时，这个房间游标之后的消息可以完全由缓冲提供，否则需要查询数据库。
+    总线可能丢失事件时调用 reset，以当前时间重新确定 floor。
+    """
+
+    def __init__(self, per_room):
+        self.per_room = per_room
+        self.rooms = {}
+        # 各房间最后被淘汰的消息 id
+        self.evicted = {}
+        self.floor = id_floor()
+        self.hits = 0
+        self.misses = 0
+        # 整页都由缓冲提供、没有查询数据库的同步请求数
+        self.memory_pages = 0
+        self.db_pages = 0
+
+    def record(self, seq, flag, sender_id, sender_name, message, times, room):
+        """记录一条已入库的消息，图片消息的 message 为图片摘要"""
+        millis = to_millis(times)
+        row = {
+            "id": seq,
+            "sender_id": sender_id,
+            "sender_username": sender_name,
+            "message": message,
+            "timestamp": millis,
+            "type": flag,
+            "room": room,
+            "item": None if flag == 8 else batch_item(seq, flag, sender_id, sender_name, message,
+                                                      from_millis(millis), room)
+        }
+        entries = self.rooms.setdefault(room, [])
+        if not entries or entries[-1]["id"] < seq:
+            entries.append(row)
+        else:
+            # 其他节点的消息可能晚于 id 更大的消息到达
+            bisect.insort(entries, row, key=lambda entry: entry["id"])
+        if len(entries) > self.per_room + self.per_room // 4:
+            # 超出容量的四分之一时一次淘汰，避免每条消息都移动整个列表
+            excess = len(entries) - self.per_room
+            self.evicted[room] = entries[excess - 1]["id"]
+            del entries[:excess]
+
+    def covers(self, room, cursor) -> bool:
+        return cursor >= max(self.floor, self.evicted.get(room, 0))
+
+    def split(self, cursor, room_list):
+        """
+        把同步范围分为两部分，返回 (缓冲中各房间游标之后的消息列表, 需要查询数据库的房间)
+        每个列表都按 id 排序，由调用方归并并截断为一页
+        """
+        pages = []
+        missing = []
+        for room in room_list:
+            if self.covers(room, cursor):
+                entries = self.rooms.get(room, ())
+                pages.append(entries[bisect.bisect_right(entries, cursor, key=lambda entry: entry["id"]):])
+                self.hits += 1
+            else:
+                missing.append(room)
+                self.misses += 1
+        if missing:
+            self.db_pages += 1
+        else:
+            self.memory_pages += 1
+        return pages, missing
+
+    def reset(self):
+        """清空缓冲，之前的消息都改为从数据库读取"""
+        self.rooms.clear()
+        self.evicted.clear()
+        self.floor = id_floor()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "rooms": len(self.rooms),
+            "messages": sum(len(entries) for entries in self.rooms.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_pages": self.memory_pages,
+            "db_pages": self.db_pages
+        }
@@ -0,0 +1,43 @@
+import time
+
+# 自定义纪元：2024-01-01 00:00:00 UTC（毫秒）
+ID_EPOCH_MS = 1704067200000
+
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class MessageIdGenerator:
+    """
+    消息 id 生成器：id = 毫秒时间 << 22 | 节点号 << 12 | 毫秒内序号
+    id 在写入数据库之前就已确定，分组提交时也能立刻作为同步游标发给客户端；
+    单个节点生成的 id 严格递增，不同节点（node_id 不同）生成的 id 不会冲突。
+    """
+
+    def __init__(self, node_id=0, last_id=0):
+        if not 0 <= node_id < 1 << NODE_BITS:
+            raise ValueError(f"节点号超出范围: {node_id}")
+        self.node_id = node_id
+        self.last_millis = last_id >> (NODE_BITS + SEQUENCE_BITS)
+        self.sequence = last_id & MAX_SEQUENCE
+
+    def next(self) -> int:
+        millis = int(time.time() * 1000) - ID_EPOCH_MS
+        if millis > self.last_millis:
+            self.last_millis = millis
+            self.sequence = 0
+        else:
+            # 同一毫秒内或时钟回拨：沿用上一个毫秒值，序号用完时借用下一毫秒
+            self.sequence += 1
+            if self.sequence > MAX_SEQUENCE:
+                self.last_millis += 1
+                self.sequence = 0
+        return (self.last_millis << (NODE_BITS + SEQUENCE_BITS)) | (self.node_id << SEQUENCE_BITS) | self.sequence
+
+
+def id_floor(millis=None) -> int:
+    """毫秒时间 millis（默认为现在）之前生成的 id 都不大于返回值"""
+    if millis is None:
+        millis = int(time.time() * 1000)
+    return ((millis - ID_EPOCH_MS) << (NODE_BITS + SEQUENCE_BITS)) - 1
@@ -0,0 +1,110 @@
+import asyncio
+import collections
+import logging
+import os
+
+from blobstore import write_atomic
+from imaging import compress_image
+
+logger = logging.getLogger('chat.image')
+
+# 同步用压缩图的派生类型名
+SYNC_DERIVATIVE = 'sync'
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class ImageCache:
+    """
+    同步用压缩图缓存
+    压缩图只生成一次（入库时，或第一次被请求时），保存在原图旁边；
+    内存中再用一个按字节计算容量的 LRU 缓存，命中时完全不需要 PIL 处理。
+    磁盘读写在 io 线程池中进行，压缩在 cpu 进程池中进行，不阻塞事件循环。
+    同一张图片同时只压缩一次：重连时多个会话同步同一张还没有压缩图的图片，都等待第一次压缩的结果。
+    """
+
+    def __init__(self, blob_store, offload, max_bytes=64 * 1024 * 1024):
+        self.blob_store = blob_store
+        self.offload = offload
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # 等待第一次压缩结果的请求数
+        self.coalesced = 0
+        # 正在生成的压缩图 {ref: asyncio.Task}
+        self.pending = {}
+
+    async def get(self, ref):
+        """返回图片的同步用压缩图数据，失败时返回 None"""
+        data = self.entries.get(ref)
+        if data is not None:
+            self.entries.move_to_end(ref)
+            self.hits += 1
+            return data
+
+        path = self.blob_store.derivative_path(ref, SYNC_DERIVATIVE)
+        if os.path.exists(path):
+            data = await self.offload.run_io(read_file, path)
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            data = await self.generate(ref)
+            if data is None:
+                return None
+        self._remember(ref, data)
+        return data
+
+    async def generate(self, ref):
+        """压缩原图并把结果保存为派生图片；同一张图片正在压缩时等待它的结果，不再重复压缩"""
+        task = self.pending.get(ref)
+        if task is None:
+            task = self.pending[ref] = asyncio.ensure_future(self._generate(ref))
+            task.add_done_callback(lambda _: self.pending.pop(ref, None))
+        else:
+            self.coalesced += 1
+        # 先发起的请求被取消（如连接断开）时，压缩继续进行，其他请求仍然可以得到结果
+        return await asyncio.shield(task)
+
+    async def _generate(self, ref):
+        data = await self.offload.run_cpu(compress_image, self.blob_store.locate(ref))
+        if data is None:
+            return None
+        await self.offload.run_io(write_atomic, self.blob_store.derivative_path(ref, SYNC_DERIVATIVE), data)
+        logger.info(f"生成图片 {ref} 的同步压缩图，{len(data)} bytes")
+        return data
+
+    async def warm(self, ref):
+        """入库时预先生成压缩图"""
+        if not os.path.exists(self.blob_store.derivative_path(ref, SYNC_DERIVATIVE)):
+            data = await self.generate(ref)
+            if data is not None:
+                self._remember(ref, data)
+
+    def _remember(self, ref, data):
+        """放入内存缓存，超出字节预算时淘汰最久未使用的条目"""
+        if len(data) > self.max_bytes:
+            return
+        old = self.entries.pop(ref, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[ref] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced
+        }
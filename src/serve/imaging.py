@@ -0,0 +1,43 @@
+import io
+import logging
+
+from PIL import Image
+
+logger = logging.getLogger('chat.image')
+
+# 压缩后的最大尺寸
+MAX_IMAGE_SIZE = (1920, 1080)
+
+IMAGE_QUALITY = 85
+
+# 压缩后的最大字节数，与消息大小限制（10MB）一致
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+
+
+def compress_image(image_path):
+    """压缩图片（在进程池中执行，不要依赖服务端的全局状态）"""
+    try:
+        # 打开图片
+        with Image.open(image_path) as img:
+            # 转换为RGB模式（如果是RGBA，去除透明通道）
+            if img.mode in ('RGBA', 'P'):
+                img = img.convert('RGB')
+
+            # 调整图片大小
+            if img.size[0] > MAX_IMAGE_SIZE[0] or img.size[1] > MAX_IMAGE_SIZE[1]:
+                img.thumbnail(MAX_IMAGE_SIZE, Image.Resampling.LANCZOS)
+
+                # 保存到内存中
+            output = io.BytesIO()
+            img.save(output, format='JPEG', quality=IMAGE_QUALITY, optimize=True)
+            compressed_data = output.getvalue()
+
+            # 检查压缩后的大小
+            if len(compressed_data) > MAX_IMAGE_BYTES:
+                logger.error(f"图片压缩后仍然超过大小限制: {len(compressed_data)} bytes > {MAX_IMAGE_BYTES} bytes")
+                return None
+
+            return compressed_data
+    except Exception as e:
+        logger.error(f"压缩图片时出错: {e}")
+        return None
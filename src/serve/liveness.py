@@ -0,0 +1,110 @@
+import asyncio
+import math
+import time
+
+
+class TimerWheel:
+    """
+    哈希时间轮：时间按 tick 划分，第 n 个 tick 到期的条目放在 slots[n % len(slots)] 中
+    加入和取消条目都是 O(1)；推进时只检查经过的槽，空槽几乎没有开销
+    """
+
+    def __init__(self, tick=1.0, slots=256):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        # 条目所在的槽号 {key: index}
+        self.where = {}
+        self.origin = time.monotonic()
+        # 下一个要处理的 tick 序号
+        self.current = 0
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, deadline):
+        """安排 key 在 deadline（time.monotonic 时间）到期，已存在的条目会被替换"""
+        self.cancel(key)
+        tick = max(math.ceil((deadline - self.origin) / self.tick), self.current)
+        index = tick % len(self.slots)
+        self.slots[index][key] = deadline
+        self.where[key] = index
+
+    def cancel(self, key):
+        index = self.where.pop(key, None)
+        if index is not None:
+            self.slots[index].pop(key, None)
+
+    def advance(self, now) -> list:
+        """推进到 now，取出并返回所有已到期的 key"""
+        target = math.floor((now - self.origin) / self.tick)
+        # 一次推进超过一整圈时，每个槽只需要检查一次
+        steps = min(target - self.current + 1, len(self.slots))
+        expired = []
+        for step in range(max(steps, 0)):
+            slot = self.slots[(self.current + step) % len(self.slots)]
+            if not slot:
+                continue
+            # 同一个槽里还可能有几圈之后才到期的条目，留在原处
+            due = [key for key, deadline in slot.items() if deadline <= now]
+            for key in due:
+                del slot[key]
+                del self.where[key]
+            expired.extend(due)
+        self.current = max(self.current, target + 1)
+        return expired
+
+
+class HeartbeatScheduler:
+    """
+    连接存活检测
+    每个连接在时间轮上只有一个条目；收到任何消息只更新最后活跃时间（O(1)），不移动时间轮条目。
+    条目到期时才检查该连接：空闲超过 interval 发送一次探测（JSON 心跳或 websocket ping），
+    空闲超过 timeout 判定离线。没有到期的连接不会被检查。
+    """
+
+    def __init__(self, probe, expire, interval=30, timeout=60, tick=1.0):
+        self.probe = probe
+        self.expire = expire
+        self.interval = interval
+        self.timeout = timeout
+        self.tick = tick
+        self.wheel = TimerWheel(tick)
+        self.last_seen = {}
+
+    def __len__(self):
+        return len(self.last_seen)
+
+    def add(self, key):
+        now = time.monotonic()
+        self.last_seen[key] = now
+        self.wheel.schedule(key, now + self.interval)
+
+    def touch(self, key):
+        """记录一次活跃（收到消息、心跳或 pong）"""
+        if key in self.last_seen:
+            self.last_seen[key] = time.monotonic()
+
+    def remove(self, key):
+        self.last_seen.pop(key, None)
+        self.wheel.cancel(key)
+
+    def check(self, now):
+        """处理所有到期的条目"""
+        for key in self.wheel.advance(now):
+            last_seen = self.last_seen.get(key)
+            if last_seen is None:
+                continue
+            idle = now - last_seen
+            if idle >= self.timeout:
+                self.last_seen.pop(key, None)
+                self.expire(key)
+            elif idle >= self.interval:
+                self.probe(key)
+                self.wheel.schedule(key, min(last_seen + self.timeout, now + self.interval))
+            else:
+                self.wheel.schedule(key, last_seen + self.interval)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.check(time.monotonic())
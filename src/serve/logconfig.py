@@ -0,0 +1,147 @@
+"""
+服务端日志配置，只在入口（serve.py / bus.py）调用一次 setup_logging
+
+各模块使用 chat.* 下的具名日志记录器，级别按子系统分别设置：
+chat.server 连接和会话，chat.traffic 每条收发消息，chat.db SQL 语句，chat.bus 消息总线，
+chat.session 发送队列，chat.image 图片处理，chat.file 文件上传，chat.offload 执行池，chat.metrics 指标端口。
+
+记录日志的线程只把记录放入队列，格式化和写终端、写文件都在 QueueListener 的后台线程中进行，
+不会阻塞事件循环或 db 线程。消息超过 LOG_MAX_CHARS 时截断，避免把图片等大载荷写入日志；
+chat.traffic 和 chat.db 每个调用位置每秒最多输出 LOG_RATE_LIMIT 条，其余只计数。
+结构化字段通过 extra={"fields": {...}} 传入，输出为 key=value。
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+LOG_FILE = 'app.log'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+
+# 各子系统的日志级别，可以用环境变量覆盖，例如 CHAT_LOG_LEVELS="chat.db=DEBUG,chat.traffic=INFO"
+LOG_LEVELS = {
+    'chat': logging.INFO,
+    'chat.traffic': logging.WARNING,
+    'chat.db': logging.WARNING,
+}
+LOG_LEVELS_ENV = 'CHAT_LOG_LEVELS'
+
+# 写入文件的最低级别
+FILE_LEVEL = logging.INFO
+
+# 单条日志消息的最大长度（字符）
+LOG_MAX_CHARS = 1000
+
+# 高频日志每个调用位置每秒最多输出的条数
+LOG_RATE_LIMIT = 20
+RATE_LIMITED_LOGGERS = ('chat.traffic', 'chat.db')
+
+
+def parse_levels(text) -> dict:
+    levels = {}
+    for part in filter(None, (item.strip() for item in text.split(','))):
+        name, _, level = part.partition('=')
+        levels[name.strip()] = logging.getLevelName(level.strip().upper())
+    return levels
+
+
+class FieldsFormatter(logging.Formatter):
+    """在消息后附加结构化字段 key=value"""
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return text
+
+
+class TruncatingQueueHandler(logging.handlers.QueueHandler):
+    """放入队列前生成消息文本并截断过长的部分"""
+
+    def __init__(self, log_queue, max_chars=LOG_MAX_CHARS):
+        super().__init__(log_queue)
+        self.max_chars = max_chars
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        if len(record.msg) > self.max_chars:
+            record.msg = f'{record.msg[:self.max_chars]}...（共 {len(record.msg)} 字符）'
+            record.message = record.msg
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    同一调用位置每 interval 秒最多放行 limit 条，其余丢弃并计数，
+    下一个时间窗口放行的第一条记录带上被抑制的条数（字段 suppressed）
+    每个记录器只在一个线程中使用，不需要加锁
+    """
+
+    def __init__(self, limit=LOG_RATE_LIMIT, interval=1.0):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        # {(文件, 行号): [窗口开始时间, 已放行条数, 已抑制条数]}
+        self.windows = {}
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        current = time.monotonic()
+        window = self.windows.get(key)
+        if window is None or current - window[0] >= self.interval:
+            if window is not None and window[2]:
+                record.fields = {**(getattr(record, 'fields', None) or {}), "suppressed": window[2]}
+            self.windows[key] = [current, 1, 0]
+            return True
+        if window[1] < self.limit:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+def setup_process_logging():
+    """
+    执行池子进程中调用：fork 出的子进程继承了队列处理器，但没有后台线程消费队列，
+    改为直接写终端（子进程只记录少量错误）
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.StreamHandler()
+    handler.setFormatter(FieldsFormatter(LOG_FORMAT))
+    root.addHandler(handler)
+
+
+def setup_logging(log_file=LOG_FILE, levels=None):
+    """配置根日志记录器：队列 + 后台线程写终端和文件；重复调用时不做任何事"""
+    root = logging.getLogger()
+    if any(isinstance(handler, TruncatingQueueHandler) for handler in root.handlers):
+        return
+
+    formatter = FieldsFormatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        file_handler = logging.FileHandler(log_file, encoding='utf-8')
+        file_handler.setLevel(FILE_LEVEL)
+        handlers.append(file_handler)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # 退出时写完队列中剩余的日志
+    atexit.register(listener.stop)
+
+    root.setLevel(logging.INFO)
+    root.addHandler(TruncatingQueueHandler(log_queue))
+
+    levels = {**LOG_LEVELS, **(levels or {}), **parse_levels(os.environ.get(LOG_LEVELS_ENV, ''))}
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+    for name in RATE_LIMITED_LOGGERS:
+        logging.getLogger(name).addFilter(RateLimitFilter())
@@ -0,0 +1,166 @@
+"""
+运行指标：计数器、直方图和采集时计算的指标，以 Prometheus 文本格式通过本地 HTTP 端口提供
+
+记录一次只是几次整数加法，可以在生产环境中一直开启；采集时才生成文本。
+"""
+import asyncio
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger('chat.metrics')
+
+# 读取采集请求的超时（秒），不发送完整请求的连接不会一直占用
+READ_TIMEOUT = 5
+# 采集请求最多的请求头行数
+MAX_HEADER_LINES = 100
+
+# 默认的耗时分桶（秒）
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """单调递增的计数，label 为标签名，inc 时给出标签值"""
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for label_value, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            labels = ((self.label, label_value),) if self.label else ()
+            yield f'{self.name}{format_labels(labels)} {format_value(value)}'
+
+
+class Histogram:
+    """
+    分桶统计耗时等数值的分布
+    可能在 db 线程中记录，用锁保护；每个桶只记录落在其中的次数，采集时再累加
+    """
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        # {标签值: [各桶次数..., 总和]}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_value)
+            if counts is None:
+                counts = self.values[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+        for label_value, counts in sorted(values.items(), key=lambda item: str(item[0])):
+            base = ((self.label, label_value),) if self.label else ()
+            total = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                total += count
+                yield f'{self.name}_bucket{format_labels((*base, ("le", format_value(bound))))} {total}'
+            yield f'{self.name}_sum{format_labels(base)} {format_value(counts[-1])}'
+            yield f'{self.name}_count{format_labels(base)} {total}'
+
+
+class Gauge:
+    """采集时调用 collect 取值；collect 返回数值，或 {标签值: 数值}"""
+
+    def __init__(self, name, help, collect, label=None, kind='gauge'):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.label = label
+        self.kind = kind
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.kind}'
+        values = self.collect()
+        if not isinstance(values, dict):
+            yield f'{self.name} {format_value(values)}'
+            return
+        for label_value, value in values.items():
+            yield f'{self.name}{format_labels(((self.label, label_value),))} {format_value(value)}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, label=None) -> Counter:
+        return self._add(Counter(name, help, label))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, label=None) -> Histogram:
+        return self._add(Histogram(name, help, buckets, label))
+
+    def gauge(self, name, help, collect, label=None, kind='gauge') -> Gauge:
+        return self._add(Gauge(name, help, collect, label, kind))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"采集指标 {metric.name} 时出错：{e}")
+        return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(registry, host, port):
+    """在 host:port 上提供 GET /metrics，返回 asyncio 服务器"""
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+            # 跳过请求头
+            for _ in range(MAX_HEADER_LINES):
+                if not (await asyncio.wait_for(reader.readline(), READ_TIMEOUT)).strip():
+                    break
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+                status, body = b'200 OK', registry.render().encode('utf-8')
+            else:
+                status, body = b'404 Not Found', b'not found\n'
+            writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"指标端口已启动：http://{host}:{port}/metrics")
+    return server
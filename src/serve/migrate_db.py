@@ -0,0 +1,21 @@
+"""
+就地升级服务端数据库到最新版本
+
+用法：python migrate_db.py [数据库文件，默认 clients.db]
+"""
+import sys
+
+from sqlmg import SqlMG, SERVER_MIGRATIONS
+
+
+def main():
+    database = sys.argv[1] if len(sys.argv) > 1 else 'clients.db'
+    sql = SqlMG(database)
+    before = sql.fetch('PRAGMA user_version')[0][0]
+    sql.sever_sql()
+    print(f"{database}: version {before} -> {len(SERVER_MIGRATIONS)}")
+    sql.close()
+
+
+if __name__ == '__main__':
+    main()
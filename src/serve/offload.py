@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+logger = logging.getLogger('chat.offload')
+
+
+class WorkPool:
+    """有界执行池：排队和执行中的任务总数超过上限时，调用方在事件循环上等待而不是无限堆积"""
+
+    def __init__(self, name, executor, max_pending):
+        self.name = name
+        self.executor = executor
+        self.slots = asyncio.Semaphore(max_pending)
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.busy_time = 0.0
+
+    async def run(self, func, *args):
+        self.waiting += 1
+        async with self.slots:
+            self.waiting -= 1
+            self.running += 1
+            start = time.perf_counter()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+            finally:
+                self.running -= 1
+                self.completed += 1
+                self.busy_time += time.perf_counter() - start
+
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "running": self.running,
+            "completed": self.completed,
+            "busy_time": round(self.busy_time, 3)
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class Offloader:
+    """
+    把阻塞操作移出事件循环
+    db：单线程，SQLite 连接只在这个线程中使用
+    io：线程池，负责磁盘读写和 base64 编解码
+    cpu：进程池，负责 PIL 图片处理；cpu_initializer 在每个子进程启动时调用，例如重新配置日志
+    """
+
+    def __init__(self, io_workers=4, cpu_workers=None, max_pending=64, cpu_initializer=None):
+        self.db = WorkPool('db', ThreadPoolExecutor(max_workers=1, thread_name_prefix='db'), max_pending)
+        self.io = WorkPool('io', ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='io'), max_pending)
+        self.cpu = WorkPool('cpu', ProcessPoolExecutor(max_workers=cpu_workers, initializer=cpu_initializer), max_pending)
+
+    async def run_db(self, func, *args):
+        return await self.db.run(func, *args)
+
+    async def run_io(self, func, *args):
+        return await self.io.run(func, *args)
+
+    async def run_cpu(self, func, *args):
+        return await self.cpu.run(func, *args)
+
+    def stats(self) -> dict:
+        return {pool.name: pool.stats() for pool in (self.db, self.io, self.cpu)}
+
+    def shutdown(self):
+        for pool in (self.cpu, self.io, self.db):
+            pool.shutdown()
+
+
+class LoopLagMonitor:
+    """事件循环延迟监控：定时睡眠，实际醒来时间比预期晚多少就是事件循环被阻塞的时间"""
+
+    def __init__(self, interval=0.5, warn_threshold=0.1):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.last = 0.0
+        self.max = 0.0
+        self.average = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self.last = lag
+            self.max = max(self.max, lag)
+            # 指数滑动平均
+            self.average = self.average * 0.9 + lag * 0.1
+            if lag > self.warn_threshold:
+                logger.warning(f"事件循环延迟 {lag * 1000:.1f} ms")
+
+    def stats(self) -> dict:
+        return {
+            "last_ms": round(self.last * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+            "average_ms": round(self.average * 1000, 3)
+        }
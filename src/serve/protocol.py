@@ -0,0 +1,422 @@
+import functools
+import json
+import struct
+import weakref
+import zlib
+from datetime import datetime
+
+# 二进制帧子协议：客户端在握手时声明该子协议，表示支持二进制图片帧
+BINARY_SUBPROTOCOL = 'chat.bin.v3'
+
+# 二进制帧头：版本(1B) flag(1B) 发送者id(4B) 消息序号(8B) 毫秒时间戳(8B) 用户名长度(2B) 房间名长度(1B)，
+# 随后是用户名、房间名和原始数据
+BINARY_VERSION = 3
+BINARY_HEADER = struct.Struct('!BBIQqHB')
+
+# 紧凑二进制协议：声明该子协议的客户端双向的所有消息都使用紧凑帧（见 CompactCodec），JSON 文本帧仍然可以解析
+COMPACT_SUBPROTOCOL = 'chat.compact.v1'
+
+# 紧凑帧头：flag(1B) 字段位(1B)，随后是用户名、房间名、id、seq、时间、附加字段（按字段位），剩余部分为消息内容
+# 整数为变长编码；用户名和房间名为一个变长整数 n 加可选的字符串：n=0 内联字符串，n=1 定义并加入驻留表，n>=2 引用表中第 n-2 项
+COMPACT_HEADER = struct.Struct('!BB')
+COMPACT_SEQ = 0x01         # 带 seq
+COMPACT_TIME = 0x02        # 带毫秒时间戳
+COMPACT_NAME_ZERO = 0x04   # 用户名为 0（服务端通知），不带用户名字段
+COMPACT_ROOM = 0x08        # 带房间名（非默认房间）
+COMPACT_EXTRA = 0x20       # 带附加字段（JSON 对象），如私聊的 to
+COMPACT_KIND_SHIFT = 6     # 最高两位为消息内容类型
+KIND_TEXT = 0              # UTF-8 文本
+KIND_BYTES = 1             # 原始字节（图片、压缩的批量消息）
+KIND_JSON = 2              # JSON（对象、数组等）
+KIND_UINT = 3              # 非负整数（回执、同步游标），变长编码
+
+# 每个连接每个方向最多驻留的用户名 / 房间名数量
+COMPACT_MAX_INTERNED = 1024
+
+# 消息格式
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+FORMAT_COMPACT = 'compact'
+
+# 默认房间：所有用户都在这个房间中，消息不带 room 字段时属于这里
+DEFAULT_ROOM = 'lobby'
+
+
+def json_create(flag, id, name, message, times, seq=None, room=None):
+    """
+    seq 为服务端分配的消息序号（同步游标），只在已入库的消息上携带
+    room 为消息所属房间，默认房间的消息不带该字段
+
+    | flag | 功能 |
+    | 0 | 普通消息 |
+    | 1 | 登录消息 |
+    | 2 | 注册消息 |
+    | 3 | 服务端心跳包 |
+    | 4 | 客户端心跳包 |
+    | 5 | 离线消息同步请求（客户端）/ 一页同步消息发送完毕（服务端） |
+    | 6 | 客户端确认已收到一页同步消息 |
+    | 7 | 服务端离线消息同步完成 |
+    | 8 | 图片消息 |
+    | 9 | 文件消息 |
+    | 10 | 头像消息 |
+    | 11 | 服务端消息回执 |
+    | 12 | 同步批量消息 |
+    | 13 | 加入房间 |
+    | 14 | 离开房间 |
+    | 15 | 私聊消息 |
+    | 16 | 会话令牌 |
+    | 17 | 文件上传控制（开始、进度确认、完成、出错、取消） |
+    | 18 | 文件分块 |
+    | 19 | 文件下载控制（查询、范围请求、结束、出错、取消） |
+    | 20 | 下载分块 |
+    """
+    msg = {
+        "flag": flag,
+        "id": id,
+        "name": name,
+        "message": message,
+        "timestamp": times
+    }
+    if seq is not None:
+        msg["seq"] = seq
+    if room and room != DEFAULT_ROOM:
+        msg["room"] = room
+    return json.dumps(msg)
+
+
+def now():
+    """返回现在的格式化时间"""
+    return datetime.now().replace(microsecond=0).isoformat()
+
+
+def to_millis(times) -> int:
+    """把 isoformat 字符串或 datetime 转换为毫秒时间戳"""
+    if isinstance(times, str):
+        times = datetime.fromisoformat(times)
+    return int(times.timestamp() * 1000)
+
+
+def from_millis(millis) -> str:
+    """把毫秒时间戳转换为 isoformat 字符串"""
+    return datetime.fromtimestamp(millis / 1000).replace(microsecond=0).isoformat()
+
+
+def binary_create(flag, id, name, payload, times, seq=None, room=None) -> bytes:
+    """
+    生成二进制帧：帧头 + 用户名 + 房间名 + 原始数据（如 JPEG 字节），避免 base64 膨胀；
+    seq 为 0 表示没有序号，房间名为空表示默认房间
+    """
+    name = str(name).encode('utf-8')
+    room = room.encode('utf-8') if room and room != DEFAULT_ROOM else b''
+    header = BINARY_HEADER.pack(BINARY_VERSION, flag, id, seq or 0, to_millis(times), len(name), len(room))
+    return b''.join((header, name, room, payload))
+
+
+def binary_parse(frame) -> dict:
+    """解析二进制帧，返回与 JSON 消息结构相同的字典，message 为原始字节"""
+    version, flag, id, seq, millis, name_len, room_len = BINARY_HEADER.unpack_from(frame)
+    if version != BINARY_VERSION:
+        raise ValueError(f"不支持的二进制帧版本: {version}")
+    offset = BINARY_HEADER.size
+    name = frame[offset:offset + name_len].decode('utf-8')
+    offset += name_len
+    room = frame[offset:offset + room_len].decode('utf-8')
+    msg = {
+        "flag": flag,
+        "id": id,
+        "name": name,
+        "message": frame[offset + room_len:],
+        "timestamp": from_millis(millis)
+    }
+    if seq:
+        msg["seq"] = seq
+    if room:
+        msg["room"] = room
+    return msg
+
+
+def parse_frame(raw_message, codec=None) -> dict:
+    """解析收到的帧，文本帧按 JSON 解析，字节帧按紧凑帧（协商了紧凑协议时，codec 为该连接的编解码器）或二进制帧解析"""
+    if isinstance(raw_message, bytes):
+        if codec is not None:
+            return codec.decode(raw_message)
+        return binary_parse(raw_message)
+    return json.loads(raw_message)
+
+
+def select_subprotocol(connection, offered):
+    """
+    握手时选择子协议（websockets.serve 的 select_subprotocol）：取客户端提供的第一个支持的子协议；
+    旧客户端不提供子协议，或提供的都不支持时返回 None，连接按 JSON 帧通信而不是被拒绝
+    """
+    for subprotocol in offered:
+        if subprotocol in (COMPACT_SUBPROTOCOL, BINARY_SUBPROTOCOL):
+            return subprotocol
+    return None
+
+
+def frame_format(websocket) -> str:
+    """客户端在握手时选择的消息格式"""
+    subprotocol = getattr(websocket, 'subprotocol', None)
+    if subprotocol == COMPACT_SUBPROTOCOL:
+        return FORMAT_COMPACT
+    if subprotocol == BINARY_SUBPROTOCOL:
+        return FORMAT_BINARY
+    return FORMAT_JSON
+
+
+def supports_binary(websocket) -> bool:
+    """客户端是否在握手时声明支持二进制帧（紧凑协议的客户端也支持）"""
+    return frame_format(websocket) != FORMAT_JSON
+
+
+def batch_item(seq, flag, id, name, message, times, room=None) -> str:
+    """把一条同步消息编码为批量帧中的一个元素"""
+    item = {
+        "seq": seq,
+        "flag": flag,
+        "id": id,
+        "name": name,
+        "message": message,
+        "timestamp": times
+    }
+    if room and room != DEFAULT_ROOM:
+        item["room"] = room
+    return json.dumps(item)
+
+
+def batch_create(items, times, compress=False, compact=False):
+    """
+    生成同步批量帧（flag 12），items 为 batch_item 编码好的元素，直接拼接不再重复编码；
+    compress 为 True 时整体 zlib 压缩后作为二进制帧发送，compact 为 True 时使用紧凑帧
+    """
+    array = '[' + ','.join(items) + ']'
+    if compress:
+        create = compact_create if compact else binary_create
+        return create(12, 0, 'server', zlib.compress(array.encode('utf-8')), times)
+    return '{"flag": 12, "id": 0, "name": "server", "message": ' + array + ', "timestamp": ' + json.dumps(times) + '}'
+
+
+# 文件分块（flag 18）的消息内容：上传 id(16B) 偏移(8B) crc32(4B)，随后是分块数据；JSON 格式下整体 base64 编码
+FILE_CHUNK_HEADER = struct.Struct('!16sQI')
+
+
+def chunk_create(upload_id, offset, data) -> bytes:
+    """生成一个文件分块，upload_id 为 32 位十六进制的上传 id"""
+    return FILE_CHUNK_HEADER.pack(bytes.fromhex(upload_id), offset, zlib.crc32(data)) + data
+
+
+def chunk_parse(payload):
+    """解析文件分块，返回 (上传 id, 偏移, crc32, 数据)，数据为 memoryview，不复制分块"""
+    raw_id, offset, crc = FILE_CHUNK_HEADER.unpack_from(payload)
+    return raw_id.hex(), offset, crc, memoryview(payload)[FILE_CHUNK_HEADER.size:]
+
+
+# 下载分块（flag 20）的消息内容：请求号(4B) 偏移(8B) crc32(4B)，随后是分块数据；JSON 格式下整体 base64 编码
+DOWNLOAD_CHUNK_HEADER = struct.Struct('!IQI')
+
+
+def download_chunk_create(request_id, offset, data) -> bytes:
+    """生成一个下载分块，request_id 为客户端在 get 请求中指定的请求号"""
+    return DOWNLOAD_CHUNK_HEADER.pack(request_id, offset, zlib.crc32(data)) + data
+
+
+def download_chunk_parse(payload):
+    """解析下载分块，返回 (请求号, 偏移, crc32, 数据)，数据为 memoryview，不复制分块"""
+    request_id, offset, crc = DOWNLOAD_CHUNK_HEADER.unpack_from(payload)
+    return request_id, offset, crc, memoryview(payload)[DOWNLOAD_CHUNK_HEADER.size:]
+
+
+def encode_varint(value) -> bytes:
+    """无符号 LEB128 变长整数"""
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def read_varint(data, offset):
+    """读取变长整数，返回 (值, 新的偏移)"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_string(text) -> bytes:
+    data = text.encode('utf-8')
+    return encode_varint(len(data)) + data
+
+
+def read_string(data, offset):
+    length, offset = read_varint(data, offset)
+    return bytes(data[offset:offset + length]).decode('utf-8'), offset + length
+
+
+# 时间戳转换涉及 datetime 解析，同一秒内的消息时间戳相同，缓存最近的结果
+_cached_millis = functools.lru_cache(maxsize=256)(to_millis)
+_cached_iso = functools.lru_cache(maxsize=256)(from_millis)
+
+
+def compact_body(id, name, message, times, seq=None, extra=None):
+    """
+    紧凑帧中除用户名和房间名以外的部分：返回 (字段位, 字节串)，同一条消息发给多个连接时只需编码一次
+    id 不是非负整数（如注册时的 None）或用户名既不是字符串也不是 0 时，原值放入附加字段
+    """
+    bits = 0
+    if not isinstance(id, int) or id < 0:
+        extra = {**(extra or {}), "id": id}
+        id = 0
+    if name == 0 and not isinstance(name, str):
+        bits |= COMPACT_NAME_ZERO
+    elif not isinstance(name, str):
+        extra = {**(extra or {}), "name": name}
+    parts = [encode_varint(id)]
+    if seq is not None:
+        bits |= COMPACT_SEQ
+        parts.append(encode_varint(seq))
+    if times:
+        bits |= COMPACT_TIME
+        parts.append(encode_varint(_cached_millis(times)))
+    if extra:
+        bits |= COMPACT_EXTRA
+        parts.append(encode_string(json.dumps(extra)))
+    if isinstance(message, bytes):
+        kind, payload = KIND_BYTES, message
+    elif isinstance(message, str):
+        kind, payload = KIND_TEXT, message.encode('utf-8')
+    elif isinstance(message, int) and not isinstance(message, bool) and message >= 0:
+        kind, payload = KIND_UINT, encode_varint(message)
+    else:
+        kind, payload = KIND_JSON, json.dumps(message).encode('utf-8')
+    parts.append(payload)
+    return bits | kind << COMPACT_KIND_SHIFT, b''.join(parts)
+
+
+class CompactCodec:
+    """
+    一个连接上的紧凑帧编解码器
+    用户名和房间名第一次出现时随帧定义并加入驻留表，之后只发送表中的序号；两个方向各有独立的表。
+    驻留表依赖帧的顺序，intern=True 的帧必须按编码的顺序发送，编码后也不能丢弃（会话的写任务在发送时才编码），
+    不经过发送队列直接发送的帧使用 intern=False，不读写驻留表，任何连接都可以解析
+    """
+
+    def __init__(self, max_interned=COMPACT_MAX_INTERNED):
+        self.max_interned = max_interned
+        self.out_names = {}
+        self.out_rooms = {}
+        self.in_names = []
+        self.in_rooms = []
+
+    def _ref(self, table, text, intern) -> bytes:
+        if intern:
+            index = table.get(text)
+            if index is not None:
+                return encode_varint(index + 2)
+            if len(table) < self.max_interned:
+                table[text] = len(table)
+                return b'\x01' + encode_string(text)
+        return b'\x00' + encode_string(text)
+
+    def encode(self, flag, id, name, message, times, seq=None, room=None, extra=None, intern=True) -> bytes:
+        bits, body = compact_body(id, name, message, times, seq, extra)
+        return self.assemble(flag, bits, name, room, body, intern)
+
+    def assemble(self, flag, bits, name, room, body, intern=True) -> bytes:
+        """在 compact_body 的结果前加上帧头、用户名和房间名"""
+        parts = [b'']
+        if not bits & COMPACT_NAME_ZERO:
+            # 不是字符串的用户名已在附加字段中，这里用空串占位
+            parts.append(self._ref(self.out_names, name if isinstance(name, str) else '', intern))
+        if room and room != DEFAULT_ROOM:
+            bits |= COMPACT_ROOM
+            parts.append(self._ref(self.out_rooms, room, intern))
+        parts[0] = COMPACT_HEADER.pack(flag, bits)
+        parts.append(body)
+        return b''.join(parts)
+
+    def _resolve(self, table, data, offset):
+        ref, offset = read_varint(data, offset)
+        if ref >= 2:
+            return table[ref - 2], offset
+        text, offset = read_string(data, offset)
+        if ref == 1 and len(table) < self.max_interned:
+            table.append(text)
+        return text, offset
+
+    def decode(self, frame) -> dict:
+        """解析紧凑帧，返回与 JSON 消息结构相同的字典"""
+        flag, bits = COMPACT_HEADER.unpack_from(frame)
+        offset = COMPACT_HEADER.size
+        if bits & COMPACT_NAME_ZERO:
+            name = 0
+        else:
+            name, offset = self._resolve(self.in_names, frame, offset)
+        room = None
+        if bits & COMPACT_ROOM:
+            room, offset = self._resolve(self.in_rooms, frame, offset)
+        id, offset = read_varint(frame, offset)
+        msg = {"flag": flag, "id": id, "name": name}
+        if bits & COMPACT_SEQ:
+            msg["seq"], offset = read_varint(frame, offset)
+        millis = 0
+        if bits & COMPACT_TIME:
+            millis, offset = read_varint(frame, offset)
+        msg["timestamp"] = _cached_iso(millis) if millis else 0
+        if room:
+            msg["room"] = room
+        if bits & COMPACT_EXTRA:
+            text, offset = read_string(frame, offset)
+            msg.update(json.loads(text))
+        kind = bits >> COMPACT_KIND_SHIFT
+        if kind == KIND_BYTES:
+            msg["message"] = frame[offset:]
+        elif kind == KIND_TEXT:
+            msg["message"] = frame[offset:].decode('utf-8')
+        elif kind == KIND_UINT:
+            msg["message"], _ = read_varint(frame, offset)
+        else:
+            msg["message"] = json.loads(frame[offset:])
+        return msg
+
+
+# 无状态的编码器：不使用驻留表，编码结果可以发给任何紧凑协议的连接
+_stateless = CompactCodec(max_interned=0)
+
+
+def compact_create(flag, id, name, message, times, seq=None, room=None, extra=None) -> bytes:
+    """生成不依赖驻留表的紧凑帧，可以在多个连接之间共享"""
+    return _stateless.encode(flag, id, name, message, times, seq, room, extra, intern=False)
+
+
+# 各紧凑协议连接的编解码器
+_codecs = weakref.WeakKeyDictionary()
+
+
+def connection_codec(websocket):
+    """返回连接的紧凑帧编解码器，未协商紧凑协议时返回 None"""
+    if frame_format(websocket) != FORMAT_COMPACT:
+        return None
+    codec = _codecs.get(websocket)
+    if codec is None:
+        codec = _codecs[websocket] = CompactCodec()
+    return codec
+
+
+def frame_create(websocket, flag, id, name, message, times, seq=None, room=None, extra=None):
+    """
+    生成直接发送（不经过会话发送队列）的帧：紧凑协议的连接使用不依赖驻留表的紧凑帧，其他连接使用 JSON
+    """
+    if frame_format(websocket) == FORMAT_COMPACT:
+        return compact_create(flag, id, name, message, times, seq, room, extra)
+    msg = json_create(flag, id, name, message, times, seq, room)
+    if extra:
+        msg = json.dumps({**json.loads(msg), **extra})
+    return msg
@@ -0,0 +1,92 @@
+from protocol import DEFAULT_ROOM
+
+# 房间名的最大长度（UTF-8 字节，二进制帧中用 1 字节记录长度）
+ROOM_NAME_MAX_BYTES = 64
+
+# 私聊会话键的前缀，私聊消息以会话键作为房间名保存，不能作为普通房间加入
+DM_PREFIX = 'dm:'
+
+
+def valid_room(room) -> bool:
+    return (isinstance(room, str) and 0 < len(room.encode('utf-8')) <= ROOM_NAME_MAX_BYTES
+            and not room.startswith(DM_PREFIX))
+
+
+def conversation_key(user_id, peer_id) -> str:
+    """两个用户之间的私聊会话键，与顺序无关"""
+    low, high = sorted((int(user_id), int(peer_id)))
+    return f'{DM_PREFIX}{low}:{high}'
+
+
+def conversation_members(room) -> tuple:
+    """私聊会话键中的两个用户 id，不是会话键时返回空元组"""
+    if not isinstance(room, str) or not room.startswith(DM_PREFIX):
+        return ()
+    try:
+        low, high = room[len(DM_PREFIX):].split(':')
+        return int(low), int(high)
+    except ValueError:
+        return ()
+
+
+class RoomIndex:
+    """
+    房间成员索引，只包含本进程中已连接的会话
+    room → 会话集合，投递消息时只遍历该房间的成员；session → 房间集合，用于断开时清理和确定同步范围。
+    所有会话都在默认房间中，且不能离开。成员关系的持久化由调用方负责（room_members 表）。
+    """
+
+    def __init__(self):
+        self.members = {}
+        self.joined = {}
+
+    def add(self, session, rooms=()):
+        """登录时加入默认房间和已保存的房间"""
+        self.joined[session] = set()
+        self.join(session, DEFAULT_ROOM)
+        for room in rooms:
+            self.join(session, room)
+
+    def join(self, session, room) -> bool:
+        """加入房间，返回是否为新加入"""
+        rooms = self.joined.setdefault(session, set())
+        if room in rooms:
+            return False
+        rooms.add(room)
+        self.members.setdefault(room, set()).add(session)
+        return True
+
+    def leave(self, session, room) -> bool:
+        """离开房间，返回是否确实离开了（默认房间不能离开）"""
+        rooms = self.joined.get(session)
+        if room == DEFAULT_ROOM or not rooms or room not in rooms:
+            return False
+        rooms.discard(room)
+        self._discard(session, room)
+        return True
+
+    def remove(self, session):
+        """连接断开时移出所有房间"""
+        for room in self.joined.pop(session, ()):
+            self._discard(session, room)
+
+    def _discard(self, session, room):
+        sessions = self.members.get(room)
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del self.members[room]
+
+    def sessions(self, room):
+        """房间中本进程的会话"""
+        return self.members.get(room, ())
+
+    def rooms_of(self, session):
+        """会话所在的房间，未登录时只有默认房间"""
+        return self.joined.get(session) or {DEFAULT_ROOM}
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self.members),
+            "memberships": sum(len(rooms) for rooms in self.joined.values())
+        }
@@ -1,123 +1,242 @@
 #!/usr/bin/python3
+import argparse
 import asyncio
 import base64
-import json
+import bisect
+import contextlib
 import websockets
 import logging
-from datetime import datetime
 import os
 import hashlib
+import heapq
+import json
+import signal
 import ssl
-import io
-from PIL import Image
+import sys
+import tempfile
+import time
+
+from sqlmg import SqlMG, DURABILITY_GROUPED, DURABILITY_PER_MESSAGE
+from offload import Offloader, LoopLagMonitor
+from blobstore import BlobStore
+from filestore import FileStore, UploadError, read_range
+from idgen import MessageIdGenerator
+from watermark import CommitWatermark, WATERMARK_ROOM
+from liveness import HeartbeatScheduler
+from imagecache import ImageCache
+from bus import LocalBus, BrokerBus, Broker
+from session import ClientSession, DROP_OLDEST
+from rooms import RoomIndex, valid_room, conversation_key, conversation_members
+from tokens import TokenStore, TOKEN_SECRET_ENV, load_secret
+from history import RecentHistory
+from metrics import Registry, serve_metrics
+from logconfig import setup_logging, setup_process_logging
+from compression import DeflatePolicy, deflate_extensions, deflate_extension, configure_deflate, DEFLATE_WINDOW_BITS
+from protocol import json_create, now, to_millis, from_millis, binary_create, parse_frame, \
+    batch_item, batch_create, chunk_parse, download_chunk_create, frame_create, frame_format, compact_body, compact_create, connection_codec, \
+    select_subprotocol, \
+    BINARY_SUBPROTOCOL, COMPACT_SUBPROTOCOL, DEFAULT_ROOM, FILE_CHUNK_HEADER, FORMAT_JSON, FORMAT_BINARY, FORMAT_COMPACT
+
+# 日志：连接和会话写入 chat.server，每条收发消息写入 chat.traffic（默认不输出），在启动时配置
+logger = logging.getLogger('chat.server')
+traffic = logging.getLogger('chat.traffic')
+
+# 监听地址和端口
+HOST = 'localhost'
+PORT = 9998
+
+# 指标端口（Prometheus 文本格式，只监听本机），默认不开启，用 --metrics-port 指定；多进程模式下各 worker 依次使用后面的端口
+METRICS_HOST = 'localhost'
+METRICS_PORT = 0
 
-from sqlmg import SqlMG
+# 发送队列深度分布的分桶
+QUEUE_DEPTH_BUCKETS = (0, 1, 4, 16, 64, 256)
 
-# 配置日志
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# worker 进程数，大于 1 时由主进程启动多个共用监听端口的 worker（SO_REUSEPORT，仅 Linux/BSD）
+WORKERS = 1
 
 # 消息大小限制（10MB）
 MAX_MESSAGE_SIZE = 10 * 1024 * 1024
 
-MAX_IMAGE_SIZE = (1920, 1080)
+# 文件分块大小：客户端按服务端在开始上传时回复的大小发送
+FILE_CHUNK_SIZE = 256 * 1024
+
+# 单个文件的大小上限
+FILE_MAX_SIZE = 16 * 1024 ** 3
+
+# 没有完成的上传保留多久（秒），之后删除已上传的部分
+FILE_UPLOAD_TTL = 7 * 24 * 3600
+
+# 清理没有被消息引用的图片的间隔（秒）
+BLOB_GC_INTERVAL = 24 * 3600
+
+# 每个连接同时进行的下载范围数
+DOWNLOAD_MAX_STREAMS = 8
+
+# 同步用压缩图的内存缓存容量（字节）
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+# 每个客户端发送队列的最大长度
+OUTBOUND_QUEUE_SIZE = 256
+
+# 发送队列满时的策略：drop_oldest / drop_noncritical / disconnect
+SLOW_CONSUMER_POLICY = DROP_OLDEST
+
+# 磁盘读写线程数
+IO_WORKERS = 4
+
+# 图片处理进程数（None 表示使用 CPU 核数）
+CPU_WORKERS = None
+
+# 每个执行池中排队和执行中的任务上限
+MAX_PENDING_JOBS = 64
+
+# 消息持久化模式：per_message / grouped / os_buffered
+DB_DURABILITY = DURABILITY_GROUPED
+
+# 分组提交：攒够多少条立即提交
+DB_BATCH_ROWS = 200
+
+# 分组提交：最长多久提交一次（毫秒）
+DB_FLUSH_INTERVAL_MS = 50
+
+# 离线消息同步每页的消息数，客户端确认一页后才发送下一页
+SYNC_PAGE_SIZE = 1000
+
+# 每个房间在内存中保留的最近消息数，游标落在这个范围内的同步请求不查询数据库
+HISTORY_PER_ROOM = 1000
+
+# 同步批量帧的大小上限（字节，压缩前）
+SYNC_BATCH_BYTES = 256 * 1024
+
+# 同步批量帧是否整体 zlib 压缩（只对支持二进制帧、且没有协商 permessage-deflate 的客户端生效）
+SYNC_BATCH_COMPRESS = True
+
+# 心跳方式：ping 使用 websocket 原生 ping/pong，json 向客户端发送 flag 3 心跳包
+HEARTBEAT_PING = 'ping'
+HEARTBEAT_JSON = 'json'
+HEARTBEAT_MODE = HEARTBEAT_PING
+
+# 连接空闲多久后发送一次探测（秒）
+HEARTBEAT_INTERVAL = 30
+
+# 连接空闲多久后判定离线（秒）
+HEARTBEAT_TIMEOUT = 60
 
-IMAGE_QUALITY = 85
 # ssl证书
 current_dir = os.path.dirname(os.path.abspath(__file__))
 cert_path = os.path.join(current_dir, 'serve_source', 'cert.pem')
 key_path = os.path.join(current_dir, 'serve_source', 'key.pem')
 
-# 已连接的客户端集合
+# 已连接的客户端会话 {user_id: ClientSession}
 connected_clients = {}
 
-# 客户端心跳信息
-client_heartbeats = {}
+# 本进程中各房间的成员会话
+rooms = RoomIndex()
 
-# SQLite数据库设置
-sql = SqlMG('clients.db')
-sql.sever_sql()
+# 会话令牌，断线重连时凭令牌恢复会话
+tokens = TokenStore(load_secret())
 
-def json_create(flag, id, name, message, times):
-    """
-    | flag | 功能 |
-    | 0 | 普通消息 |
-    | 1 | 登录消息 |
-    | 2 | 注册消息 |
-    | 3 | 服务端心跳包 |
-    | 4 | 客户端心跳包 |
-    | 5 | 服务端同步离线消息 |
-    | 6 | 客户端离线消息同步请求 |
-    | 7 | 服务端离线消息同步完成 |
-    | 8 | 图片消息 |
-    | 9 | 文件消息 |
-    """
-    msg = {
-        "flag": flag,
-        "id": id,
-        "name": name,
-        "message": message,
-        "timestamp": times
-    }
-    return json.dumps(msg)
-
-def compress_image(image_path):
-    """压缩图片"""
-    try:
-        # 打开图片
-        with Image.open(image_path) as img:
-            # 转换为RGB模式（如果是RGBA，去除透明通道）
-            if img.mode in ('RGBA', 'P'):
-                img = img.convert('RGB')
-
-            # 调整图片大小
-            if img.size[0] > MAX_IMAGE_SIZE[0] or img.size[1] > MAX_IMAGE_SIZE[1]:
-                img.thumbnail(MAX_IMAGE_SIZE, Image.Resampling.LANCZOS)
-
-                # 保存到内存中
-            output = io.BytesIO()
-            img.save(output, format='JPEG', quality=IMAGE_QUALITY, optimize=True)
-            compressed_data = output.getvalue()
-
-            # 检查压缩后的大小
-            if len(compressed_data) > MAX_MESSAGE_SIZE:
-                logging.error(f"图片压缩后仍然超过大小限制: {len(compressed_data)} bytes > {MAX_MESSAGE_SIZE} bytes")
-                return None
-
-            return compressed_data
-    except Exception as e:
-        logging.error(f"压缩图片时出错: {e}")
-        return None
+# 各房间最近的消息，由消息总线的事件填充
+history = RecentHistory(HISTORY_PER_ROOM)
 
-def pic_msg(msg, user_id):
-    """处理图片消息"""
-    # 确保/pic/文件夹存在，用于存储图片
-    pic_folder = os.path.join(current_dir, 'pic')
-    if not os.path.exists(pic_folder):
-        os.makedirs(pic_folder)
+# permessage-deflate 的压缩策略：图片和小消息不压缩，按 flag 统计压缩率和耗时
+deflate_policy = DeflatePolicy()
 
-    image_data = msg['message']  # 图片数据，假设是base64编码
-    image_name = f"image_{user_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}.jpg"
-    image_path = os.path.join(pic_folder, image_name)
+# 数据库、执行池和依赖它们的仓库在启动时由 open_database / start_offload 创建，导入本模块时不打开任何资源：
+# spawn / forkserver 方式启动的图片处理子进程会以 __mp_main__ 重新导入本模块
+# SQLite 连接在启动后只在 offload 的 db 线程中使用
+sql = None
+# 消息 id 在入库前分配，同时作为客户端的同步游标
+message_ids = None
+# 阻塞操作的执行层
+offload = None
+# 图片仓库：按内容哈希去重存储
+blob_store = None
+# 同步用压缩图缓存
+image_cache = None
+# 分块上传的文件仓库
+file_store = None
 
-    # 解码图片并保存到磁盘
-    with open(image_path, 'wb') as img_file:
-        img_file.write(base64.b64decode(image_data))  # 假设是base64编码的图片
+loop_monitor = LoopLagMonitor()
 
-    return image_path
+# 运行指标，采集时才计算的指标在 register_gauges 中登记
+metrics = Registry()
+messages_received = metrics.counter('chat_messages_received_total', '收到的客户端消息数', 'flag')
+fanout_seconds = metrics.histogram('chat_broadcast_fanout_seconds', '一条广播放入本进程房间成员发送队列的耗时')
+sql_seconds = metrics.histogram('chat_sqlite_statement_seconds', 'SQLite 语句耗时', label='kind')
+image_seconds = metrics.histogram('chat_image_processing_seconds', '图片消息的处理耗时', label='stage')
 
-# 检查客户端心跳状态
-async def check_client_heartbeats():
-    """检查客户端心跳状态"""
-    while True:
-        current_time = datetime.now()
-        for user_id, last_heartbeat in list(client_heartbeats.items()):
-            # 计算时间差（秒）
-            time_diff = (current_time - last_heartbeat).total_seconds()
-            if time_diff > 60:  # 超过60秒未收到心跳包
-                logging.info(f"客户端 {user_id} 超过60秒未发送心跳包，标记为离线。")
-                connected_clients.pop(user_id, None)
-                client_heartbeats.pop(user_id, None)
-        await asyncio.sleep(10)  # 每10秒检查一次
+def open_database():
+    """打开数据库并升级结构，创建消息 id 生成器和依赖数据库的仓库"""
+    global sql, message_ids, blob_store, file_store
+    sql = SqlMG('clients.db', check_same_thread=False, durability=DB_DURABILITY, batch_rows=DB_BATCH_ROWS)
+    sql.sever_sql()
+    sql.on_statement = lambda kind, seconds: sql_seconds.observe(seconds, kind)
+    message_ids = MessageIdGenerator(0, sql.fetch('SELECT MAX(id) AS id FROM messages')[0]['id'] or 0)
+    blob_store = BlobStore(os.path.join(current_dir, 'pic'), sql)
+    file_store = FileStore(os.path.join(current_dir, 'files'), sql, FILE_CHUNK_SIZE, FILE_MAX_SIZE)
+
+def start_offload():
+    """创建执行池和同步用压缩图缓存，在 open_database 之后调用"""
+    global offload, image_cache
+    offload = Offloader(IO_WORKERS, CPU_WORKERS, MAX_PENDING_JOBS, setup_process_logging)
+    image_cache = ImageCache(blob_store, offload, IMAGE_CACHE_BYTES)
+
+def image_bytes(msg) -> bytes:
+    """取出图片消息中的原始图片数据：二进制帧直接是字节，旧的 JSON 帧是 base64 文本"""
+    image_data = msg['message']
+    if isinstance(image_data, bytes):
+        return image_data
+    return base64.b64decode(image_data)
+
+def image_frame(flag, sender_id, sender_name, image_data, times, fmt, seq=None, room=None):
+    """生成图片帧：支持二进制帧的客户端直接发送原始字节（紧凑帧或二进制帧），旧客户端使用 base64 JSON"""
+    if fmt == FORMAT_COMPACT:
+        return compact_create(flag, sender_id, sender_name, image_data, times, seq, room)
+    if fmt == FORMAT_BINARY:
+        return binary_create(flag, sender_id, sender_name, image_data, times, seq, room)
+    return json_create(flag, sender_id, sender_name, base64.b64encode(image_data).decode('utf-8'), times, seq, room)
+
+async def pic_msg(image_data):
+    """处理图片消息：按内容哈希存入图片仓库并预先生成同步用压缩图，返回图片摘要"""
+    start = time.perf_counter()
+    digest = await offload.run_io(blob_store.write, image_data)
+    await offload.run_db(blob_store.add_ref, digest, len(image_data))
+    stored = time.perf_counter()
+    image_seconds.observe(stored - start, 'store')
+    await image_cache.warm(digest)
+    image_seconds.observe(time.perf_counter() - stored, 'compress')
+    return digest
+
+# 心跳探测与离线判定
+async def ping_session(session):
+    """发送 websocket ping，收到 pong 时记录一次活跃"""
+    try:
+        pong_waiter = await session.websocket.ping()
+        await pong_waiter
+        heartbeats.touch(session)
+    except websockets.ConnectionClosed:
+        pass
+
+def probe_session(session):
+    """向空闲的客户端发送心跳探测"""
+    if HEARTBEAT_MODE == HEARTBEAT_PING:
+        asyncio.create_task(ping_session(session))
+    else:
+        session.enqueue(session.encode(3, 0, 0, "heartbeat", now()), critical=False)
+        traffic.debug(f"向客户端 {session.user_id} 发送心跳包")
+
+def expire_session(session):
+    """客户端超时未响应，标记为离线并断开连接"""
+    logger.info(f"客户端 {session.user_id} 超过{HEARTBEAT_TIMEOUT}秒没有响应，标记为离线。")
+    if connected_clients.get(session.user_id) is session:
+        connected_clients.pop(session.user_id, None)
+    rooms.remove(session)
+    session.abort(1011, 'heartbeat timeout')
+
+# 客户端存活检测：只在连接的截止时间到达时才检查该连接
+heartbeats = HeartbeatScheduler(probe_session, expire_session, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
 
 # 验证客户端的用户ID和密码
 def authenticate_client(user_id, password) -> bool:
@@ -140,169 +259,966 @@ def register_client(username, password) -> int | None:
         result = sql.fetch('SELECT user_id FROM clients WHERE username = ?', (username,))
         return result[0]['user_id'] if result else None
     except Exception as e:
-        logging.error(f"Error: {e}")
+        logger.error(f"Error: {e}")
         return None
 
-def now():
-    """返回现在的格式化时间"""
-    return datetime.now().replace(microsecond=0).isoformat()
-
 # 存储消息记录
-def store_message(message):
-    """存储消息记录"""
-    sql.exec("INSERT INTO messages (sender_id, sender_username, message, timestamp, type) VALUES (?, ?, ?, ?, ?)",
-             ( message['id'], message['name'], message['message'], datetime.fromisoformat(message['timestamp']), message['flag']))
+def store_message(message, message_id, room):
+    """存储消息记录，message_id 由 message_ids 预先分配"""
+    sql.queue("INSERT INTO messages (id, sender_id, sender_username, message, timestamp, type, room) VALUES (?, ?, ?, ?, ?, ?, ?)",
+             (message_id, message['id'], message['name'], message['message'], to_millis(message['timestamp']), message['flag'],
+              room))
+
+# 房间成员关系
+def load_rooms(user_id) -> list:
+    """用户加入过的房间（不含默认房间）"""
+    return [row['room'] for row in sql.fetch("SELECT room FROM room_members WHERE user_id = ?", (user_id,))]
+
+def save_membership(user_id, room, joined):
+    if joined:
+        sql.exec("INSERT OR IGNORE INTO room_members (room, user_id) VALUES (?, ?)", (room, user_id))
+    else:
+        sql.exec("DELETE FROM room_members WHERE room = ? AND user_id = ?", (room, user_id))
 
+# 私聊会话
+# 已记录过的会话键，只在 db 线程中访问
+known_conversations = set()
+
+def open_conversation(user_id, peer_id) -> str | None:
+    """返回两人的私聊会话键；第一次对话时确认对方存在并为双方记录会话，对方不存在时返回 None"""
+    if not isinstance(peer_id, int) or peer_id == user_id:
+        return None
+    room = conversation_key(user_id, peer_id)
+    if room in known_conversations:
+        return room
+    if not sql.fetch("SELECT 1 FROM clients WHERE user_id = ?", (peer_id,)):
+        return None
+    for owner, peer in ((user_id, peer_id), (peer_id, user_id)):
+        sql.queue("INSERT OR IGNORE INTO conversations (user_id, peer_id, room) VALUES (?, ?, ?)", (owner, peer, room))
+    known_conversations.add(room)
+    return room
 
-# 定期向客户端发送心跳包
-async def send_heartbeats():
-    """定期向客户端发送心跳包"""
+def load_conversations(user_id) -> list:
+    """用户参与的所有私聊会话键"""
+    return [row['room'] for row in sql.fetch("SELECT room FROM conversations WHERE user_id = ?", (user_id,))]
+
+
+# 定期提交排队的消息写入
+async def flush_messages():
+    """分组提交模式下，定时把排队的消息写入数据库；多进程模式下提交后通过消息总线发布本进程的已提交水位"""
     while True:
-        for user_id, client in connected_clients.items():
-            try:
-                await client.send(json_create(3, 0, 0, "heartbeat", now()))
-                logging.info(f"向客户端 {user_id} 发送心跳包")
-            except websockets.ConnectionClosed:
-                logging.info(f"客户端 {user_id} 连接已关闭，移除客户端")
-                connected_clients.pop(user_id, None)
-                client_heartbeats.pop(user_id, None)
-        await asyncio.sleep(30)  # 每30秒发送一次心跳包
+        await asyncio.sleep(DB_FLUSH_INTERVAL_MS / 1000)
+        written = watermark.take_written()
+        await offload.run_db(sql.flush)
+        if sql.retrying:
+            # 数据库暂时不可写，写入留在队列中等待重试，对应的 id 还不能计入水位
+            watermark.requeue(written)
+        else:
+            watermark.commit(written)
+        if watermark.peers:
+            bus.publish({"type": "watermark", "room": WATERMARK_ROOM, "node": message_ids.node_id,
+                         "id": watermark.local()})
+
+@contextlib.contextmanager
+def new_message_id():
+    """
+    分配消息 id，在 with 块中入库并发布到消息总线；块结束之前集群水位不会越过这个 id，
+    分组提交时要等到下一次提交之后
+    """
+    message_id = message_ids.next()
+    watermark.begin(message_id)
+    try:
+        yield message_id
+    finally:
+        if sql.durability == DURABILITY_PER_MESSAGE:
+            watermark.commit([message_id])
+        else:
+            watermark.queued(message_id)
+
+
+def open_session(user_id, websocket, saved_rooms, token):
+    """登录或恢复成功后创建会话，加入连接表、房间索引和存活检测"""
+    session = ClientSession(user_id, websocket, OUTBOUND_QUEUE_SIZE, SLOW_CONSUMER_POLICY).start()
+    session.token = token
+    connected_clients[user_id] = session
+    rooms.add(session, saved_rooms)
+    heartbeats.add(session)
+    return session
+
+def announce_online(user_id, username):
+    """
+    广播上线通知：以登录用户的 user_id 发布，各进程投递时跳过本人；
+    多进程模式下总线在会话加入房间之后才投递，以 0 发布时通知会发回给刚登录的用户
+    """
+    broadcast(user_id, username, f"用户{username}已上线", 1)
+
+def issue_token(user_id, username):
+    """签发会话令牌，并通知其他服务进程，客户端重连到任一进程都可以恢复"""
+    token, expires = tokens.issue(user_id, username)
+    bus.publish({"type": "token", "nonce": tokens.nonce(token), "user_id": user_id, "username": username,
+                 "expires": expires})
+    return token, expires
+
+def suspend_token(session, cursor):
+    """会话断开时通知所有服务进程记录令牌的游标和房间，客户端重连到任一进程都能从这里继续"""
+    bus.publish({"type": "suspend", "nonce": tokens.nonce(session.token), "cursor": cursor,
+                 "rooms": list(rooms.rooms_of(session))})
+
+def rotate_token(token, user_id, username):
+    """恢复会话成功后吊销旧令牌并签发新令牌，同一个令牌不能恢复出多个会话"""
+    nonce = tokens.nonce(token)
+    # 先在本进程吊销，同一进程上并发的恢复请求不会等到总线投递之后
+    tokens.revoke(nonce)
+    bus.publish({"type": "revoke", "nonce": nonce})
+    return issue_token(user_id, username)
 
 # WebSocket连接处理函数
 async def handler(websocket):
+    user_id = None
+    session = None
+    codec = connection_codec(websocket)
+    configure_deflate(websocket, frame_format(websocket))
+    # 本连接上进行中的上传 {上传 id: 状态}
+    uploads = {}
+    # 本连接上正在发送的下载范围 {请求号: 任务}
+    downloads = {}
     try:
         try:
-            user_id = None
             async for raw_message in websocket:
-                msg = json.loads(raw_message)
+                msg = parse_frame(raw_message, codec)
                 flag = msg.get("flag")
-                logging.info(msg)
+                messages_received.inc(flag if isinstance(flag, int) and 0 <= flag < 32 else 'other')
+                traffic.debug("收到消息", extra={"fields": {"user_id": user_id, "flag": flag, "bytes": len(raw_message)}})
+                if session is not None:
+                    # 收到任何消息都说明连接存活
+                    heartbeats.touch(session)
 
                 if flag == 4 and user_id is not None:  # 客户端心跳
-                    client_heartbeats[user_id] = datetime.now()
-                    logging.info(f"收到心跳：{user_id}")
+                    traffic.debug(f"收到心跳：{user_id}")
                     continue
 
                 elif flag == 1:  # 登录
                     user_id = msg['id']
                     username = msg['name']
                     password = msg['message']
-                    if authenticate_client(user_id, password):
-                        await websocket.send(json_create(1, 0, 'server', 'LOGIN_SUCCESS', now()))
-                        await broadcast(0, username, f"用户{username}已上线", 1)
-                        logging.info(f"客户端已登录：{user_id}")
+                    if await offload.run_db(authenticate_client, user_id, password):
+                        await websocket.send(frame_create(websocket, 1, 0, 'server', 'LOGIN_SUCCESS', now()))
+                        token, expires = issue_token(user_id, username)
+                        await websocket.send(frame_create(websocket, 16, 0, 'server',
+                                                          {"status": "ISSUED", "token": token, "expires": expires}, now()))
+                        announce_online(user_id, username)
+                        logger.info(f"客户端已登录：{user_id}")
 
-                        connected_clients[user_id] = websocket
-                        client_heartbeats[user_id] = datetime.now()
+                        saved_rooms = await offload.run_db(load_rooms, user_id)
+                        session = open_session(user_id, websocket, saved_rooms, token)
 
                     else:
-                        await websocket.send(json_create(1, 0, 'server', 'LOGIN_FAIL', now()))
+                        await websocket.send(frame_create(websocket, 1, 0, 'server', 'LOGIN_FAIL', now()))
                         await websocket.close()
                         return
 
+                elif flag == 16 and session is None:  # 凭令牌恢复会话
+                    request = msg['message'] if isinstance(msg['message'], dict) else {}
+                    token = request.get('token')
+                    entry = tokens.validate(token)
+                    if entry is None:
+                        await websocket.send(frame_create(websocket, 16, 0, 'server', {"status": "RESUME_FAIL"}, now()))
+                        continue
+                    user_id = entry['user_id']
+                    token, expires = rotate_token(token, user_id, entry['username'])
+                    await websocket.send(frame_create(websocket, 16, 0, 'server',
+                                                      {"status": "RESUMED", "token": token, "expires": expires}, now()))
+                    saved_rooms = entry['rooms']
+                    if saved_rooms is None:
+                        # 令牌由其他服务进程签发，这里还没有记录过房间
+                        saved_rooms = await offload.run_db(load_rooms, user_id)
+                    session = open_session(user_id, websocket, saved_rooms, token)
+                    logger.info(f"客户端已凭令牌恢复会话：{user_id}")
+                    # 不再广播上线通知，直接从客户端确认过的游标开始发送断线期间错过的消息
+                    cursor = parse_cursor(request.get('cursor') or entry['cursor'])
+                    if cursor is None:
+                        await reject_sync(websocket, request.get('cursor'))
+                        continue
+                    await send_sync_page(user_id, cursor, websocket, await sync_rooms(session, user_id))
+
                 elif flag == 2:  # 注册
                     username = msg['name']
                     password = msg['message']
-                    user_id = register_client(username, password)
+                    user_id = await offload.run_db(register_client, username, password)
                     if user_id is not None:
-                        await websocket.send(json_create(2, user_id, username, 'REGISTERED', now()))
-                        logging.info(f'register user with id:{user_id}')
+                        await websocket.send(frame_create(websocket, 2, user_id, username, 'REGISTERED', now()))
+                        logger.info(f'register user with id:{user_id}')
                     else:
-                        await websocket.send(json_create(2, user_id, username, 'REGISTERED_FAIL', now()))
-                        logging.info(f"注册请求失败")
+                        await websocket.send(frame_create(websocket, 2, user_id, username, 'REGISTERED_FAIL', now()))
+                        logger.info(f"注册请求失败")
 
                 elif flag == 10 and user_id is not None:
                     sender_username = msg['name']
-                    await broadcast(user_id, sender_username, msg['message'], 10)
+                    broadcast(user_id, sender_username, await offload.run_io(image_bytes, msg), 10)
                 elif flag == 5 and user_id is not None:  # 同步离线消息
-                    await refresh_msg(user_id, msg['message'], websocket)
+                    request = msg['message']
+                    if isinstance(request, dict):
+                        # 按游标分页同步：先发送第一页，之后每收到一次确认再发送下一页
+                        # 带 peer 时只同步与该用户的私聊会话
+                        cursor = request.get('cursor')
+                        peer = request.get('peer')
+                        if cursor is None:
+                            # 同步完成时游标会发给客户端，不能越过其他进程还没有提交的消息
+                            mark = watermark.cluster()
+                            cursor = min(await offload.run_db(cursor_after_time, request.get('time')), mark)
+                        if parse_cursor(cursor) is None or (peer is not None and parse_cursor(peer) is None):
+                            await reject_sync(websocket, request)
+                            continue
+                        room_list = await sync_rooms(session, user_id, peer)
+                        await send_sync_page(user_id, parse_cursor(cursor), websocket, room_list, peer)
+                    else:
+                        # 旧客户端：按时间同步，不等待确认
+                        await refresh_msg(user_id, request, websocket, await sync_rooms(session, user_id))
+
+                elif flag == 6 and user_id is not None:  # 客户端确认已收到一页同步消息
+                    ack = msg['message']
+                    peer = ack.get('peer') if isinstance(ack, dict) else None
+                    cursor = parse_cursor(ack.get('cursor') if isinstance(ack, dict) else ack)
+                    if cursor is None or (peer is not None and parse_cursor(peer) is None):
+                        await reject_sync(websocket, ack)
+                        continue
+                    await send_sync_page(user_id, cursor, websocket, await sync_rooms(session, user_id, peer), peer)
+
+                elif flag == 13 and session is not None:  # 加入房间
+                    room = msg['message']
+                    if valid_room(room):
+                        if rooms.join(session, room) and room != DEFAULT_ROOM:
+                            await offload.run_db(save_membership, user_id, room, True)
+                        session.enqueue(session.encode(13, 0, 'server', {"room": room, "status": "JOINED"}, now()))
+                    else:
+                        session.enqueue(session.encode(13, 0, 'server', {"room": room, "status": "JOIN_FAIL"}, now()))
+
+                elif flag == 14 and session is not None:  # 离开房间
+                    room = msg['message']
+                    if rooms.leave(session, room):
+                        await offload.run_db(save_membership, user_id, room, False)
+                        session.enqueue(session.encode(14, 0, 'server', {"room": room, "status": "LEFT"}, now()))
+                    else:
+                        session.enqueue(session.encode(14, 0, 'server', {"room": room, "status": "LEAVE_FAIL"}, now()))
+
+                elif flag == 15 and session is not None:  # 私聊消息
+                    peer_id = msg.get('to')
+                    room = await offload.run_db(open_conversation, user_id, peer_id)
+                    if room is None:
+                        session.enqueue(session.encode(15, 0, 'server', {"to": peer_id, "status": "NO_SUCH_USER"}, now()))
+                    else:
+                        with new_message_id() as message_id:
+                            await offload.run_db(store_message, msg, message_id, room)
+                            send_direct(user_id, msg['name'], peer_id, msg['message'], message_id, room)
+                        send_receipt(session, user_id, message_id)
+
+                elif flag == 17 and session is not None:  # 文件上传控制
+                    await upload_control(session, user_id, msg, uploads)
+
+                elif flag == 18 and session is not None:  # 文件分块
+                    await upload_chunk(session, user_id, msg, uploads)
+
+                elif flag == 19 and session is not None:  # 文件下载控制
+                    await download_control(session, msg, downloads)
+
+                elif flag in (0, 8) and user_id is not None and not in_room(session, msg):
+                    logger.warning(f"用户 {user_id} 不在房间 {msg.get('room')} 中，消息被拒绝")
+                    if session is not None:
+                        # 与回执走同一个发送队列，客户端据此按顺序对应自己发送的消息
+                        session.enqueue(session.encode(13, 0, 'server', {"room": msg.get('room'), "status": "NOT_MEMBER"},
+                                                       now()))
 
                 elif flag == 0 and user_id is not None:  # 普通消息
                     sender_username = msg['name']
-                    store_message(msg)
-                    await broadcast(user_id, sender_username, msg['message'])
+                    room = msg.get('room') or DEFAULT_ROOM
+                    with new_message_id() as message_id:
+                        await offload.run_db(store_message, msg, message_id, room)
+                        broadcast(user_id, sender_username, msg['message'], seq=message_id, room=room)
+                    send_receipt(session, user_id, message_id)
 
                 # 处理图片消息
                 elif flag == 8 and user_id is not None:  # 图片消息
-                    image_path = pic_msg(msg, user_id)
-                    img_data = msg['message']
-                    msg['message'] = image_path
+                    img_data = await offload.run_io(image_bytes, msg)
+                    msg['message'] = await pic_msg(img_data)
                     sender_username = msg['name']
-                    # 将图片路径存入数据库
-                    store_message(msg)
-                    # 广播图片消息给所有客户端
-                    await broadcast(user_id, sender_username, img_data, 8)
+                    room = msg.get('room') or DEFAULT_ROOM
+                    # 将图片摘要存入数据库
+                    with new_message_id() as message_id:
+                        await offload.run_db(store_message, msg, message_id, room)
+                        # 广播图片消息给房间中的客户端
+                        broadcast(user_id, sender_username, img_data, 8, seq=message_id, room=room,
+                                  digest=msg['message'])
+                    send_receipt(session, user_id, message_id)
 
                 else:
-                    logging.warning(f"未知 flag：{flag}")
+                    logger.warning(f"未知 flag：{flag}")
 
         except websockets.ConnectionClosed as e:
-            logging.info(f"客户端连接已关闭 (用户ID：{user_id})：{e}")
+            logger.info(f"客户端连接已关闭 (用户ID：{user_id})：{e}")
+    finally:
+        for task in downloads.values():
+            task.cancel()
+        if session is not None:
+            session.close()
+            heartbeats.remove(session)
+            # 投递过的消息之前可能还有其他进程没有提交的消息，恢复时从集群水位之前继续，重复的消息由客户端去重
+            suspend_token(session, min(session.last_seq, watermark.cluster()))
+            rooms.remove(session)
+            # 同一用户可能已经重新登录，只移除属于本连接的会话
+            if connected_clients.get(user_id) is session:
+                connected_clients.pop(user_id, None)
+            logger.info(f"已将客户端从连接列表中移除 (用户ID：{user_id})")
+
+# 分块上传
+def upload_reply(session, upload_id, op, **fields):
+    """回复上传控制消息（flag 17），与其他回复走同一个发送队列"""
+    session.enqueue(session.encode(17, 0, 'server', {"op": op, "upload": upload_id, **fields}, now()))
+
+async def upload_control(session, user_id, msg, uploads):
+    """
+    start：开始或继续一次上传，回复客户端应当从哪个字节继续发送以及分块大小；
+    仓库中已有相同内容时不需要发送任何分块，直接完成。cancel：放弃一次上传
+    """
+    request = msg['message'] if isinstance(msg['message'], dict) else {}
+    upload_id = request.get('upload')
+    op = request.get('op')
+    if op == 'cancel':
+        uploads.pop(upload_id, None)
+        await offload.run_db(file_store.cancel, str(upload_id), user_id)
+        upload_reply(session, upload_id, 'cancelled')
+        return
+    if op != 'start':
+        upload_reply(session, upload_id, 'error', reason='BAD_REQUEST')
+        return
+    room = request.get('room') or DEFAULT_ROOM
+    if room not in rooms.rooms_of(session):
+        upload_reply(session, upload_id, 'error', reason='NOT_MEMBER')
+        return
+    try:
+        offset = await offload.run_db(file_store.begin, upload_id, user_id, request.get('name'), request.get('size'),
+                                      request.get('digest'), room)
+    except UploadError as e:
+        upload_reply(session, upload_id, 'error', reason=e.reason)
+        return
+    uploads[upload_id] = {"size": request['size'], "digest": request['digest'], "room": room, "offset": offset,
+                          "rejected": False}
+    upload_reply(session, upload_id, 'offset', offset=offset, chunk_size=FILE_CHUNK_SIZE)
+    logger.info("开始上传", extra={"fields": {"user_id": user_id, "upload": upload_id, "size": request['size'],
+                                             "offset": offset}})
+    if offset == request['size']:
+        await finish_upload(session, user_id, msg['name'], upload_id, uploads)
+
+async def upload_chunk(session, user_id, msg, uploads):
+    """
+    写入一个分块并确认。写入完成前不读取这个连接的下一条消息，客户端在途的分块数也有上限，
+    服务端每个连接同时只持有一个分块，磁盘变慢时由 TCP 反压让客户端放慢。
+    偏移不连续或校验失败时只回复一次出错，之后丢弃不连续的分块，直到客户端从出错的位置重新发送
+    """
+    payload = msg['message']
+    if not isinstance(payload, bytes):
+        payload = await offload.run_io(base64.b64decode, payload)
+    if len(payload) < FILE_CHUNK_HEADER.size:
+        upload_reply(session, None, 'error', reason='BAD_CHUNK')
+        return
+    upload_id, offset, crc, data = chunk_parse(payload)
+    upload = uploads.get(upload_id)
+    if upload is None:
+        upload_reply(session, upload_id, 'error', reason='UNKNOWN_UPLOAD')
+        return
+    if offset != upload['offset']:
+        if not upload['rejected']:
+            upload['rejected'] = True
+            upload_reply(session, upload_id, 'error', reason='OFFSET', offset=upload['offset'])
+        return
+    try:
+        upload['offset'] = await offload.run_io(file_store.write_chunk, upload_id, upload['size'], offset, data, crc)
+    except UploadError as e:
+        if e.reason == 'UNKNOWN_UPLOAD':
+            # 已上传的部分已被清理，之后的分块都按未知上传回复
+            uploads.pop(upload_id, None)
+        else:
+            upload['rejected'] = True
+        upload_reply(session, upload_id, 'error', reason=e.reason, offset=e.offset)
+        return
+    upload['rejected'] = False
+    upload_reply(session, upload_id, 'ack', offset=upload['offset'])
+    if upload['offset'] == upload['size']:
+        await finish_upload(session, user_id, msg['name'], upload_id, uploads)
+
+async def finish_upload(session, user_id, username, upload_id, uploads):
+    """校验整个文件并移入仓库，作为 flag 9 消息入库并广播到房间；message 为文件信息的 JSON 文本"""
+    upload = uploads.pop(upload_id)
+    try:
+        await offload.run_io(file_store.finish, upload_id, upload['digest'])
+    except UploadError as e:
+        await offload.run_db(file_store.cancel, upload_id, user_id)
+        upload_reply(session, upload_id, 'error', reason=e.reason)
+        return
+    with new_message_id() as message_id:
+        info = json.dumps(await offload.run_db(file_store.complete, upload_id, message_id))
+        msg = {"id": user_id, "name": username, "message": info, "timestamp": now(), "flag": 9}
+        await offload.run_db(store_message, msg, message_id, upload['room'])
+        broadcast(user_id, username, info, 9, seq=message_id, room=upload['room'])
+    # 文件完成的时间与发送顺序无关，不发送 flag 11 回执，客户端从 done 中取得消息序号
+    upload_reply(session, upload_id, 'done', file=message_id)
+    logger.info("上传完成", extra={"fields": {"user_id": user_id, "upload": upload_id, "file": message_id}})
+
+async def expire_uploads():
+    """定时删除长时间没有完成的上传"""
+    while True:
+        await offload.run_db(file_store.expire, FILE_UPLOAD_TTL)
+        await asyncio.sleep(3600)
+
+async def collect_blobs():
+    """定时按消息的实际引用校正图片引用计数，删除没有被引用的图片及其压缩图"""
+    while True:
+        await asyncio.sleep(BLOB_GC_INTERVAL)
+        await offload.run_db(blob_store.collect_garbage)
+
+# 按范围下载
+def locate_download(file_id):
+    """
+    找到文件 id 对应的内容（db 线程）：分块上传的文件，或图片消息（id 为消息序号，内容为原图）
+    返回 {"path", "name", "size", "digest", "room"}，没有时返回 None
+    """
+    info = file_store.lookup(file_id)
+    if info is not None:
+        return info
+    rows = sql.fetch("SELECT message, room FROM messages WHERE id = ? AND type = 8", (file_id,))
+    if not rows:
+        return None
+    ref = rows[0]['message']
+    path = blob_store.locate(ref)
+    if not os.path.exists(path):
+        return None
+    return {"path": path, "name": f'{file_id}.jpg', "size": os.path.getsize(path),
+            "digest": ref if blob_store.is_digest(ref) else None, "room": rows[0]['room']}
+
+def may_download(session, room) -> bool:
+    """文件所在的房间是会话已加入的房间，或会话用户参与的私聊会话"""
+    return room in rooms.rooms_of(session) or session.user_id in conversation_members(room)
+
+def download_reply(session, request_id, op, **fields):
+    """回复下载控制消息（flag 19），与其他回复走同一个发送队列"""
+    session.enqueue(session.encode(19, 0, 'server', {"op": op, "req": request_id, **fields}, now()))
+
+async def download_control(session, msg, downloads):
+    """
+    stat：查询文件的名称、大小和摘要；get：发送文件中 [offset, offset + length) 的内容，
+    同一个连接上可以同时进行多个范围，各由一个任务发送；cancel：停止发送一个范围。
+    请求号由客户端指定，回复和分块都带上请求号
+    """
+    request = msg['message'] if isinstance(msg['message'], dict) else {}
+    request_id = request.get('req')
+    op = request.get('op')
+    if op == 'cancel':
+        task = downloads.pop(request_id, None)
+        if task is not None:
+            task.cancel()
+        return
+    file_id = request.get('file')
+    if op not in ('stat', 'get') or not isinstance(request_id, int) or not 0 <= request_id < 2 ** 32 \
+            or not isinstance(file_id, int):
+        download_reply(session, request_id, 'error', reason='BAD_REQUEST')
+        return
+    info = await offload.run_db(locate_download, file_id)
+    if info is None or not may_download(session, info['room']):
+        # 不在房间中的用户与文件不存在得到相同的回复
+        download_reply(session, request_id, 'error', reason='NOT_FOUND')
+        return
+    if op == 'stat':
+        download_reply(session, request_id, 'info', file=file_id, name=info['name'], size=info['size'],
+                       digest=info['digest'])
+        return
+    offset = request.get('offset', 0)
+    length = request.get('length', info['size'] - offset)
+    if not isinstance(offset, int) or not isinstance(length, int) or not 0 <= offset <= info['size'] or length < 0:
+        download_reply(session, request_id, 'error', reason='BAD_RANGE')
+        return
+    if request_id in downloads or len(downloads) >= DOWNLOAD_MAX_STREAMS:
+        download_reply(session, request_id, 'error', reason='BUSY')
+        return
+    end = min(offset + length, info['size'])
+    downloads[request_id] = asyncio.create_task(stream_range(session, request_id, info['path'], offset, end,
+                                                             downloads))
+    traffic.debug("开始发送下载范围", extra={"fields": {"user_id": session.user_id, "file": file_id,
+                                                        "offset": offset, "end": end}})
+
+async def stream_range(session, request_id, path, offset, end, downloads):
+    """
+    按分块从磁盘读取并发送一个范围，内存中只有当前的一个分块。
+    分块不进入会话的发送队列，直接调用 websocket.send：发送缓冲区满时在这里等待，由 TCP 反压控制读取速度；
+    聊天消息由发送队列在分块之间插入，大文件不会长时间占用连接。发送完后回复 end
+    """
+    websocket = session.websocket
+    fmt = frame_format(websocket)
+    try:
+        while offset < end:
+            data = await offload.run_io(read_range, path, offset, min(FILE_CHUNK_SIZE, end - offset))
+            if not data:
+                # 文件比记录的短
+                break
+            await websocket.send(image_frame(20, 0, 'server', download_chunk_create(request_id, offset, data), now(),
+                                             fmt))
+            offset += len(data)
+        download_reply(session, request_id, 'end', offset=offset)
+    except websockets.ConnectionClosed:
+        pass
     finally:
-        if user_id is not None:
-            connected_clients.pop(user_id, None)
-            client_heartbeats.pop(user_id, None)
-            logging.info(f"已将客户端从连接列表中移除 (用户ID：{user_id})")
-
-async def broadcast(sender_user_id, sender_username, message, flag = 0):
-    """广播消息给所有已连接的客户端"""
-    for user_id, client in connected_clients.items():
-        if user_id == sender_user_id:
+        if downloads.get(request_id) is asyncio.current_task():
+            del downloads[request_id]
+
+def in_room(session, msg) -> bool:
+    """消息的目标房间是否为发送者已加入的房间"""
+    return (msg.get('room') or DEFAULT_ROOM) in rooms.rooms_of(session)
+
+def send_receipt(session, user_id, message_id):
+    """通知发送者消息已入库及其序号，客户端据此记录序号，同步时不会重复收到自己的消息"""
+    if session is not None:
+        session.enqueue(session.encode(11, user_id, 'server', message_id, now()))
+
+def broadcast(sender_user_id, sender_username, message, flag = 0, seq=None, room=DEFAULT_ROOM, digest=None):
+    """把消息发布到消息总线，由总线投递给每个服务进程中该房间的客户端；digest 为已入库图片的摘要"""
+    header = {"type": "broadcast", "room": room, "sender_id": sender_user_id, "sender_name": sender_username,
+              "flag": flag, "seq": seq, "times": now()}
+    if digest is not None:
+        header["digest"] = digest
+    if isinstance(message, bytes):
+        bus.publish(header, message)
+    else:
+        header["message"] = message
+        bus.publish(header)
+
+def send_direct(sender_user_id, sender_username, peer_id, message, seq, room):
+    """把私聊消息发布到消息总线，接收者所在的服务进程直接按 user_id 找到其会话"""
+    bus.publish({"type": "direct", "room": room, "to": peer_id, "sender_id": sender_user_id,
+                 "sender_name": sender_username, "message": message, "seq": seq, "times": now()})
+
+def on_bus_event(header, payload):
+    """处理消息总线投递的事件（包括本进程自己发布的）"""
+    if header.get("type") == "broadcast":
+        message = header["message"] if "message" in header else payload
+        room = header.get("room", DEFAULT_ROOM)
+        if header["seq"]:
+            history.record(header["seq"], header["flag"], header["sender_id"], header["sender_name"],
+                           header.get("digest", message), header["times"], room)
+        start = time.perf_counter()
+        deliver(header["sender_id"], header["sender_name"], message, header["flag"], header["seq"], header["times"],
+                room)
+        fanout_seconds.observe(time.perf_counter() - start)
+    elif header.get("type") == "direct":
+        history.record(header["seq"], 15, header["sender_id"], header["sender_name"], header["message"],
+                       header["times"], header["room"])
+        session = connected_clients.get(header["to"])
+        if session is not None:
+            session.enqueue(session.encode(15, header["sender_id"], header["sender_name"], header["message"],
+                                           header["times"], header["seq"], header["room"]), seq=header["seq"])
+    elif header.get("type") == "token":
+        tokens.remember(header["nonce"], header["user_id"], header["username"], header["expires"])
+    elif header.get("type") == "suspend":
+        tokens.suspend(header["nonce"], header["cursor"], header["rooms"])
+    elif header.get("type") == "revoke":
+        tokens.revoke(header["nonce"])
+    elif header.get("type") == "watermark":
+        watermark.report(header["node"], header["id"])
+    elif header.get("type") == "gap":
+        # 可能有消息没有经过本进程，缓冲中已有的消息不再完整
+        history.reset()
+
+def deliver(sender_user_id, sender_username, message, flag, seq, times, room=DEFAULT_ROOM):
+    """
+    把消息投递给本进程中该房间的成员，开销只与房间成员数有关
+    每种消息格式只编码一次，使用同一格式的接收者共享同一个帧对象；只放入各客户端的发送队列，不等待发送。
+    紧凑协议的文字消息只共享用户名、房间名以外的部分，各会话按自己的驻留表补上帧头
+    """
+    members = rooms.sessions(room)
+    if flag in (8, 10):
+        # 图片按客户端能力分别编码：紧凑帧、二进制帧与 base64 JSON 帧各最多编码一次
+        frames = {}
+        for session in members:
+            if session.user_id == sender_user_id:
+                continue
+            frame = frames.get(session.format)
+            if frame is None and flag == 8 and seq and session.format == FORMAT_COMPACT:
+                # 紧凑协议的客户端按 id 下载已入库的图片（flag 19），这里只发送引用
+                frame = frames[session.format] = compact_create(flag, sender_user_id, sender_username,
+                                                                {"file": seq, "size": len(message)}, times, seq, room)
+            elif frame is None:
+                frame = frames[session.format] = image_frame(flag, sender_user_id, sender_username, message, times,
+                                                             session.format, seq, room)
+            session.enqueue(frame, seq=seq)
+        traffic.debug("广播图片消息", extra={"fields": {"room": room, "members": len(members), "seq": seq}})
+        return
+
+    if flag == 1:
+        # 上线通知：以服务端名义发送，不带序号和房间
+        out_flag, out_id, out_name, out_seq, out_room = 0, 0, 0, None, None
+        critical = False
+    elif flag in (0, 9):
+        out_flag, out_id, out_name, out_seq, out_room = flag, sender_user_id, sender_username, seq, room
+        critical = True
+    else:
+        return
+
+    frame = None
+    body = None
+    for session in members:
+        if session.user_id == sender_user_id:
             continue
-        if flag == 0:
-            msg = json_create(flag, sender_user_id, sender_username, message, now())
-            await client.send(msg)
-            logging.info(f"向客户端 {user_id} 广播消息：{msg}")
-        elif flag == 1:
-            msg = json_create(0, 0, 0, message, now())
-            await client.send(msg)
-        elif flag == 8 or flag == 10:
-            msg = json_create(flag, sender_user_id, sender_username, message, now())
-            await client.send(msg)
-            logging.info(f"向客户端 {user_id} 广播图片消息")
+        if session.codec is not None:
+            if body is None:
+                body = compact_body(out_id, out_name, message, times, out_seq)
+            session.enqueue(session.compact_frame(out_flag, body[0], out_name, out_room, body[1]), critical, out_seq)
+        else:
+            if frame is None:
+                frame = json_create(out_flag, out_id, out_name, message, times, out_seq, out_room)
+            session.enqueue(frame, critical, out_seq)
+    if flag == 0:
+        traffic.debug("广播消息", extra={"fields": {"room": room, "members": len(members), "seq": seq}})
 
-#应当放在连接建立处，与客户端进行通讯拿到时间后查询再返回
-async def refresh_msg(user_id, last_time, websocket):
-    """"给客户端同步消息"""
-    last_time = datetime.fromisoformat(last_time)
-
-    logging.info(f"开始向客户端 {user_id} 同步离线消息，自 {last_time}")
-    result = sql.fetch("""
-        SELECT sender_id, sender_username, message, timestamp, type 
-        FROM messages 
-        WHERE timestamp > ? 
-        ORDER BY timestamp
-    """, (last_time,))
-
-    for row in result:
+# 消息总线：单进程运行时在进程内投递，多个服务进程之间通过消息代理转发（见 main）
+bus = LocalBus(on_bus_event)
+
+# 已提交水位：发给客户端的游标不越过任何进程还没有提交的消息；多进程模式下由 main 按对端节点号重新创建
+watermark = CommitWatermark()
+
+def cursor_after_time(last_time) -> int:
+    """把旧的时间戳同步点换算为消息游标：返回该时间之后第一条消息之前的位置"""
+    if not last_time or last_time == -1:
+        return 0
+    result = sql.fetch("SELECT id FROM messages WHERE timestamp > ? ORDER BY timestamp, id LIMIT 1",
+                       (to_millis(last_time),))
+    if result:
+        return result[0]['id'] - 1
+    return sql.fetch('SELECT MAX(id) AS id FROM messages')[0]['id'] or 0
+
+def fetch_sync_page(cursor, room_list):
+    """
+    取出游标之后、用户所在房间中的一页消息
+    每个房间用 (room, id) 索引各取一页再按 id 归并，开销只与这些房间的消息数有关
+    """
+    pages = [sql.fetch_page("""
+        SELECT id, sender_id, sender_username, message, timestamp, type, room
+        FROM messages
+        WHERE room = ? AND id > ?
+        ORDER BY id
+        LIMIT ?
+    """, (room, cursor, SYNC_PAGE_SIZE), SYNC_PAGE_SIZE) for room in room_list]
+    return list(heapq.merge(*pages, key=lambda row: row['id']))[:SYNC_PAGE_SIZE]
+
+async def sync_page_rows(cursor, room_list) -> list:
+    """取出游标之后的一页同步消息：缓冲覆盖的房间直接从内存读取，其余房间查询数据库"""
+    pages, missing = history.split(cursor, room_list)
+    if missing:
+        pages.append(await offload.run_db(fetch_sync_page, cursor, missing))
+    return list(heapq.merge(*pages, key=lambda row: row['id']))[:SYNC_PAGE_SIZE]
+
+async def committed_page_rows(cursor, room_list) -> list:
+    """
+    取出游标之后的一页同步消息，只保留不超过集群已提交水位的部分，结束游标不会越过其他进程还没有提交的消息；
+    水位在读取之前取得，读到的消息都不大于它时这一页是完整的。第一条消息就超过水位时等待水位前进
+    """
+    while True:
+        mark = watermark.cluster()
+        rows = await sync_page_rows(cursor, room_list)
+        if not rows or rows[0]['id'] <= mark:
+            return rows[:bisect.bisect_right(rows, mark, key=lambda row: row['id'])]
+        await asyncio.sleep(DB_FLUSH_INTERVAL_MS / 1000)
+
+async def send_sync_rows(rows, websocket, fmt):
+    """逐条发送同步消息，每条消息都携带 seq"""
+    for row in rows:
         sender_id = row['sender_id']
         sender_name = row['sender_username']
         message = row['message']
-        timestamp = row['timestamp']
+        timestamp = from_millis(row['timestamp'])
         flag = row['type']
-        if flag == 8:
-            message = compress_image(message)
-            message = base64.b64encode(message).decode('utf-8')
-        msg = json_create(flag, sender_id, sender_name, message, timestamp)
+        if flag == 8 and fmt == FORMAT_COMPACT:
+            # 紧凑协议的客户端按 id 下载图片，同步中只发送引用
+            msg = compact_create(flag, sender_id, sender_name, {"file": row['id']}, timestamp, row['id'], row['room'])
+        elif flag == 8:
+            image_data = await image_cache.get(message)
+            if image_data is None:
+                continue
+            msg = image_frame(flag, sender_id, sender_name, image_data, timestamp, fmt, row['id'], row['room'])
+        else:
+            msg = frame_create(websocket, flag, sender_id, sender_name, message, timestamp, row['id'], row['room'])
         await websocket.send(msg)
 
-    await websocket.send(json_create(7, 0, "server", "sync_complete", now()))
+async def send_sync_batches(rows, websocket, fmt):
+    """
+    把一页同步消息中的文字消息按字节预算打包为批量帧发送，一帧携带多条消息；
+    图片消息仍单独发送，发送前先发出已打包的文字消息以保持顺序
+    """
+    # 协商了 permessage-deflate 的连接由连接级压缩处理批量帧，共享压缩上下文，不再单独 zlib 压缩
+    compress = fmt != FORMAT_JSON and SYNC_BATCH_COMPRESS and deflate_extension(websocket) is None
+    items = []
+    size = 0
+
+    async def send_batch():
+        nonlocal items, size
+        if items:
+            await websocket.send(batch_create(items, now(), compress, fmt == FORMAT_COMPACT))
+            items = []
+            size = 0
+
+    for row in rows:
+        if row['type'] == 8:
+            await send_batch()
+            await send_sync_rows([row], websocket, fmt)
+            continue
+        if 'item' in row.keys():
+            # 来自内存缓冲的消息已经编码好
+            item = row['item']
+        else:
+            item = batch_item(row['id'], row['type'], row['sender_id'], row['sender_username'], row['message'],
+                              from_millis(row['timestamp']), row['room'])
+        if items and size + len(item) > SYNC_BATCH_BYTES:
+            await send_batch()
+        items.append(item)
+        size += len(item) + 1
+    await send_batch()
+
+def parse_cursor(value) -> int | None:
+    """客户端发来的游标或用户 id：SQLite 整数范围内的非负整数或其十进制字符串，无效时返回 None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, str) and value.isdecimal():
+        value = int(value)
+    return value if isinstance(value, int) and 0 <= value < 1 << 63 else None
+
+async def reject_sync(websocket, request):
+    """同步请求的游标无效：以 flag 7 结束这次同步并说明原因，不关闭连接"""
+    logger.warning(f"无效的同步游标：{request!r}")
+    await websocket.send(frame_create(websocket, 7, 0, "server", {"status": "BAD_CURSOR"}, now()))
+
+async def sync_rooms(session, user_id, peer=None) -> list:
+    """
+    同步范围：用户所在的房间和参与的私聊会话；指定 peer 时只包含与该用户的私聊会话
+    """
+    if peer is not None:
+        return [conversation_key(user_id, peer)]
+    return [*rooms.rooms_of(session), *await offload.run_db(load_conversations, user_id)]
+
+async def send_sync_page(user_id, cursor, websocket, room_list, peer=None):
+    """
+    发送游标之后、同步范围内的一页离线消息，并以 flag 5 通知客户端这一页的结束游标；
+    客户端保存游标后回复 flag 6 确认，再发送下一页，断线后可以从最后确认的游标继续。
+    按会话同步（peer 不为 None）时结束游标为 {"cursor": 游标, "peer": peer}，确认时原样回复
+    """
+    rows = await committed_page_rows(cursor, list(room_list))
+    if not rows:
+        traffic.info(f"客户端 {user_id} 同步完成，游标 {cursor}")
+        await websocket.send(frame_create(websocket, 7, 0, "server", "sync_complete", now(), cursor))
+        return
+    await send_sync_batches(rows, websocket, frame_format(websocket))
+    last_id = rows[-1]['id']
+    traffic.info(f"向客户端 {user_id} 发送一页同步消息 {len(rows)} 条，游标 {cursor} -> {last_id}")
+    end = last_id if peer is None else {"cursor": last_id, "peer": peer}
+    await websocket.send(frame_create(websocket, 5, 0, "server", end, now()))
+
+#应当放在连接建立处，与客户端进行通讯拿到时间后查询再返回
+async def refresh_msg(user_id, last_time, websocket, room_list):
+    """"给旧客户端按时间同步消息，按页读取数据库，不等待确认"""
+    fmt = frame_format(websocket)
+    traffic.info(f"开始向客户端 {user_id} 同步离线消息，自 {last_time}")
+    cursor = await offload.run_db(cursor_after_time, last_time)
+    while True:
+        rows = await sync_page_rows(cursor, list(room_list))
+        if not rows:
+            break
+        await send_sync_rows(rows, websocket, fmt)
+        cursor = rows[-1]['id']
+
+    await websocket.send(frame_create(websocket, 7, 0, "server", "sync_complete", now()))
+
 
+def queue_depths() -> dict:
+    """各会话发送队列深度的累计分布：深度不超过 le 的会话数"""
+    depths = sorted(len(session.queue) for session in connected_clients.values())
+    buckets = {bound: bisect.bisect_right(depths, bound) for bound in QUEUE_DEPTH_BUCKETS}
+    buckets['+Inf'] = len(depths)
+    return buckets
+
+def register_gauges():
+    """登记采集时才计算的指标"""
+    metrics.gauge('chat_connected_sessions', '已登录的连接数', lambda: len(connected_clients))
+    metrics.gauge('chat_outbound_queue_depth', '发送队列深度不超过 le 的会话数', queue_depths, 'le')
+    metrics.gauge('chat_outbound_queue_depth_max', '最深的发送队列长度',
+                  lambda: max((len(session.queue) for session in connected_clients.values()), default=0))
+    metrics.gauge('chat_outbound_dropped', '已连接会话因队列已满丢弃的消息数',
+                  lambda: sum(session.dropped for session in connected_clients.values()))
+    metrics.gauge('chat_event_loop_lag_seconds', '事件循环延迟', lambda: {
+        "last": loop_monitor.last, "max": loop_monitor.max, "average": loop_monitor.average}, 'stat')
+    metrics.gauge('chat_offload_waiting', '执行池中等待的任务数',
+                  lambda: {name: pool['waiting'] for name, pool in offload.stats().items()}, 'pool')
+    metrics.gauge('chat_offload_running', '执行池中执行中的任务数',
+                  lambda: {name: pool['running'] for name, pool in offload.stats().items()}, 'pool')
+    metrics.gauge('chat_sync_history_lookups_total', '同步时按房间查询内存缓冲的次数',
+                  lambda: {"hit": history.hits, "miss": history.misses}, 'result', kind='counter')
+    metrics.gauge('chat_room_count', '本进程中有成员的房间数', lambda: rooms.stats()['rooms'])
+    stats = deflate_policy.stats
+    for field, text in (('messages', '经过 permessage-deflate 的发送消息数'),
+                        ('skipped', '按压缩策略没有压缩的发送消息数'),
+                        ('raw_bytes', '发送消息压缩前的字节数'),
+                        ('wire_bytes', '发送消息压缩后的字节数'),
+                        ('seconds', '压缩发送消息的 CPU 耗时（秒）'),
+                        ('in_messages', '收到的压缩消息数'),
+                        ('in_raw_bytes', '收到的压缩消息解压后的字节数'),
+                        ('in_wire_bytes', '收到的压缩消息解压前的字节数'),
+                        ('in_seconds', '解压收到的消息的 CPU 耗时（秒）')):
+        metrics.gauge(f'chat_deflate_{field}_total', text, lambda field=field: stats.collect(field), 'flag',
+                      kind='counter')
+
+def stop_on_signals(stop):
+    """收到 SIGINT/SIGTERM 时设置 stop，让进程正常退出并提交排队的写入（Windows 不支持，保持默认行为）"""
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:
+            pass
 
 # 主函数
-async def main():
+async def main(host=HOST, port=PORT, node_id=0, bus_address=None, worker=False, metrics_port=METRICS_PORT,
+               deflate_window_bits=DEFLATE_WINDOW_BITS, peers=()):
+    """
+    运行一个服务进程
+    bus_address 不为 None 时连接该地址的消息代理，与连接同一代理的其他服务进程组成同一个聊天室；
+    node_id 在这些进程之间必须互不相同，各自分配的消息 id 才不会冲突。
+    worker 为 True 时由 supervise 启动：与其他 worker 共用监听端口（SO_REUSEPORT），主进程退出时随之退出
+    metrics_port 不为 0 时在本机该端口上提供 /metrics
+    deflate_window_bits 为 permessage-deflate 的滑动窗口位数，0 表示不压缩
+    peers 为共用数据库、连接同一代理的其他服务进程的节点号，同步游标不会越过它们还没有提交的消息
+    """
+    global bus, watermark
+
     # 配置 SSL 上下文
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ssl_context.load_cert_chain(cert_path, key_path)
 
+    stop = asyncio.Event()
+    stop_on_signals(stop)
+    waits = [asyncio.create_task(stop.wait())]
+    if worker:
+        waits.append(asyncio.create_task(wait_parent_exit()))
+
+    register_gauges()
+    message_ids.node_id = node_id
+    watermark = CommitWatermark(peers)
+    if bus_address is not None:
+        bus = BrokerBus(bus_address, on_bus_event)
+        await bus.start()
+    asyncio.create_task(bus.run())
+
     # 启动心跳检查任务
-    asyncio.create_task(check_client_heartbeats())
-    asyncio.create_task(send_heartbeats())
+    asyncio.create_task(heartbeats.run())
+    asyncio.create_task(loop_monitor.run())
+    asyncio.create_task(flush_messages())
+    asyncio.create_task(tokens.run())
+    asyncio.create_task(expire_uploads())
+    asyncio.create_task(collect_blobs())
+    if metrics_port:
+        await serve_metrics(metrics, METRICS_HOST, metrics_port)
 
     # 启动 WebSocket 服务器
-    async with websockets.serve(handler, "localhost", 9998, ssl=ssl_context, max_size=MAX_MESSAGE_SIZE):
-        logging.info("WebSocket 服务器已启动，监听端口 9998")
-        await asyncio.Future()  # 运行直到被取消
+    # 心跳由 heartbeats 统一调度，关闭 websockets 为每个连接单独运行的 keepalive 任务
+    async with websockets.serve(handler, host, port, ssl=ssl_context, max_size=MAX_MESSAGE_SIZE,
+                                subprotocols=[COMPACT_SUBPROTOCOL, BINARY_SUBPROTOCOL],
+                                select_subprotocol=select_subprotocol, ping_interval=None,
+                                compression=None, extensions=deflate_extensions(deflate_policy, deflate_window_bits),
+                                reuse_port=worker):
+        logger.info(f"WebSocket 服务器已启动，监听端口 {port}，节点 {node_id}")
+        await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)  # 运行直到收到退出信号
+    bus.close()
+
+async def wait_parent_exit():
+    """worker 的标准输入是连接主进程的管道，读到 EOF 说明主进程已退出"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    await reader.read()
+
+async def supervise(workers, host=HOST, port=PORT, node_id=0, bus_address=None, metrics_port=METRICS_PORT,
+                    deflate_window_bits=DEFLATE_WINDOW_BITS):
+    """
+    多进程模式的主进程：启动 workers 个共用监听端口的 worker 进程，节点号依次为 node_id+1 ... node_id+workers，
+    指标端口依次为 metrics_port+1 ... metrics_port+workers
+    没有指定外部消息代理时，在主进程中运行一个代理供 worker 使用。
+    数据库结构已在启动时由主进程升级完成（open_database），worker 启动时不会同时执行迁移
+    """
+    # worker 共用令牌签名密钥，客户端重连到任一 worker 都能通过校验
+    os.environ.setdefault(TOKEN_SECRET_ENV, os.urandom(32).hex())
+    broker = None
+    if bus_address is None:
+        bus_address = os.path.join(tempfile.gettempdir(), f'chat-bus-{port}.sock')
+        broker = Broker(bus_address)
+        await broker.start()
+
+    processes = [
+        await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__),
+                                             '--host', host, '--port', str(port), '--worker',
+                                             '--node-id', str(node_id + index + 1), '--bus', bus_address,
+                                             '--metrics-port', str(metrics_port + index + 1 if metrics_port else 0),
+                                             '--deflate-window-bits', str(deflate_window_bits),
+                                             '--peers', *(str(node_id + other + 1) for other in range(workers)
+                                                          if other != index),
+                                             stdin=asyncio.subprocess.PIPE)
+        for index in range(workers)
+    ]
+    logger.info(f"已启动 {workers} 个 worker，监听端口 {port}")
+    stop = asyncio.Event()
+    stop_on_signals(stop)
+    try:
+        # 收到退出信号，或任一 worker 意外退出时，结束整个服务
+        exits = [asyncio.create_task(process.wait()) for process in processes]
+        await asyncio.wait([asyncio.create_task(stop.wait()), *exits], return_when=asyncio.FIRST_COMPLETED)
+        if not stop.is_set():
+            logger.error("有 worker 退出，停止服务")
+    finally:
+        for process in processes:
+            if process.returncode is None:
+                process.terminate()
+        for process in processes:
+            await process.wait()
+        if broker is not None:
+            broker.close()
+            os.remove(bus_address)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='聊天服务器')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='worker 进程数，大于 1 时以多进程模式运行（需要支持 SO_REUSEPORT 的系统）')
+    parser.add_argument('--node-id', type=int, default=0,
+                        help='节点号，连接同一消息代理的服务进程必须各不相同')
+    parser.add_argument('--bus', default=None,
+                        help='消息代理地址（unix socket 路径或 host:port），多个服务进程通过它组成同一个聊天室')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='指标端口（Prometheus 文本格式，只监听本机），默认为 0，不开启')
+    parser.add_argument('--deflate-window-bits', type=int, default=DEFLATE_WINDOW_BITS, choices=[0, *range(9, 16)],
+                        help='permessage-deflate 的滑动窗口位数，越小每个连接占用的内存越少，0 表示不压缩')
+    parser.add_argument('--peers', type=int, nargs='*', default=[],
+                        help='共用数据库、连接同一消息代理的其他服务进程的节点号')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    args = parse_args()
+    setup_logging()
+    # 多进程模式下主进程在启动 worker 之前完成迁移，只有 worker 创建执行池
+    open_database()
+    try:
+        if args.workers > 1 and not args.worker:
+            asyncio.run(supervise(args.workers, args.host, args.port, args.node_id, args.bus, args.metrics_port,
+                                  args.deflate_window_bits))
+        else:
+            start_offload()
+            asyncio.run(main(args.host, args.port, args.node_id, args.bus, args.worker, args.metrics_port,
+                             args.deflate_window_bits, args.peers))
+    finally:
+        # 先等待执行池中的任务完成，再提交剩余的排队写入
+        if offload is not None:
+            offload.shutdown()
+        sql.close()
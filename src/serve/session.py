@@ -0,0 +1,135 @@
+import asyncio
+import collections
+import logging
+
+import websockets
+
+from protocol import supports_binary, frame_format, connection_codec, json_create, compact_body
+
+logger = logging.getLogger('chat.session')
+
+# 慢消费者策略：发送队列满时的处理方式
+DROP_OLDEST = 'drop_oldest'            # 丢弃队列中最旧的消息
+DROP_NONCRITICAL = 'drop_noncritical'  # 丢弃非关键消息（心跳、上线通知等）
+DISCONNECT = 'disconnect'              # 直接断开该客户端
+POLICIES = (DROP_OLDEST, DROP_NONCRITICAL, DISCONNECT)
+
+# 还没有补上用户名、房间名的紧凑帧，由写任务在发送前组装
+PendingFrame = collections.namedtuple('PendingFrame', 'flag bits name room body')
+
+
+class ClientSession:
+    """
+    客户端会话：每个连接拥有一个有界发送队列，由独立的写任务负责发送。
+    广播只把消息放入队列而不等待发送，慢客户端不会拖累其他客户端。
+    """
+
+    def __init__(self, user_id, websocket, max_queue=256, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"未知的慢消费者策略: {policy}")
+        self.user_id = user_id
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.policy = policy
+        self.binary = supports_binary(websocket)
+        self.format = frame_format(websocket)
+        # 紧凑协议的编解码器，帧在写任务发送前才组装，驻留表只记录确实发出的定义
+        self.codec = connection_codec(websocket)
+        self.queue = collections.deque()
+        self.wakeup = asyncio.Event()
+        self.dropped = 0
+        self.closed = False
+        self.writer_task = None
+        # 会话令牌，以及写任务最后发出的已入库消息序号（断开时记入令牌）
+        self.token = None
+        self.last_seq = 0
+        # 有带序号的消息被丢弃后不再前移 last_seq，恢复会话时从丢弃之前的位置补发
+        self.seq_gap = False
+
+    def start(self):
+        """启动写任务"""
+        self.writer_task = asyncio.create_task(self._writer())
+        return self
+
+    def encode(self, flag, id, name, message, times, seq=None, room=None):
+        """按连接的消息格式编码一条放入本会话发送队列的消息"""
+        if self.codec is not None:
+            bits, body = compact_body(id, name, message, times, seq)
+            return PendingFrame(flag, bits, name, room, body)
+        return json_create(flag, id, name, message, times, seq, room)
+
+    def compact_frame(self, flag, bits, name, room, body):
+        """由 compact_body 的结果生成本会话的紧凑帧，多个会话共享同一个 body"""
+        return PendingFrame(flag, bits, name, room, body)
+
+    def enqueue(self, frame, critical=True, seq=None) -> bool:
+        """将消息放入发送队列，不等待发送完成；seq 为已入库消息的序号；返回消息是否入队"""
+        if self.closed:
+            return False
+        if len(self.queue) >= self.max_queue and not self._make_room(critical):
+            if seq:
+                self.seq_gap = True
+            return False
+        self.queue.append((frame, critical, seq))
+        self.wakeup.set()
+        return True
+
+    def _make_room(self, critical) -> bool:
+        """队列已满时按策略腾出位置；返回新消息是否还可以入队"""
+        if self.policy == DROP_OLDEST:
+            self._drop(0)
+            return True
+        if self.policy == DROP_NONCRITICAL:
+            if not critical:
+                self.dropped += 1
+                return False
+            for i, (_, queued_critical, _) in enumerate(self.queue):
+                if not queued_critical:
+                    self._drop(i)
+                    return True
+        # DISCONNECT 策略，或队列中全是关键消息时，断开该客户端
+        logger.warning(f"客户端 {self.user_id} 发送队列已满（{len(self.queue)}），断开连接")
+        self.abort()
+        return False
+
+    def _drop(self, index):
+        _, _, seq = self.queue[index]
+        del self.queue[index]
+        self.dropped += 1
+        if seq:
+            self.seq_gap = True
+
+    def abort(self, code=1008, reason='slow consumer'):
+        """丢弃未发送的消息并断开连接"""
+        self.close()
+        asyncio.create_task(self.websocket.close(code, reason))
+
+    def close(self):
+        """停止写任务"""
+        self.closed = True
+        self.queue.clear()
+        self.wakeup.set()
+        if self.writer_task is not None and self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
+
+    async def _writer(self):
+        """写任务：依次发送队列中的消息"""
+        try:
+            while True:
+                while not self.queue:
+                    if self.closed:
+                        return
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                frame, _, seq = self.queue.popleft()
+                if isinstance(frame, PendingFrame):
+                    # 驻留表在发送时才更新：队列满时被丢弃的帧不会带走客户端没有收到的定义
+                    frame = self.codec.assemble(*frame)
+                await self.websocket.send(frame)
+                if seq and not self.seq_gap:
+                    self.last_seq = seq
+        except websockets.ConnectionClosed:
+            logger.info(f"客户端 {self.user_id} 连接已关闭，停止发送")
+        finally:
+            self.closed = True
+            self.queue.clear()
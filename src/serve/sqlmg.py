@@ -1,64 +1,168 @@
+import itertools
 import logging
 import sqlite3
+import time
 
-# 创建一个日志记录器
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)  # 设置最低日志级别为 DEBUG
+# 日志由入口统一配置（见 logconfig），每条语句的日志为 DEBUG 级别
+logger = logging.getLogger('chat.db')
 
-# 创建终端处理器
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)  # 终端输出 DEBUG 级别及以上
-console_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(console_formatter)
+# 持久化模式
+DURABILITY_PER_MESSAGE = 'per_message'  # 每条写入单独提交，并等待 fsync
+DURABILITY_GROUPED = 'grouped'          # 写入先排队，攒够一批或定时在一个事务中提交
+DURABILITY_OS_BUFFERED = 'os_buffered'  # 同 grouped，但提交时不等待 fsync，交给操作系统缓冲
 
-# 创建文件处理器
-file_handler = logging.FileHandler('app.log')  # 日志文件名
-file_handler.setLevel(logging.INFO)  # 文件记录 INFO 级别及以上
-file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(file_formatter)
+# 各模式对应的 synchronous 设置
+SYNCHRONOUS = {
+    DURABILITY_PER_MESSAGE: 'FULL',
+    DURABILITY_GROUPED: 'NORMAL',
+    DURABILITY_OS_BUFFERED: 'OFF',
+}
 
-# 将处理器添加到日志记录器
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+# 数据库暂时不可写的错误码（忙、被锁定、读写出错、磁盘已满），这些错误下排队的写入保留到下次 flush 重试
+# SQLITE_BUSY / SQLITE_LOCKED / SQLITE_IOERR / SQLITE_FULL（sqlite3 模块从 Python 3.11 起才有这些常量）
+TRANSIENT_ERRORS = (5, 6, 10, 13)
+
+
+def is_transient(error) -> bool:
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is None:
+        # Python 3.11 之前的异常没有错误码
+        return isinstance(error, sqlite3.OperationalError)
+    return code & 0xff in TRANSIENT_ERRORS
+
+
+# 服务端数据库迁移脚本，第 n 个脚本把数据库从版本 n-1 升级到版本 n，已发布的脚本不要修改
+SERVER_MIGRATIONS = [
+    # 1：初始结构（兼容没有版本号的旧数据库）
+    '''
+    CREATE TABLE IF NOT EXISTS clients (
+        user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        password_hash TEXT NOT NULL,  -- 存储密码的哈希值
+        salt TEXT NOT NULL            -- 存储盐值
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER,
+        sender_username TEXT,
+        type INTEGER,
+        message TEXT,
+        timestamp DATETIME,
+        FOREIGN KEY(sender_id) REFERENCES clients(user_id)
+    );
+    CREATE TABLE IF NOT EXISTS blobs (
+        digest TEXT PRIMARY KEY,      -- 图片内容的 sha256
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL     -- 引用该图片的消息数
+    );
+    ''',
+    # 2：时间戳改为整数毫秒（旧数据按本地时间转换），并为同步和历史查询建立索引
+    '''
+    CREATE TABLE messages_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender_id INTEGER,
+        sender_username TEXT,
+        type INTEGER,
+        message TEXT,
+        timestamp INTEGER NOT NULL,   -- 毫秒时间戳
+        FOREIGN KEY(sender_id) REFERENCES clients(user_id)
+    );
+    INSERT INTO messages_new (id, sender_id, sender_username, type, message, timestamp)
+        SELECT id, sender_id, sender_username, type, message,
+               COALESCE(CAST(ROUND((julianday(timestamp, 'utc') - 2440587.5) * 86400000) AS INTEGER), 0)
+        FROM messages;
+    DROP TABLE messages;
+    ALTER TABLE messages_new RENAME TO messages;
+    CREATE INDEX idx_messages_timestamp ON messages (timestamp);
+    CREATE INDEX idx_messages_sender ON messages (sender_id, timestamp);
+    ''',
+    # 3：房间。已有消息都属于默认房间；成员关系按用户保存，默认房间不记录
+    '''
+    ALTER TABLE messages ADD COLUMN room TEXT NOT NULL DEFAULT 'lobby';
+    CREATE INDEX idx_messages_room ON messages (room, id);
+    CREATE TABLE room_members (
+        room TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        PRIMARY KEY (room, user_id)
+    );
+    CREATE INDEX idx_room_members_user ON room_members (user_id);
+    ''',
+    # 4：私聊会话。私聊消息的 room 为会话键，按 (room, id) 索引读取；每个参与者各有一行会话记录
+    '''
+    CREATE TABLE conversations (
+        user_id INTEGER NOT NULL,
+        peer_id INTEGER NOT NULL,
+        room TEXT NOT NULL,           -- 会话键 dm:较小id:较大id
+        PRIMARY KEY (user_id, peer_id)
+    );
+    ''',
+    # 5：分块上传的文件。uploads 记录进行中的上传，完成后移入 files，文件 id 与对应的 flag 9 消息 id 相同
+    '''
+    CREATE TABLE uploads (
+        upload_id TEXT PRIMARY KEY,   -- 客户端生成的上传 id
+        user_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        digest TEXT NOT NULL,         -- 整个文件的 sha256
+        room TEXT NOT NULL,
+        created INTEGER NOT NULL      -- 毫秒时间戳
+    );
+    CREATE TABLE files (
+        id INTEGER PRIMARY KEY,
+        digest TEXT NOT NULL,
+        name TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        user_id INTEGER,
+        room TEXT NOT NULL
+    );
+    ''',
+]
 
 class SqlMG():
-    def __init__(self, database):
+    def __init__(self, database, check_same_thread=True, durability=DURABILITY_PER_MESSAGE, batch_rows=200):
         """SQLite数据库设置"""
+        if durability not in SYNCHRONOUS:
+            raise ValueError(f'unknown durability mode: {durability}')
+        self.durability = durability
+        self.batch_rows = batch_rows
+        # 排队等待批量提交的写入 [(sql, params)]
+        self.pending = []
+        # 上次 flush 因数据库暂时不可写而把写入留在队列中，等待下次重试
+        self.retrying = False
+        # 语句耗时回调 on_statement(类型, 秒)，类型为 exec / fetch / flush，用于统计
+        self.on_statement = None
         try:
-            self.conn = sqlite3.connect(database)
+            self.conn = sqlite3.connect(database, check_same_thread=check_same_thread)
             self.conn.row_factory = sqlite3.Row
             self.cursor = self.conn.cursor()
-            logger.info('SqlMG init successfully.')
+            self.cursor.execute('PRAGMA journal_mode=WAL')
+            self.cursor.execute(f'PRAGMA synchronous={SYNCHRONOUS[durability]}')
+            logger.info(f'SqlMG init successfully with durability {durability}.')
         except sqlite3.Error as e:
             logger.error(f'SqlMG init failed: {e}')
             exit(0)
 
     def sever_sql(self):
-        try:
-            self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS clients (
-                user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                password_hash TEXT NOT NULL,  -- 存储密码的哈希值
-                salt TEXT NOT NULL            -- 存储盐值
-            );
-            ''')
-            self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_id INTEGER,
-                sender_username TEXT,
-                type INTEGER,
-                message TEXT,
-                timestamp DATETIME,
-                FOREIGN KEY(sender_id) REFERENCES clients(user_id)
-            );
-            ''')
-            self.conn.commit()
-            logger.info('sql for server init successfully.')
-        except sqlite3.Error as e:
-            logger.error(f'sql for server init failed: {e}')
-            exit(0)
+        """创建或升级服务端数据库结构"""
+        self.migrate(SERVER_MIGRATIONS)
+        logger.info('sql for server init successfully.')
+
+    def migrate(self, migrations):
+        """
+        按顺序执行尚未执行过的迁移脚本，已执行到的版本号记录在 PRAGMA user_version 中
+        每个脚本和版本号的更新在同一个事务中完成，失败时整体回滚
+        """
+        self.flush()
+        version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+        for number, script in enumerate(migrations[version:], start=version + 1):
+            try:
+                self.cursor.executescript(f'BEGIN;\n{script}\nPRAGMA user_version = {number};\nCOMMIT;')
+                logger.info(f'database migrated to version {number}.')
+            except sqlite3.Error as e:
+                if self.conn.in_transaction:
+                    self.conn.rollback()
+                logger.error(f'database migration to version {number} failed: {e}')
+                exit(0)
 
     def client_sql(self):
         try:
@@ -78,34 +182,131 @@ class SqlMG():
             logger.error(f'sql for client init failed: {e}')
             exit(0)
 
+    def _observe(self, kind, start):
+        if self.on_statement is not None:
+            self.on_statement(kind, time.perf_counter() - start)
+
     def exec(self, sql, params=None):
         """执行sql的插入、更新、删除功能"""
+        start = time.perf_counter()
         try:
             if params:
                 self.cursor.execute(sql, params)
             else:
                 self.cursor.execute(sql)
             self.conn.commit()
-            logger.info(f'{sql} with {params} run successfully.')
+            logger.debug('%s with %s run successfully.', sql, params)
         except sqlite3.Error as e:
             logger.error(f'{sql} with {params} run failed: {e}')
+        self._observe('exec', start)
+
+    def queue(self, sql, params):
+        """
+        执行写入：per_message 模式下立即提交；
+        其他模式下先排队，攒够 batch_rows 条时批量提交，其余由调用方定时 flush
+        """
+        if self.durability == DURABILITY_PER_MESSAGE:
+            self.exec(sql, params)
+            return
+        self.pending.append((sql, params))
+        # 重试期间只由定时 flush 重试，不在每次写入时都等待数据库
+        if len(self.pending) >= self.batch_rows and not self.retrying:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        把排队的写入在一个事务中用 executemany 批量执行，返回写入条数
+        批量提交失败时：数据库暂时不可写则把写入留在队列中，下次 flush 重试；
+        否则逐条重新写入，只丢弃出错的那一条，其余写入照常提交（这些消息的回执已经发出）
+        """
+        if not self.pending:
+            self.retrying = False
+            return 0
+        pending, self.pending = self.pending, []
+        start = time.perf_counter()
+        try:
+            # 相邻的相同语句合并为一次 executemany，保持写入顺序
+            for sql, rows in itertools.groupby(pending, key=lambda item: item[0]):
+                self.cursor.executemany(sql, [params for _, params in rows])
+            self.conn.commit()
+            written = len(pending)
+            self.retrying = False
+            logger.debug('flushed %d queued statements.', written)
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            if is_transient(e):
+                written = self._retry_later(pending, e)
+            else:
+                logger.warning(f'flush {len(pending)} queued statements failed: {e}, writing them one by one')
+                written = self._flush_rows(pending)
+        self._observe('flush', start)
+        return written
+
+    def _retry_later(self, pending, error) -> int:
+        """把没有写入的语句放回队列最前面，保持写入顺序"""
+        self.pending[:0] = pending
+        self.retrying = True
+        logger.error(f'flush {len(pending)} queued statements failed: {error}, will retry')
+        return 0
+
+    def _flush_rows(self, pending) -> int:
+        """逐条写入并一次提交：约束错误等只回滚出错的语句，数据库暂时不可写时整体放回队列"""
+        written = 0
+        try:
+            for sql, params in pending:
+                try:
+                    self.cursor.execute(sql, params)
+                    written += 1
+                except sqlite3.Error as e:
+                    if is_transient(e):
+                        raise
+                    logger.error(f'{sql} with {params} run failed: {e}, dropped')
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            return self._retry_later(pending, e)
+        self.retrying = False
+        return written
 
     def fetch(self, sql, params=None):
-        """执行sql的查询功能"""
+        """执行sql的查询功能（先提交排队的写入，保证能读到刚写入的数据）"""
+        self.flush()
+        start = time.perf_counter()
         try:
             if params:
                 self.cursor.execute(sql, params)
             else:
                 self.cursor.execute(sql)
-            logger.info(f'{sql} with {params} run successfully.')
+            logger.debug('%s with %s run successfully.', sql, params)
+        except sqlite3.Error as e:
+            logger.error(f'{sql} with {params} run failed: {e}')
+        rows = self.cursor.fetchall()
+        self._observe('fetch', start)
+        return rows
+
+    def fetch_page(self, sql, params, size):
+        """按页查询：用独立游标 fetchmany 取出最多 size 行，不把整个结果集读入内存"""
+        self.flush()
+        start = time.perf_counter()
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            rows = cursor.fetchmany(size)
+            logger.debug('%s with %s fetched %d rows.', sql, params, len(rows))
+            return rows
         except sqlite3.Error as e:
             logger.error(f'{sql} with {params} run failed: {e}')
-        return self.cursor.fetchall()
+            return []
+        finally:
+            cursor.close()
+            self._observe('fetch', start)
 
     def close(self):
-        """关闭数据库连接"""
-        if self.conn:
+        """关闭数据库连接，关闭前提交所有排队的写入"""
+        if getattr(self, 'conn', None):
+            self.flush()
             self.conn.close()
+            self.conn = None
             logger.info('Database connection closed.')
 
     def __del__(self):
@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import time
+
+# 令牌有效期（秒）
+TOKEN_TTL = 24 * 3600
+
+# 多个服务进程共用签名密钥时通过该环境变量传入（十六进制），未设置时每个进程随机生成
+TOKEN_SECRET_ENV = 'CHAT_TOKEN_SECRET'
+
+
+def load_secret():
+    secret = os.environ.get(TOKEN_SECRET_ENV)
+    return bytes.fromhex(secret) if secret else None
+
+
+class TokenStore:
+    """
+    会话令牌：登录成功后签发，断线重连时凭令牌恢复会话，不需要再次发送密码
+    令牌格式为 用户id.过期时间.随机数.签名（HMAC-SHA256），校验只访问内存表，不访问数据库；
+    内存表以随机数为键，记录令牌对应的用户，以及上次断开时最后投递的消息游标和所在房间；
+    多个服务进程各有一份内存表，签发、断开和吊销都经消息总线通知所有进程（见 serve.py）。
+    令牌只能恢复一次：恢复成功时吊销旧令牌并签发新令牌
+    """
+
+    def __init__(self, secret=None, ttl=TOKEN_TTL):
+        self.secret = secret or os.urandom(32)
+        self.ttl = ttl
+        self.entries = {}
+
+    def _sign(self, body) -> str:
+        return hmac.new(self.secret, body.encode('utf-8'), hashlib.sha256).hexdigest()
+
+    def issue(self, user_id, username):
+        """签发令牌，返回 (令牌, 过期时间)"""
+        expires = int(time.time()) + self.ttl
+        nonce = os.urandom(16).hex()
+        body = f'{user_id}.{expires}.{nonce}'
+        self.remember(nonce, user_id, username, expires)
+        return f'{body}.{self._sign(body)}', expires
+
+    def remember(self, nonce, user_id, username, expires):
+        """记录令牌（本进程签发的，或其他服务进程经消息总线通知的）"""
+        self.entries.setdefault(nonce, {"user_id": user_id, "username": username, "expires": expires,
+                                        "cursor": 0, "rooms": None})
+
+    def validate(self, token):
+        """校验令牌，有效时返回内存表中的记录，否则返回 None"""
+        try:
+            user_id, expires, nonce, signature = token.split('.')
+            user_id, expires = int(user_id), int(expires)
+        except (AttributeError, ValueError):
+            return None
+        if not hmac.compare_digest(signature, self._sign(f'{user_id}.{expires}.{nonce}')):
+            return None
+        if expires < time.time():
+            self.entries.pop(nonce, None)
+            return None
+        entry = self.entries.get(nonce)
+        if entry is None or entry["user_id"] != user_id:
+            return None
+        return entry
+
+    @staticmethod
+    def nonce(token) -> str:
+        return token.split('.')[2]
+
+    def suspend(self, nonce, cursor, rooms):
+        """
+        会话断开时记录最后投递的消息游标和所在房间：
+        恢复时客户端没有带游标则从这里继续，房间直接从这里恢复而不需要查询数据库
+        """
+        entry = self.entries.get(nonce)
+        if entry is not None:
+            entry["cursor"] = max(entry["cursor"], cursor)
+            entry["rooms"] = list(rooms)
+
+    def revoke(self, nonce):
+        """吊销令牌，之后凭它恢复会话都会失败"""
+        self.entries.pop(nonce, None)
+
+    def purge(self, now=None) -> int:
+        """删除过期的令牌，返回删除的数量"""
+        now = now or time.time()
+        expired = [nonce for nonce, entry in self.entries.items() if entry["expires"] < now]
+        for nonce in expired:
+            del self.entries[nonce]
+        return len(expired)
+
+    async def run(self, interval=600):
+        while True:
+            await asyncio.sleep(interval)
+            self.purge()
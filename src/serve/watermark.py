@@ -0,0 +1,74 @@
+import time
+
+from idgen import id_floor
+
+# 总线上水位事件使用的房间：空字符串不是合法的房间名，不会与聊天房间共用代理的事件编号和补发缓冲
+WATERMARK_ROOM = ''
+
+# 对端多久没有发布水位后视为已经退出（秒），不再等待它
+PEER_TIMEOUT = 10
+
+
+class CommitWatermark:
+    """
+    多个服务进程共用数据库时的已提交水位
+    各节点按时间分配 id，节点 B 已提交的消息 id 可能大于节点 A 已分配、还没有提交的 id；
+    发给客户端的游标越过这样的 id 时，客户端之后从该游标同步就会漏掉这条消息。
+
+    本节点记录已分配、还没有提交并发布到总线的 id，本节点的水位为其中最小的 id 之前的位置，
+    没有时为当前时间之前的位置和已提交的最大 id 中较大的一个（之后分配的 id 都更大）；水位在提交后通过消息总线发布，
+    晚于它覆盖的消息事件到达其他节点。集群水位为本节点和各对端水位中的最小值，不大于它的消息都已提交，
+    并且已经出现在各节点的内存缓冲中。
+    """
+
+    def __init__(self, peers=(), timeout=PEER_TIMEOUT):
+        self.peers = tuple(peers)
+        self.timeout = timeout
+        # 已分配、还没有提交的 id
+        self.pending = set()
+        # 已写入排队、等待下一次分组提交的 id
+        self.written = []
+        # 已提交的最大 id
+        self.highest = 0
+        # 各对端最近发布的水位 {节点号: (水位, 收到的时间)}，启动时视为 0，对端发布后才开始前进
+        started = time.monotonic()
+        self.reports = {peer: (0, started) for peer in self.peers}
+
+    def begin(self, message_id):
+        """分配了一个 id，提交并发布之前集群水位不会越过它"""
+        self.pending.add(message_id)
+
+    def queued(self, message_id):
+        """消息已写入排队并发布，下一次分组提交后才计入水位"""
+        self.written.append(message_id)
+
+    def requeue(self, message_ids):
+        """提交失败、留在队列中等待重试的 id，下一次提交后再计入水位"""
+        self.written[:0] = message_ids
+
+    def commit(self, message_ids):
+        """这些 id 的消息已提交并发布到总线"""
+        self.pending.difference_update(message_ids)
+        self.highest = max(self.highest, *message_ids, 0)
+
+    def take_written(self) -> list:
+        """取出排队等待提交的 id，调用方在下一次提交完成后对它们调用 commit"""
+        written, self.written = self.written, []
+        return written
+
+    def local(self) -> int:
+        """本节点的水位：本节点不大于它的 id 都已提交"""
+        if self.pending:
+            return min(self.pending) - 1
+        return max(id_floor(), self.highest)
+
+    def report(self, node, mark):
+        """记录对端发布的水位，重复或乱序到达的旧水位不会让水位后退"""
+        if node in self.reports:
+            self.reports[node] = (max(mark, self.reports[node][0]), time.monotonic())
+
+    def cluster(self) -> int:
+        """集群水位：各节点不大于它的 id 都已提交"""
+        now = time.monotonic()
+        marks = [mark for mark, received in self.reports.values() if now - received < self.timeout]
+        return min([self.local(), *marks])
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 服务端模块按同一目录内的平铺方式互相导入（from protocol import ...）
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'src', 'serve'))
@@ -0,0 +1,75 @@
+import json
+
+import bus
+import serve
+from bus import Broker, BrokerBus
+from rooms import RoomIndex
+
+
+def forward(broker, room, size):
+    broker._forward({"type": "broadcast", "room": room}, b'x' * size)
+
+
+def test_broker_history_is_bounded_by_bytes():
+    broker = Broker(history=100, history_bytes=10000)
+    for index in range(50):
+        forward(broker, f'room{index % 5}', 1000)
+    assert broker.history_total <= 10000
+    assert broker.history_total == sum(len(frame) for events in broker.history.values() for _, frame in events)
+    # 保留的是每个房间最近的事件
+    assert [seq for seq, _ in broker.history['room4']] == [9, 10]
+
+
+def test_broker_history_order_does_not_grow_with_count_evictions():
+    broker = Broker(history=4, history_bytes=10 ** 9)
+    for _ in range(1000):
+        forward(broker, 'lobby', 10)
+    assert [seq for seq, _ in broker.history['lobby']] == [997, 998, 999, 1000]
+    assert broker.history_count == 4
+    assert len(broker.history_order) <= 2 * 4 + 4
+
+
+def test_outbox_is_bounded_by_bytes(monkeypatch):
+    monkeypatch.setattr(bus, 'OUTBOX_BYTES', 5000)
+    node = BrokerBus('unused', lambda header, payload: None)
+    for _ in range(20):
+        node.publish({"type": "broadcast"}, b'x' * 1000)
+    assert node.outbox_bytes <= 5000
+    assert node.outbox_bytes == sum(len(frame) for frame in node.outbox)
+    assert node.dropped == 20 - len(node.outbox)
+    assert node.lost
+
+
+class RecordingBus:
+    def __init__(self):
+        self.events = []
+
+    def publish(self, header, payload=b''):
+        self.events.append(header)
+
+
+class Session:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.format = 'json'
+        self.codec = None
+        self.frames = []
+
+    def enqueue(self, frame, critical=True, seq=None):
+        self.frames.append(json.loads(frame))
+
+
+def test_online_notice_skips_the_user_who_logged_in(monkeypatch):
+    """多进程模式下上线通知经总线投递，不会发回刚登录的用户"""
+    recording = RecordingBus()
+    monkeypatch.setattr(serve, 'bus', recording)
+    monkeypatch.setattr(serve, 'rooms', RoomIndex())
+    alice, bob = Session(7), Session(8)
+    serve.rooms.add(alice)
+    serve.rooms.add(bob)
+
+    serve.announce_online(7, 'alice')
+    for header in recording.events:
+        serve.on_bus_event(header, b'')
+    assert alice.frames == []
+    assert [(frame['flag'], frame['id'], frame['message']) for frame in bob.frames] == [(0, 0, '用户alice已上线')]
@@ -0,0 +1,60 @@
+import asyncio
+import os
+
+from imagecache import ImageCache, SYNC_DERIVATIVE
+
+
+class FakeBlobStore:
+    def __init__(self, folder):
+        self.folder = folder
+
+    def locate(self, ref):
+        return os.path.join(self.folder, ref)
+
+    def derivative_path(self, ref, kind):
+        return os.path.join(self.folder, f'{ref}.{kind}')
+
+
+class FakeOffload:
+    """io 直接在事件循环中执行，cpu 记录调用次数并让出事件循环，模拟进程池中的压缩耗时"""
+
+    def __init__(self):
+        self.cpu_calls = 0
+
+    async def run_io(self, func, *args):
+        return func(*args)
+
+    async def run_cpu(self, func, *args):
+        self.cpu_calls += 1
+        await asyncio.sleep(0.05)
+        return b'compressed'
+
+
+def test_concurrent_gets_compress_once(tmp_path):
+    offload = FakeOffload()
+    cache = ImageCache(FakeBlobStore(str(tmp_path)), offload)
+
+    async def burst():
+        return await asyncio.gather(*(cache.get('abc') for _ in range(10)))
+
+    assert asyncio.run(burst()) == [b'compressed'] * 10
+    assert offload.cpu_calls == 1
+    assert cache.coalesced == 9
+    assert cache.pending == {}
+    assert (tmp_path / f'abc.{SYNC_DERIVATIVE}').read_bytes() == b'compressed'
+
+
+def test_cancelled_first_caller_does_not_cancel_generation(tmp_path):
+    offload = FakeOffload()
+    cache = ImageCache(FakeBlobStore(str(tmp_path)), offload)
+
+    async def scenario():
+        first = asyncio.create_task(cache.get('abc'))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(cache.get('abc'))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(scenario()) == b'compressed'
+    assert offload.cpu_calls == 1
@@ -0,0 +1,32 @@
+import asyncio
+
+import websockets
+
+from protocol import select_subprotocol, BINARY_SUBPROTOCOL, COMPACT_SUBPROTOCOL
+
+
+async def negotiate(offered):
+    """按服务端的握手设置启动一个服务器，返回客户端提供 offered 时协商出的子协议"""
+    async def handler(websocket):
+        await websocket.send(str(websocket.subprotocol))
+
+    async with websockets.serve(handler, 'localhost', 0, subprotocols=[COMPACT_SUBPROTOCOL, BINARY_SUBPROTOCOL],
+                                select_subprotocol=select_subprotocol) as server:
+        port = server.sockets[0].getsockname()[1]
+        async with websockets.connect(f'ws://localhost:{port}', subprotocols=offered) as websocket:
+            return websocket.subprotocol, await websocket.recv()
+
+
+def test_client_without_subprotocol_falls_back_to_json():
+    assert asyncio.run(negotiate(None)) == (None, 'None')
+
+
+def test_first_supported_offer_is_selected():
+    assert asyncio.run(negotiate(['chat.unknown', BINARY_SUBPROTOCOL, COMPACT_SUBPROTOCOL])) == \
+        (BINARY_SUBPROTOCOL, BINARY_SUBPROTOCOL)
+    assert asyncio.run(negotiate([COMPACT_SUBPROTOCOL, BINARY_SUBPROTOCOL])) == \
+        (COMPACT_SUBPROTOCOL, COMPACT_SUBPROTOCOL)
+
+
+def test_unsupported_offer_falls_back_to_json():
+    assert asyncio.run(negotiate(['chat.unknown'])) == (None, 'None')
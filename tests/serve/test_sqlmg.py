@@ -0,0 +1,52 @@
+import sqlite3
+
+from sqlmg import SqlMG, DURABILITY_GROUPED
+
+INSERT = 'INSERT INTO messages (id, sender_id, sender_username, message, timestamp, type, room) VALUES (?, ?, ?, ?, ?, ?, ?)'
+
+
+def open_db(path):
+    sql = SqlMG(str(path), durability=DURABILITY_GROUPED)
+    sql.sever_sql()
+    return sql
+
+
+def message(message_id):
+    return message_id, 1, 'alice', f'hello {message_id}', 0, 0, 'lobby'
+
+
+def stored_ids(sql):
+    return [row['id'] for row in sql.fetch('SELECT id FROM messages ORDER BY id')]
+
+
+def test_bad_row_does_not_discard_the_batch(tmp_path):
+    sql = open_db(tmp_path / 'chat.db')
+    sql.exec(INSERT, message(2))
+    for message_id in (1, 2, 3):
+        sql.queue(INSERT, message(message_id))
+    # id 2 已存在，只有这一条被丢弃
+    assert sql.flush() == 2
+    assert stored_ids(sql) == [1, 2, 3]
+    assert not sql.retrying
+    assert sql.pending == []
+
+
+def test_locked_database_keeps_rows_for_retry(tmp_path):
+    path = tmp_path / 'chat.db'
+    sql = open_db(path)
+    sql.cursor.execute('PRAGMA busy_timeout = 50')
+    for message_id in (1, 2):
+        sql.queue(INSERT, message(message_id))
+
+    other = sqlite3.connect(str(path), isolation_level=None)
+    other.execute('BEGIN EXCLUSIVE')
+    assert sql.flush() == 0
+    assert sql.retrying
+    assert len(sql.pending) == 2
+    other.execute('ROLLBACK')
+    other.close()
+
+    sql.queue(INSERT, message(3))
+    assert sql.flush() == 3
+    assert not sql.retrying
+    assert stored_ids(sql) == [1, 2, 3]
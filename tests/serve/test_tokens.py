@@ -0,0 +1,166 @@
+import asyncio
+import json
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import time
+
+import pytest
+import websockets
+
+import serve
+from protocol import json_create, now
+from rooms import RoomIndex
+from tokens import TokenStore
+
+SERVE_PATH = os.path.join(os.path.dirname(serve.__file__), 'serve.py')
+
+
+class RecordingBus:
+    def __init__(self):
+        self.events = []
+
+    def publish(self, header, payload=b''):
+        self.events.append(header)
+
+
+class Session:
+    def __init__(self, token):
+        self.token = token
+
+
+def test_suspend_state_reaches_other_workers(monkeypatch):
+    """worker A 上断开的会话，凭令牌在 worker B 上恢复时能取得游标和房间"""
+    secret = os.urandom(32)
+    worker_a, worker_b = TokenStore(secret), TokenStore(secret)
+    bus = RecordingBus()
+    monkeypatch.setattr(serve, 'bus', bus)
+    monkeypatch.setattr(serve, 'tokens', worker_a)
+    monkeypatch.setattr(serve, 'rooms', RoomIndex())
+
+    token, _ = serve.issue_token(7, 'alice')
+    session = Session(token)
+    serve.rooms.add(session, ['lobby', 'games'])
+    serve.suspend_token(session, 42)
+
+    monkeypatch.setattr(serve, 'tokens', worker_b)
+    for header in bus.events:
+        serve.on_bus_event(header, b'')
+    entry = worker_b.validate(token)
+    assert entry['cursor'] == 42
+    assert sorted(entry['rooms']) == ['games', 'lobby']
+
+
+def test_revoke_reaches_other_workers(monkeypatch):
+    secret = os.urandom(32)
+    worker_a, worker_b = TokenStore(secret), TokenStore(secret)
+    bus = RecordingBus()
+    monkeypatch.setattr(serve, 'bus', bus)
+    monkeypatch.setattr(serve, 'tokens', worker_a)
+
+    token, _ = serve.issue_token(7, 'alice')
+    new_token, _ = serve.rotate_token(token, 7, 'alice')
+    assert worker_a.validate(token) is None
+
+    monkeypatch.setattr(serve, 'tokens', worker_b)
+    for header in bus.events:
+        serve.on_bus_event(header, b'')
+    assert worker_b.validate(token) is None
+    assert worker_b.validate(new_token)['user_id'] == 7
+
+
+@pytest.fixture
+def server(tmp_path):
+    """在临时目录中启动一个单进程服务器，返回地址"""
+    with socket.socket() as probe:
+        probe.bind(('localhost', 0))
+        port = probe.getsockname()[1]
+    process = subprocess.Popen([sys.executable, SERVE_PATH, '--port', str(port)], cwd=tmp_path,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('localhost', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        yield f'wss://localhost:{port}'
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def client_ssl_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def reply(websocket, flag):
+    while True:
+        msg = json.loads(await websocket.recv())
+        if msg['flag'] == flag:
+            return msg
+
+
+async def login(url):
+    """注册并登录一个用户，返回 (user_id, 令牌)"""
+    async with websockets.connect(url, ssl=client_ssl_context()) as websocket:
+        await websocket.send(json_create(2, None, f'resume{os.getpid()}', 'secret', now()))
+        user_id = (await reply(websocket, 2))['id']
+        await websocket.send(json_create(1, user_id, f'resume{os.getpid()}', 'secret', now()))
+        assert (await reply(websocket, 1))['message'] == 'LOGIN_SUCCESS'
+        return user_id, (await reply(websocket, 16))['message']['token']
+
+
+async def resume(url, token):
+    async with websockets.connect(url, ssl=client_ssl_context()) as websocket:
+        await websocket.send(json_create(16, 0, '', {"token": token, "cursor": 0}, now()))
+        return (await reply(websocket, 16))['message']
+
+
+def test_resume_rotates_token(server):
+    async def scenario():
+        _, token = await login(server)
+        resumed = await resume(server, token)
+        assert resumed['status'] == 'RESUMED'
+        assert resumed['token'] != token
+        # 旧令牌已吊销，不能再恢复出第二个会话
+        assert (await resume(server, token))['status'] == 'RESUME_FAIL'
+        again = await resume(server, resumed['token'])
+        assert again['status'] == 'RESUMED'
+        assert (await resume(server, resumed['token']))['status'] == 'RESUME_FAIL'
+
+    asyncio.run(scenario())
+
+
+def test_parse_cursor():
+    assert serve.parse_cursor(42) == 42
+    assert serve.parse_cursor('42') == 42
+    for value in (None, True, -1, 'abc', '-1', 1.5, {"cursor": 1}, [1], 1 << 63):
+        assert serve.parse_cursor(value) is None
+
+
+def test_bad_sync_cursor_keeps_connection(server):
+    """无效的同步游标以 flag 7 回复 BAD_CURSOR，连接保持可用"""
+    async def scenario():
+        _, token = await login(server)
+        async with websockets.connect(server, ssl=client_ssl_context()) as websocket:
+            await websocket.send(json_create(16, 0, '', {"token": token, "cursor": "abc"}, now()))
+            assert (await reply(websocket, 16))['message']['status'] == 'RESUMED'
+            assert (await reply(websocket, 7))['message'] == {"status": "BAD_CURSOR"}
+            for ack in ({"cursor": {"id": 1}}, {"cursor": 0, "peer": "bob"}, "abc", None):
+                await websocket.send(json_create(6, 0, '', ack, now()))
+                assert (await reply(websocket, 7))['message'] == {"status": "BAD_CURSOR"}
+            await websocket.send(json_create(5, 0, '', {"cursor": [], "time": None}, now()))
+            assert (await reply(websocket, 7))['message'] == {"status": "BAD_CURSOR"}
+            await websocket.send(json_create(6, 0, '', 0, now()))
+            assert (await reply(websocket, 7))['message'] == 'sync_complete'
+
+    asyncio.run(scenario())